@@ -0,0 +1,232 @@
+'''
+    An index of the checkpoints of a benchmark, kept as JSON lines next to
+    them. Each line updates the record of one checkpoint with a few fields,
+    so that capture, conversion and simulation can each add what they learn
+    without rewriting the file, even from several processes at once. Tools
+    read the records instead of listing every checkpoint directory and
+    inspecting its files, which can take minutes on NFS.
+
+    Records may have:
+        number, insts or seconds: where the checkpoint is in the run.
+        created: when it was captured.
+        keyframe: the checkpoint it is a diff of, if any.
+        checksums: the sizes and hashes of its files, as in checksums.json.
+        format: what its memory is stored as, one of FORMATS, or None while
+                it is still being captured.
+        size: the size of that file.
+        mem_size: the size of its physical memory, as in mappings.json.
+        valid: False if converting it failed or it failed validate().
+        signature: its hardware event counts (see SimPoints).
+        sim_<mode>: how simulating it in that mode went.
+'''
+import json
+
+from fcntl import lockf, LOCK_UN, LOCK_EX
+from pathlib import Path
+
+from lapidary.checkpoint.Checkpoints import GDBCheckpoint, Gem5Checkpoint, \
+                                           Gem5DiffCheckpoint
+from lapidary.checkpoint.PageStore import PageStore
+
+class Catalog:
+
+    FILE_NAME = 'catalog.jsonl'
+    LOCK_FILE = 'catalog.lock'
+    FORMATS   = ['core', 'pmem', 'manifest', 'diff']
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.catalog_file   = self.checkpoint_dir / self.FILE_NAME
+        # Separate from the catalog, which compact() replaces.
+        self.lock_file      = self.checkpoint_dir / self.LOCK_FILE
+
+    @classmethod
+    def of(cls, gdb_checkpoint):
+        ''' The catalog which gdb_checkpoint belongs in. '''
+        return cls(gdb_checkpoint.checkpoint_directory.parent)
+
+    def exists(self):
+        return self.catalog_file.exists()
+
+    def update(self, name, **fields):
+        fields['name'] = name
+        line = json.dumps(fields, sort_keys=True) + '\n'
+        with self.lock_file.open('a') as lock:
+            try:
+                lockf(lock, LOCK_EX)
+                with self.catalog_file.open('a') as f:
+                    f.write(line)
+            finally:
+                lockf(lock, LOCK_UN)
+
+    def records(self):
+        ''' { name: record }, in checkpoint order. '''
+        from natsort import natsorted
+        records = {}
+        if not self.exists():
+            return records
+        with self.catalog_file.open() as f:
+            for line in f:
+                try:
+                    fields = json.loads(line)
+                except ValueError:
+                    # Someone is still writing this one.
+                    continue
+                records.setdefault(fields['name'], {}).update(fields)
+        return { name: records[name] for name in natsorted(records.keys()) }
+
+    @staticmethod
+    def is_usable(record):
+        ''' Whether the checkpoint can be converted or simulated. '''
+        return record.get('format') in Catalog.FORMATS and \
+               record.get('valid', True)
+
+    def checkpoints(self, usable_only=True):
+        ''' The checkpoint directories, in order, scanning them if need be. '''
+        records = self.records() if self.exists() else self.scan()
+        return [ self.checkpoint_dir / name for name, record in records.items()
+                 if not usable_only or self.is_usable(record) ]
+
+    @staticmethod
+    def describe(checkpoint_dir):
+        '''
+            The fields of a record that can be found from the checkpoint's
+            files, going by which files exist rather than by reading them.
+        '''
+        gdb_checkpoint = GDBCheckpoint(Path(checkpoint_dir))
+        fields = { 'format': None }
+        if not gdb_checkpoint.mappings_file.exists():
+            return fields
+
+        keyframe = gdb_checkpoint.get_keyframe()
+        if keyframe is not None:
+            fields['keyframe'] = keyframe.checkpoint_directory.name
+
+        diff_file  = Gem5DiffCheckpoint(Path(checkpoint_dir)).pmem_diff_file
+        core_files = gdb_checkpoint.get_core_files()
+        for fmt, file_path in [('pmem',     gdb_checkpoint.pmem_file),
+                               ('manifest', gdb_checkpoint.manifest_file),
+                               ('diff',     diff_file),
+                               ('core',     core_files[0] if core_files else None)]:
+            if file_path is not None and file_path.exists():
+                fields['format'] = fmt
+                fields['size']   = file_path.stat().st_size
+                break
+        return fields
+
+    def scan(self):
+        '''
+            Adds a record for every checkpoint directory which doesn't have
+            one yet, e.g. those created before there was a catalog.
+        '''
+        from lapidary.utils import Utils
+        records = self.records()
+        for dirent in Utils.get_directory_entries_by_time(self.checkpoint_dir):
+            if not dirent.is_dir() or dirent.name == PageStore.DIRECTORY or \
+               dirent.name in records:
+                continue
+            fields = self.describe(dirent)
+            gdb_checkpoint = GDBCheckpoint(dirent)
+            if gdb_checkpoint.mappings_file.exists():
+                fields['mem_size'] = Utils.get_mem_size_from_mappings_file(
+                    gdb_checkpoint.mappings_file)
+            signature = gdb_checkpoint.get_signature()
+            if signature is not None:
+                fields['signature'] = signature
+            self.update(dirent.name, **fields)
+        return self.records()
+
+    def rescan(self):
+        '''
+            Brings every record up to date with what is on disk, dropping
+            those of checkpoints which are gone.
+        '''
+        from lapidary.utils import Utils
+        names = []
+        for dirent in Utils.get_directory_entries_by_time(self.checkpoint_dir):
+            if dirent.is_dir() and dirent.name != PageStore.DIRECTORY:
+                self.update(dirent.name, valid=True, **self.describe(dirent))
+                names += [dirent.name]
+        return self.compact(names)
+
+    def compact(self, names=None):
+        '''
+            Rewrites the catalog with one line per checkpoint, only keeping
+            names if given.
+        '''
+        tmp_file = self.catalog_file.with_suffix('.tmp')
+        with self.lock_file.open('a') as lock:
+            try:
+                lockf(lock, LOCK_EX)
+                records = self.records()
+                if names is not None:
+                    records = { n: r for n, r in records.items() if n in names }
+                with tmp_file.open('w') as tmp:
+                    for record in records.values():
+                        tmp.write(json.dumps(record, sort_keys=True) + '\n')
+                tmp_file.rename(self.catalog_file)
+            finally:
+                lockf(lock, LOCK_UN)
+        return records
+
+    def validate(self, deep=False):
+        '''
+            Checks every checkpoint (see GDBCheckpoint.is_valid_checkpoint)
+            and records whether it is valid. Returns the names of those which
+            aren't.
+        '''
+        invalid = []
+        for name, record in self.records().items():
+            checkpoint_dir = self.checkpoint_dir / name
+            if record.get('format') == 'diff':
+                checkpoint = Gem5DiffCheckpoint(checkpoint_dir)
+            elif record.get('format') in ['pmem', 'manifest']:
+                checkpoint = Gem5Checkpoint(checkpoint_dir)
+            else:
+                checkpoint = GDBCheckpoint(checkpoint_dir)
+            valid = checkpoint.is_valid_checkpoint(deep)
+            if valid != record.get('valid', True):
+                self.update(name, valid=valid)
+            if not valid:
+                invalid += [name]
+        return invalid
+
+def record_checkpoint(gdb_checkpoint, **fields):
+    ''' Update gdb_checkpoint's record, for those without a Catalog at hand. '''
+    Catalog.of(gdb_checkpoint).update(
+        gdb_checkpoint.checkpoint_directory.name, **fields)
+
+def add_args(parser):
+    parser.add_argument('--checkpoint-dir', '-d', required=True,
+        help='Where the checkpoints of a benchmark are.')
+    parser.add_argument('--rescan', default=False, action='store_true',
+        help=('Update every record from the checkpoint files, e.g. after '
+              'checkpoints were deleted or copied in by hand.'))
+    parser.add_argument('--validate', default=False, action='store_true',
+        help=('Check each checkpoint against its recorded checksums, or its '
+              'core\'s headers if it has none, and record which are valid.'))
+    parser.add_argument('--deep', default=False, action='store_true',
+        help=('With --validate, also check that each core\'s segments match '
+              'its mappings.json, and the sizes and leading bytes of the '
+              'checkpoint\'s other files. Files aren\'t read through, so '
+              'corruption past their first 64KB isn\'t caught.'))
+
+def main(args):
+    catalog = Catalog(args.checkpoint_dir)
+    if args.rescan:
+        records = catalog.rescan()
+    else:
+        records = catalog.scan()
+    if args.validate:
+        invalid = catalog.validate(args.deep)
+        for name in invalid:
+            print('{} is not a valid checkpoint.'.format(name))
+        records = catalog.records()
+
+    formats = {}
+    for record in records.values():
+        fmt = record.get('format') if Catalog.is_usable(record) else 'unusable'
+        formats[fmt] = formats.get(fmt, 0) + 1
+    print('{} checkpoints in {}:'.format(len(records), catalog.catalog_file))
+    for fmt, count in sorted(formats.items(), key=lambda x: str(x[0])):
+        print('\t{}: {}'.format(fmt, count))
@@ -1,11 +1,11 @@
 #! /usr/bin/env python3
 
-import gzip, json, mimetypes, os, progressbar, resource, shutil
+import fcntl, gzip, json, mimetypes, mmap, os, progressbar, resource, shutil
 import subprocess
 
 from argparse import ArgumentParser
 from elftools.elf.elffile import ELFFile
-from multiprocessing import cpu_count, Pool, Lock, Process
+from multiprocessing import cpu_count, Pool, Lock
 from pathlib import Path
 from pprint import pprint
 from progressbar import ProgressBar
@@ -13,17 +13,57 @@ from time import sleep
 
 from lapidary.utils import *
 from lapidary.checkpoint.Checkpoints import *
+from lapidary.checkpoint.Catalog import Catalog, record_checkpoint
+from lapidary.checkpoint.PageStore import PageStore
+from lapidary.checkpoint.PmemDiff import PmemImage
+from lapidary.checkpoint.Compression import CompressionPool
+
+class SparsePmemWriter:
+    '''
+        Writes image data into a pmem file, skipping pages that are entirely
+        zero. The pmem is truncated to its full size up front, so skipped
+        pages stay as holes in a sparse file and still read back as zeros.
+    '''
+
+    def __init__(self, pmem_raw, mem_size):
+        pmem_raw.truncate(mem_size)
+        self.pmem_fd   = pmem_raw.fileno()
+        self.pgsize    = resource.getpagesize()
+        self.zero_page = bytes(self.pgsize)
+
+    def write(self, paddr, buf):
+        pgsize    = self.pgsize
+        zero_page = self.zero_page
+        run_start = None
+        for off in range(0, len(buf), pgsize):
+            page = buf[off:off + pgsize]
+            if page == zero_page[:len(page)]:
+                if run_start is not None:
+                    os.pwrite(self.pmem_fd, buf[run_start:off], paddr + run_start)
+                    run_start = None
+            elif run_start is None:
+                run_start = off
+        if run_start is not None:
+            os.pwrite(self.pmem_fd, buf[run_start:], paddr + run_start)
+
 
 class GDBCheckpointConverter:
 
-    def __init__(self, gdb_checkpoint, keyframe=None, diffs=None):
+    # How much of a segment is held in memory at once while converting.
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, gdb_checkpoint, keyframe=None, memory=None):
+        '''
+            memory: Read the image straight from a stopped process (see
+                    ProcessMemory) rather than from the checkpoint's core.
+        '''
         assert isinstance(gdb_checkpoint, GDBCheckpoint)
-        assert gdb_checkpoint.is_valid_checkpoint()
+        assert memory is not None or gdb_checkpoint.is_valid_checkpoint()
         assert keyframe is None or isinstance(keyframe, Gem5Checkpoint)
         self.gdb_checkpoint = gdb_checkpoint
         self.mappings = self.gdb_checkpoint.get_mappings()
         self.keyframe = keyframe
-        self.diff_frames = diffs
+        self.memory   = memory
 
     @staticmethod
     def compress_memory_image(file_path):
@@ -33,90 +73,310 @@ class GDBCheckpointConverter:
 
             The only downside is that simulations take longer to start.
         '''
-        subprocess.call(['gzip', '-f', str(file_path)])
-        gzip_path = Path(str(file_path) + '.gz')
-        gzip_path.rename(file_path)
-
+        compression = CompressionPool('gzip', max_workers=1)
+        compression.submit(file_path, keep_name=True)
+        compression.wait()
 
-    def _create_diff_file(self, src_pmem_fp, new_pmem_fp):
-        if self.keyframe is None:
-            return new_pmem_file
-        
-        from diff_match_patch import diff_match_patch
-        dmp = diff_match_patch()
 
+    @staticmethod
+    def _open_segment_source(core):
+        '''
+            Uncompressed cores are memory-mapped so that segments are streamed
+            straight out of the page cache. Compressed cores have no flat
+            layout to map, so we fall back to reading from the gzip stream.
+        '''
+        if isinstance(core, gzip.GzipFile):
+            return core
+        return mmap.mmap(core.fileno(), 0, access=mmap.ACCESS_READ)
 
-    def create_pmem_file(self):
+    def _copy_range(self, src, src_offset, size, sink, paddr):
+        '''
+            Copy size bytes from src (a file handle or mmap) into the sink in
+            chunks of CHUNK_SIZE, so peak memory does not depend on how large
+            the segment is.
+        '''
+        done = 0
+        while done < size:
+            length = min(self.CHUNK_SIZE, size - done)
+            src.seek(src_offset + done, 0)
+            buf = src.read(length)
+            if not buf:
+                break
+            sink.write(paddr + done, buf)
+
+            if isinstance(src, mmap.mmap) and hasattr(src, 'madvise'):
+                # Drop the pages we've already copied from our RSS.
+                start = ((src_offset + done) // mmap.PAGESIZE) * mmap.PAGESIZE
+                src.madvise(mmap.MADV_DONTNEED, start,
+                            src_offset + done + len(buf) - start)
+            done += len(buf)
+
+    def _write_process_image(self, sink):
+        '''
+            Stream every readable mapping of the process into
+            sink.write(paddr, buf).
+        '''
+        for vaddr, mapping in self.mappings.items():
+            if vaddr == 0 or vaddr == 'mem_size':
+                continue
+            if not self.memory.is_readable(vaddr):
+                continue
+            paddr = int(mapping['paddr'])
+            for done, buf in self.memory.read_range(vaddr, int(mapping['size'])):
+                sink.write(paddr + done, buf)
+
+    def _write_image(self, sink):
+        '''
+            Stream the whole memory image, shared objects first and then the
+            core's PT_LOAD segments, into sink.write(paddr, buf).
+        '''
+        if self.memory is not None:
+            return self._write_process_image(sink)
 
-        with self.gdb_checkpoint.get_pmem_file_handle() as pmem_raw,\
-             self.gdb_checkpoint.get_core_file_handle() as core:
+        with self.gdb_checkpoint.get_core_file_handle() as core:
             core_elf = ELFFile(core)
             pgsize = resource.getpagesize()
-            idx = 0
 
-            # Write out whole file as zeros first
-            pmem_raw.truncate(self.mappings['mem_size'])
+            load_segments = [ s for s in core_elf.iter_segments()
+                              if s['p_type'] == 'PT_LOAD' ]
 
-            # Check for shared object files
+            # Check for shared object files which were not dumped into the core
             for vaddr, mapping_dict in self.mappings.items():
                 if vaddr == 0 or vaddr == 'mem_size':
                     continue
 
+                in_core = False
+                for s in load_segments:
+                    elf_start_vaddr = int(s['p_vaddr'])
+                    elf_max_vaddr = elf_start_vaddr + int(s['p_memsz'])
+                    if elf_start_vaddr <= vaddr and vaddr < elf_max_vaddr:
+                        in_core = True
+                        break
+                if in_core:
+                    continue
+
                 maybe_file = Path(mapping_dict['name'])
                 if maybe_file.exists() and maybe_file.is_file():
-                    for s in core_elf.iter_segments():
-                        if s['p_type'] != 'PT_LOAD':
-                            continue
-                        elf_start_vaddr = int(s['p_vaddr'])
-                        elf_max_vaddr = elf_start_vaddr + int(s['p_memsz'])
-                        if elf_start_vaddr <= vaddr and vaddr < elf_max_vaddr:
-                            continue
-                        else:
-                            with maybe_file.open('rb') as shared_object:
-                                offset = int(mapping_dict['offset'])
-                                size   = int(mapping_dict['size'])
-                                paddr  = int(mapping_dict['paddr'])
-
-                                shared_object.seek(offset, 0)
-                                pmem_raw.seek(paddr, 0)
-
-                                buf = shared_object.read(size)
-                                pmem_raw.write(buf)
+                    with maybe_file.open('rb') as shared_object:
+                        offset = int(mapping_dict['offset'])
+                        size   = int(mapping_dict['size'])
+                        paddr  = int(mapping_dict['paddr'])
+                        self._copy_range(shared_object, offset, size,
+                                         sink, paddr)
 
             # Load everything else
-            for s in core_elf.iter_segments():
-                if s['p_type'] != 'PT_LOAD':
-                    continue
-                assert s['p_filesz'] == s['p_memsz']
-                assert s['p_memsz'] % pgsize == 0
-                if s['p_vaddr'] in self.mappings:
-
-                    mapping = self.mappings[s['p_vaddr']]
-                    paddr = int(mapping['paddr'])
-                    pmem_raw.seek(paddr, 0)
+            src = self._open_segment_source(core)
+            try:
+                for s in load_segments:
+                    assert s['p_filesz'] == s['p_memsz']
+                    assert s['p_memsz'] % pgsize == 0
+                    if s['p_vaddr'] in self.mappings:
+                        mapping = self.mappings[s['p_vaddr']]
+                        paddr = int(mapping['paddr'])
+                        self._copy_range(src, int(s['p_offset']),
+                                         int(s['p_filesz']), sink, paddr)
+            finally:
+                if src is not core:
+                    src.close()
 
-                    mem = s.data()
-                    assert len(mem) == s['p_memsz']
-                    #print('{}: {} -> {}, size {}'.format(os.getpid(), s['p_vaddr'], paddr, len(mem)))
-                    pmem_raw.write(mem)
+    def create_pmem_file(self):
+        with self.gdb_checkpoint.new_pmem_file() as pmem_file:
+            with pmem_file.open('wb') as pmem_raw:
+                self._write_image(SparsePmemWriter(pmem_raw,
+                                                   self.mappings['mem_size']))
 
         return self.gdb_checkpoint.pmem_file
 
+    def create_page_manifest(self):
+        '''
+            Rather than writing out a full pmem, add this checkpoint's pages
+            to the benchmark's shared page store and only keep a manifest.
+            The pmem is rebuilt with materialize_checkpoint before simulation.
+        '''
+        manifest = self.gdb_checkpoint.get_page_manifest()
+        with manifest.writer(self.mappings['mem_size']) as writer:
+            self._write_image(writer)
+
+        return self.gdb_checkpoint.manifest_file
+
+    def create_diff_file(self):
+        '''
+            Only store the pages which changed since the keyframe. Once the
+            diff is written, the core is removed, since the keyframe and the
+            diff are all that's needed to rebuild the pmem.
+        '''
+        assert self.keyframe is not None
+        keyframe_dir = self.keyframe.checkpoint_directory
+
+        diff_checkpoint = Gem5DiffCheckpoint(
+            self.gdb_checkpoint.checkpoint_directory)
+        diff = diff_checkpoint.get_pmem_diff()
+        with MaterializedCheckpoint(keyframe_dir):
+            if not self.keyframe.pmem_file_exists():
+                raise Exception('Keyframe {} has not been converted!'.format(
+                    self.keyframe))
+            with PmemImage(self.keyframe.pmem_file) as keyframe_image, \
+                 diff.writer(self.mappings['mem_size'], self.mappings,
+                             keyframe_dir.name, self.keyframe.get_mappings(),
+                             keyframe_image) as writer:
+                self._write_image(writer)
+
+        for core_file in self.gdb_checkpoint.get_core_files():
+            core_file.unlink()
+
+        return diff_checkpoint.pmem_diff_file
+
 
 ################################################################################
 
-def convert_checkpoint(gdb_checkpoint, force_recreate):
+def convert_checkpoint(gdb_checkpoint, force_recreate, dedup=False, memory=None):
+    '''
+        Converts the checkpoint's core into a pmem, a page manifest (dedup)
+        or a diff against its keyframe. With memory (a ProcessMemory), the
+        image is read from the process instead, and no core is needed.
+
+        The outcome is recorded in the checkpoint's Catalog.
+    '''
     assert isinstance(gdb_checkpoint, GDBCheckpoint)
+    try:
+        out_file = _convert_checkpoint(gdb_checkpoint, force_recreate, dedup,
+                                       memory)
+    except:
+        record_checkpoint(gdb_checkpoint, valid=False)
+        raise
+    if out_file is not None:
+        checksums = gdb_checkpoint.write_checksums()
+        record_checkpoint(gdb_checkpoint, valid=True, checksums=checksums,
+            **Catalog.describe(gdb_checkpoint.checkpoint_directory))
+    return out_file
+
+def _convert_checkpoint(gdb_checkpoint, force_recreate, dedup, memory):
+
+    keyframe = gdb_checkpoint.get_keyframe()
+    if keyframe is not None:
+        diff_checkpoint = Gem5DiffCheckpoint(gdb_checkpoint.checkpoint_directory)
+        if diff_checkpoint.is_valid_checkpoint() and memory is None and \
+           (not force_recreate or not gdb_checkpoint.is_valid_checkpoint()):
+            return None
+        converter = GDBCheckpointConverter(gdb_checkpoint, keyframe, memory)
+        diff_out_file = converter.create_diff_file()
+        assert diff_out_file.exists()
+        return diff_out_file
+
+    if dedup:
+        if gdb_checkpoint.manifest_file_exists() and not force_recreate:
+            return None
+        converter = GDBCheckpointConverter(gdb_checkpoint, memory=memory)
+        manifest_out_file = converter.create_page_manifest()
+        assert manifest_out_file.exists()
+        return manifest_out_file
 
     if gdb_checkpoint.pmem_file_exists() and not force_recreate:
         return None
 
-    converter = GDBCheckpointConverter(gdb_checkpoint)
+    converter = GDBCheckpointConverter(gdb_checkpoint, memory=memory)
     pmem_out_file = converter.create_pmem_file()
     assert pmem_out_file.exists()
     return pmem_out_file
 
 
+def materialize_checkpoint(checkpoint_dir):
+    '''
+        Make sure the checkpoint has a pmem file that gem5 can load, rebuilding
+        it from the page store if it was converted with --dedup, or from its
+        keyframe if it is a diff. Returns True if a pmem was created, so the
+        caller can remove it when done.
+
+        A checkpoint which was never converted gets its core converted into a
+        pmem, which is kept (and so False is returned), as converting it
+        again costs more than keeping it around.
+
+        This isn't safe against other processes using the same checkpoint,
+        see MaterializedCheckpoint for that.
+    '''
+    gdb_checkpoint = GDBCheckpoint(Path(checkpoint_dir))
+    if gdb_checkpoint.pmem_file_exists():
+        return False
+    if gdb_checkpoint.manifest_file_exists():
+        manifest = gdb_checkpoint.get_page_manifest()
+        with gdb_checkpoint.new_pmem_file() as pmem_file:
+            manifest.materialize(pmem_file)
+        return True
+
+    diff_checkpoint = Gem5DiffCheckpoint(Path(checkpoint_dir))
+    if diff_checkpoint.is_valid_checkpoint():
+        keyframe = diff_checkpoint.get_keyframe()
+        with MaterializedCheckpoint(keyframe.checkpoint_directory):
+            with PmemImage(keyframe.pmem_file) as keyframe_image, \
+                 diff_checkpoint.new_pmem_file() as pmem_file:
+                diff_checkpoint.get_pmem_diff().materialize(
+                    pmem_file, keyframe_image)
+        return True
+
+    if gdb_checkpoint.mappings_file.exists() and gdb_checkpoint.get_core_files():
+        GDBCheckpointConverter(gdb_checkpoint).create_pmem_file()
+        record_checkpoint(gdb_checkpoint,
+            **Catalog.describe(gdb_checkpoint.checkpoint_directory))
+    return False
+
+
+class MaterializedCheckpoint:
+    '''
+        Holds a checkpoint's pmem in place for the duration of a with
+        statement, materializing it first if need be, e.g. for a simulation.
+
+        Holders of the same checkpoint share it, even across processes: it
+        is only materialized by the first and only removed by the last (and
+        only if it can be rebuilt). The pmem of a checkpoint that was never
+        converted is kept, so each checkpoint is converted at most once.
+    '''
+
+    # Held exclusively while the pmem is created or removed.
+    CONVERT_LOCK = '.pmem.convert.lock'
+    # Held shared by every holder.
+    USERS_LOCK   = '.pmem.users.lock'
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.users          = None
+
+    def _open_lock(self, name):
+        return (self.checkpoint_dir / name).open('a')
+
+    def __enter__(self):
+        with self._open_lock(self.CONVERT_LOCK) as convert:
+            fcntl.flock(convert.fileno(), fcntl.LOCK_EX)
+            self.users = self._open_lock(self.USERS_LOCK)
+            fcntl.flock(self.users.fileno(), fcntl.LOCK_SH)
+            try:
+                materialize_checkpoint(self.checkpoint_dir)
+            except:
+                self.users.close()
+                self.users = None
+                raise
+        return GDBCheckpoint(self.checkpoint_dir)
+
+    def _can_rebuild(self):
+        gdb_checkpoint = GDBCheckpoint(self.checkpoint_dir)
+        return gdb_checkpoint.manifest_file_exists() or \
+               Gem5DiffCheckpoint(self.checkpoint_dir).is_valid_checkpoint()
+
+    def __exit__(self, *args):
+        with self._open_lock(self.CONVERT_LOCK) as convert:
+            fcntl.flock(convert.fileno(), fcntl.LOCK_EX)
+            try:
+                # Only succeeds if no one else holds the checkpoint.
+                fcntl.flock(self.users.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                pmem_file = GDBCheckpoint(self.checkpoint_dir).pmem_file
+                if self._can_rebuild() and pmem_file.exists():
+                    pmem_file.unlink()
+            except BlockingIOError:
+                pass
+            finally:
+                self.users.close()
+                self.users = None
+
+
 def add_arguments(parser):
     parser.add_argument('--pool-size', '-p', default=cpu_count(),
                         help='Number of threads to run at a time.')
@@ -128,6 +388,13 @@ def add_arguments(parser):
         help='Override existing checkpoints. Disabled by default')
     parser.add_argument('--no-compression', '-x', default=False,
         action='store_true', help='Do not compress pmem file. Faster, but space intensive')
+    parser.add_argument('--compress-workers', default=2, type=int,
+        help='Maximum number of pmem files to compress at once.')
+    parser.add_argument('--compress-threads', default=None, type=int,
+        help='Threads per compression job (uses pigz if available).')
+    parser.add_argument('--dedup', default=False, action='store_true',
+        help=('Store pages in a content-addressed page store shared by all '
+              'checkpoints, keeping only a page manifest per checkpoint.'))
 
 
 def main():
@@ -139,17 +406,36 @@ def main():
     checkpoint_dir = Path(args.checkpoint_dir)
     assert checkpoint_dir.exists()
 
-    pool_args = []
-    for checkpoint_subdir in utils.get_directory_entries_by_time(checkpoint_dir):
-        if checkpoint_subdir.is_dir():
-            checkpoint = GDBCheckpoint(checkpoint_subdir)
-            if checkpoint.is_valid_checkpoint():
-                pool_args += [ (checkpoint, args.force) ]
-            else:
-                print('{} is not a valid checkpoint, skipping.'.format(checkpoint))
+    checkpoints = {}
+    catalog = Catalog(checkpoint_dir)
+    records = catalog.records() if catalog.exists() else catalog.scan()
+    for name, record in records.items():
+        checkpoint = GDBCheckpoint(checkpoint_dir / name)
+        if Catalog.is_usable(record):
+            checkpoints[str(checkpoint)] = checkpoint
+        else:
+            print('{} is not a valid checkpoint, skipping.'.format(checkpoint))
 
     if args.num_checkpoints is not None:
-        pool_args = utils.select_evenly_spaced(pool_args, args.num_checkpoints)
+        checkpoints = Utils.select_evenly_spaced(checkpoints, args.num_checkpoints)
+
+    # Diffs can only be converted once their keyframes have been, so all the
+    # keyframes (whether selected or not) are converted first.
+    keyframes = {}
+    diffs     = []
+    for checkpoint in checkpoints.values():
+        keyframe = checkpoint.get_keyframe()
+        if keyframe is None:
+            keyframes[str(checkpoint)] = checkpoint
+        else:
+            keyframes.setdefault(str(keyframe), keyframe)
+            diffs += [checkpoint]
+
+    phases = [
+        [ (c, args.force, args.dedup) for c in keyframes.values() ],
+        [ (c, args.force, args.dedup) for c in diffs ],
+    ]
+    pool_args = phases[0] + phases[1]
 
     with Pool(int(args.pool_size)) as pool:
         bar = ProgressBar(max_value=len(pool_args))
@@ -162,44 +448,60 @@ def main():
                 update_bar.num_complete += 1
                 if pmem_file_dest is not None:
                     update_bar.newly_created += 1
-                    if update_bar.compress:
-                        gzip_proc = Process(target=GDBCheckpointConverter.compress_memory_image,
-                                            args=(pmem_file_dest,))
-                        update_bar.gzip_procs += [gzip_proc]
-                        gzip_proc.start()
+                    if update_bar.compress and \
+                       pmem_file_dest.name == GDBCheckpoint.PMEM_FILE:
+                        update_bar.to_compress += [pmem_file_dest]
+                        if not update_bar.defer:
+                            start_compression()
             finally:
                 lock.release()
 
+        def start_compression():
+            # gem5 can only read gzip'd pmem files, under their original name.
+            for pmem_file_dest in update_bar.to_compress:
+                compression.submit(pmem_file_dest, keep_name=True)
+            update_bar.to_compress = []
+
         update_bar.num_complete = 0
         update_bar.newly_created = 0
-        update_bar.gzip_procs = []
+        compression = CompressionPool('gzip',
+                                      max_workers=args.compress_workers,
+                                      threads=args.compress_threads)
         update_bar.compress = not args.no_compression
+        update_bar.to_compress = []
+        # Keyframes are read while converting diffs, so hold off on
+        # compressing them until every diff has been created.
+        update_bar.defer = len(diffs) > 0
         bar.start()
 
         def fail(e):
             raise e
 
-        results = []
-        for args in pool_args:
-            result = pool.apply_async(convert_checkpoint, args, callback=update_bar,
-                error_callback=fail)
-            results += [result]
-
-        all_ready = False
-        while not all_ready:
-            all_ready = True
-            for result in [r for r in results if not r.ready()]:
-                result.wait(0.1)
-                if not result.ready():
-                    all_ready = False
-                sleep(1)
-
+        for phase in phases:
+            results = []
+            for fn_args in phase:
+                result = pool.apply_async(convert_checkpoint, fn_args,
+                    callback=update_bar, error_callback=fail)
+                results += [result]
+
+            all_ready = False
+            while not all_ready:
+                all_ready = True
+                for result in [r for r in results if not r.ready()]:
+                    result.wait(0.1)
+                    if not result.ready():
+                        all_ready = False
+                    sleep(1)
+                with lock:
+                    compression.poll()
+
+        with lock:
+            start_compression()
         bar.finish()
         progressbar.streams.flush()
 
-        for gzip_proc in update_bar.gzip_procs:
-            if gzip_proc is not None:
-                gzip_proc.join()
+        compression.wait()
+        print(compression.report())
 
         print('\n{}/{} newly created, {}/{} already existed.'.format(
           update_bar.newly_created, len(pool_args),
@@ -1,8 +1,11 @@
+from bisect import bisect_right
 from jinja2 import Template
-import os, resource
+import logging, os, resource
 import re
 
 class MemoryMapping:
+    __slots__ = ('index', 'paddr', 'vaddr', 'size', 'offset', 'flags', 'name')
+
     def __init__(self, index, paddr, vaddr, size, offset, flags, name):
         self.index  = index
         self.paddr  = paddr
@@ -24,6 +27,54 @@ class MemoryMapping:
     def __contains__(self, vaddr):
         return self.vaddr <= vaddr and vaddr < self.vaddr + self.size
 
+    def to_dict(self):
+        return { attr: getattr(self, attr) for attr in self.__slots__ }
+
+
+class MappingTable:
+    '''
+        The mappings of a process, one MemoryMapping per region, sorted by
+        vaddr. Behaves like the { vaddr: MemoryMapping } dict it replaces
+        (keyed by the start of each region), but can also find the region
+        holding an address.
+    '''
+
+    def __init__(self, mappings):
+        self.regions = sorted(mappings)
+        self.starts  = [ m.vaddr for m in self.regions ]
+        self.pgsize  = resource.getpagesize()
+
+    def find(self, vaddr):
+        ''' The region which vaddr falls in, or None. '''
+        i = bisect_right(self.starts, vaddr) - 1
+        if i >= 0 and vaddr in self.regions[i]:
+            return self.regions[i]
+        return None
+
+    def __contains__(self, vaddr):
+        mapping = self.find(vaddr)
+        return mapping is not None and mapping.vaddr == vaddr
+
+    def __getitem__(self, vaddr):
+        if vaddr not in self:
+            raise KeyError(vaddr)
+        return self.find(vaddr)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def __iter__(self):
+        return iter(self.starts)
+
+    def items(self):
+        return zip(self.starts, self.regions)
+
+    def values(self):
+        return iter(self.regions)
+
+    def num_pages(self):
+        return sum((m.size + self.pgsize - 1) // self.pgsize for m in self.regions)
+
 
 class RegisterValues:
 
@@ -53,12 +104,67 @@ class RegisterValues:
         'idtr_attr': 46043
     }
 
+    # Registers which are unions of vector types, widest first.
+    VECTOR_FIELDS = ['v8_int64', 'v4_int64', 'v2_int64']
+
     def __init__(self, fs_base):
         import copy
         import gdb
-        raw = gdb.execute('info all-registers', to_string=True)
         self.regvals = copy.deepcopy(RegisterValues.defaults)
         self.fs_base = fs_base
+        # Full vector registers (xmm, ymm, zmm) as integers.
+        self.vectors = {}
+        self.frame   = gdb.selected_frame()
+
+        try:
+            registers = list(self.frame.architecture().registers())
+        except AttributeError:
+            # GDB is too old to list registers, so parse them instead.
+            self._parse_info_registers()
+            return
+
+        for register in registers:
+            value = self.frame.read_register(register)
+            vtype = value.type.strip_typedefs()
+            if vtype.code == gdb.TYPE_CODE_UNION:
+                vector = self._vector_to_int(value)
+                if vector is not None:
+                    self.vectors[register.name] = vector
+            elif vtype.code in (gdb.TYPE_CODE_INT, gdb.TYPE_CODE_PTR,
+                                gdb.TYPE_CODE_FLAGS):
+                mask = (1 << (8 * vtype.sizeof)) - 1
+                self.regvals[register.name] = int(value) & mask
+
+        self.regvals['rflags'] = self.regvals.get('eflags', 0)
+        for i in range(16):
+            xmm = self.vectors.get('xmm{}'.format(i), 0)
+            self.regvals['xmm{}_low'.format(i)]  = xmm & ((1 << 64) - 1)
+            self.regvals['xmm{}_high'.format(i)] = xmm >> 64
+
+        upper = [ name for name, vector in self.vectors.items()
+                  if name.startswith('ymm') and vector >> 128 ]
+        if upper:
+            logging.getLogger(name=__name__).warning(
+                'gem5 does not restore AVX state; dropping the upper halves of {}'.format(
+                    ', '.join(upper)))
+
+    @classmethod
+    def _vector_to_int(cls, value):
+        ''' The raw contents of a vector register, as one integer. '''
+        fields = [ f.name for f in value.type.strip_typedefs().fields() ]
+        for field in cls.VECTOR_FIELDS:
+            if field in fields:
+                elements = value[field]
+                low, high = elements.type.range()
+                vector = 0
+                for i in range(high, low - 1, -1):
+                    vector = (vector << 64) | (int(elements[i]) & ((1 << 64) - 1))
+                return vector
+        return None
+
+    def _parse_info_registers(self):
+        import gdb
+        raw = gdb.execute('info all-registers', to_string=True)
 
         for entry in raw.split(os.linesep):
             entry = entry.strip()
@@ -79,11 +185,9 @@ class RegisterValues:
             entry = gdb.execute('info registers xmm{}'.format(i), to_string=True)
             matches = RegisterValues.floats.match(entry.strip())
             if matches:
-                high = 'xmm{}_high'.format(i)
-                low = 'xmm{}_low'.format(i)
-                self.regvals[high] = int(matches.group(2), 16)
-                self.regvals[low] = int(matches.group(3), 16)
-                #print('{}: {}, {}'.format(i, self.regvals[high], self.regvals[low]))
+                # v2_int64 lists the low quadword first.
+                self.regvals['xmm{}_low'.format(i)]  = int(matches.group(2), 16)
+                self.regvals['xmm{}_high'.format(i)] = int(matches.group(3), 16)
 
 
     def __getitem__(self, regname):
@@ -115,7 +219,7 @@ class RegisterValues:
             regname = 'fpr{}'.format(i)
             reg_str += '{} '.format(self[regname])
         for i in range(32):
-            suffix = '_low' if i % 2 else '_high'
+            suffix = '_high' if i % 2 else '_low'
             regname = 'xmm{}{}'.format(i // 2, suffix)
             reg_str += '{} '.format(self[regname])
         for i in range(8):
@@ -129,13 +233,9 @@ class RegisterValues:
         return '{}'.format(virt_pc)
 
     def get_next_pc_string(self):
-        import gdb
-        raw = gdb.execute('x/2i $pc', to_string=True)
-        print(raw)
-        next_line = raw.split(os.linesep)[1].strip().replace('\t', ' ')
-        print(next_line)
-        next_pc = next_line.split(' ')[0].strip().replace(':', '')
-        return '{}'.format(int(next_pc, 16))
+        pc = int(self['rip'])
+        insn = self.frame.architecture().disassemble(pc)[0]
+        return '{}'.format(pc + insn['length'])
 
     def get_misc_reg_string(self):
         ''' For system.cpu.isa regVal string '''
@@ -203,9 +303,55 @@ class RegisterValues:
         return reg_str.strip()
 
 WORK_DIR = os.path.dirname(__file__)
+
+PAGE_TABLE_ENTRY = '\n[system.cpu.workload.Entry%d]\nvaddr=%d\npaddr=%d\nflags=0\n'
+# Where the page table goes in the rendered template.
+PAGE_TABLE_MARKER = '\0page_table\0'
+
+def write_page_table(f, mappings, batch_size=65536):
+    '''
+        Writes the page table entry of every page of mappings to f, batch_size
+        entries at a time. Each batch is formatted by one % over the whole
+        batch, with NumPy laying out the arguments, which beats formatting
+        the entries one at a time by quite a bit.
+    '''
+    import numpy as np
+    pgsize = mappings.pgsize
+    index  = 0
+    for m in mappings.regions:
+        num_pages = (m.size + pgsize - 1) // pgsize
+        for start in range(0, num_pages, batch_size):
+            count = min(batch_size, num_pages - start)
+            offsets = np.arange(start, start + count, dtype=np.uint64) * pgsize
+            args    = np.empty((count, 3), dtype=np.uint64)
+            args[:, 0] = np.arange(index, index + count, dtype=np.uint64)
+            args[:, 1] = offsets + m.vaddr
+            args[:, 2] = offsets + m.paddr if m.paddr != 0 else 0
+            f.write((PAGE_TABLE_ENTRY * count) % tuple(args.ravel().tolist()))
+            index += count
+
+_templates = {}
+
+def _get_template(template_file):
+    ''' Templates are compiled once per process, rather than per checkpoint. '''
+    if template_file not in _templates:
+        with open(template_file, 'r') as tf:
+            _templates[template_file] = Template(tf.read())
+    return _templates[template_file]
+
 def fill_checkpoint_template(template_file='%s/check.tmpl/m5.cpt' % WORK_DIR,
                              output_file='%s/check.cpt/m5.cpt' % WORK_DIR, **kwargs):
-    with open(template_file, 'r') as tf:
-        template = Template(tf.read())
-        with open(output_file, 'w') as f:
-            f.write(template.render(**kwargs))
+    '''
+        The rendered template is written out as it is generated, and the page
+        table (which is most of it) straight from the mappings, so that the
+        whole file is never held in memory.
+    '''
+    template = _get_template(template_file)
+    with open(output_file, 'w') as f:
+        for chunk in template.generate(page_table=PAGE_TABLE_MARKER, **kwargs):
+            if PAGE_TABLE_MARKER in chunk:
+                before, after = chunk.split(PAGE_TABLE_MARKER, 1)
+                f.write(before)
+                write_page_table(f, kwargs['mappings'])
+                chunk = after
+            f.write(chunk)
@@ -1,7 +1,102 @@
 from pathlib import Path
+from tempfile import NamedTemporaryFile
+import hashlib
 import json
 import gzip
-from elftools.elf.elffile import ELFFile
+import os
+import resource
+import struct
+import subprocess
+
+from lapidary.checkpoint.Compression import CODECS
+
+from lapidary.checkpoint.PageStore import PageStore, PageManifest
+from lapidary.checkpoint.PmemDiff import PmemDiff
+
+class CoreHeader:
+    '''
+        The ELF header and program headers of a core file. Only as much of
+        the core as the headers take up is read (or decompressed), which for
+        a core is its first few KB.
+    '''
+
+    EHDR = struct.Struct('<16sHHIQQQIHHHHHH')
+    PHDR = struct.Struct('<IIQQQQQQ')
+    SHDR = struct.Struct('<IIQQQQIIQQ')
+
+    ET_CORE   = 4
+    PT_LOAD   = 1
+    # e_phnum when the real count is in the first section header.
+    PN_XNUM   = 0xffff
+
+    def __init__(self, read_head):
+        '''
+            read_head(size) returns the first size bytes of the core. Raises
+            ValueError if they aren't the headers of an ELF64 core.
+        '''
+        ehdr = read_head(self.EHDR.size)
+        if len(ehdr) < self.EHDR.size:
+            raise ValueError('Truncated ELF header')
+        (ident, e_type, _, _, _, phoff, shoff, _, _, phentsize, phnum, _,
+         _, _) = self.EHDR.unpack(ehdr)
+        if ident[:4] != b'\x7fELF' or ident[4] != 2 or ident[5] != 1:
+            raise ValueError('Not a little-endian ELF64 file')
+        if e_type != self.ET_CORE:
+            raise ValueError('Not a core file ({})'.format(e_type))
+        if phentsize != self.PHDR.size:
+            raise ValueError('Bad program header size {}'.format(phentsize))
+
+        if phnum == self.PN_XNUM:
+            head = read_head(shoff + self.SHDR.size)
+            if len(head) < shoff + self.SHDR.size:
+                raise ValueError('Truncated section header')
+            phnum = self.SHDR.unpack_from(head, shoff)[7]
+
+        table_end = phoff + phnum * phentsize
+        head = read_head(table_end)
+        if len(head) < table_end:
+            raise ValueError('Truncated program headers')
+
+        self.segments = []
+        for i in range(phnum):
+            (p_type, _, p_offset, p_vaddr, _, p_filesz, p_memsz,
+             _) = self.PHDR.unpack_from(head, phoff + i * phentsize)
+            self.segments += [{ 'p_type':   p_type,   'p_offset': p_offset,
+                                'p_vaddr':  p_vaddr,  'p_filesz': p_filesz,
+                                'p_memsz':  p_memsz }]
+        self.header_size = table_end
+
+    def load_segments(self):
+        return [ s for s in self.segments if s['p_type'] == self.PT_LOAD ]
+
+    def data_size(self):
+        ''' How large the core has to be to hold every segment. '''
+        return max([ s['p_offset'] + s['p_filesz'] for s in self.segments ] +
+                   [ self.header_size ])
+
+
+class NewPmemFile:
+    '''
+        A temporary file next to pmem_file to write a pmem to, for the
+        duration of a with statement. It is only renamed into place if the
+        with statement completes, so that a conversion which fails or is
+        killed never leaves a partial pmem behind to be simulated.
+    '''
+
+    def __init__(self, pmem_file):
+        self.pmem_file = pmem_file
+        self.tmp_file  = pmem_file.with_name('.{}.{}.tmp'.format(
+            pmem_file.name, os.getpid()))
+
+    def __enter__(self):
+        return self.tmp_file
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            os.rename(str(self.tmp_file), str(self.pmem_file))
+        elif self.tmp_file.exists():
+            self.tmp_file.unlink()
+
 
 class GDBCheckpoint:
 
@@ -9,6 +104,14 @@ class GDBCheckpoint:
     GDB_CORE_FILE = 'gdb.core'
     GDB_GZIP_FILE = 'gdb.core.gz'
     PMEM_FILE     = 'system.physmem.store0.pmem'
+    MANIFEST_FILE = 'system.physmem.store0.pmem.manifest'
+    DIFF_FILE     = 'system.physmem.store0.pmem.diff'
+    KEYFRAME_FILE = 'keyframe'
+    SIGNATURE_FILE = 'perf_signature.json'
+    CHECKSUMS_FILE = 'checksums.json'
+
+    # Files at most this large are hashed whole, the rest only this far in.
+    CHECKSUM_HEAD = 64 * 1024
 
     def __init__(self, checkpoint_directory):
         assert isinstance(checkpoint_directory, Path)
@@ -18,6 +121,10 @@ class GDBCheckpoint:
         self.gdb_core_file = self.checkpoint_directory / self.GDB_CORE_FILE
         self.gdb_gzip_file = self.checkpoint_directory / self.GDB_GZIP_FILE
         self.pmem_file     = self.checkpoint_directory / self.PMEM_FILE
+        self.manifest_file = self.checkpoint_directory / self.MANIFEST_FILE
+        self.keyframe_file = self.checkpoint_directory / self.KEYFRAME_FILE
+        self.signature_file = self.checkpoint_directory / self.SIGNATURE_FILE
+        self.checksums_file = self.checkpoint_directory / self.CHECKSUMS_FILE
         self.mappings      = None
 
     def get_mappings(self):
@@ -32,42 +139,229 @@ class GDBCheckpoint:
                         self.mappings[int(key)] = mapping
         return self.mappings
 
-    def is_valid_checkpoint(self):
-        exists = self.mappings_file.exists() and \
-            (self.gdb_core_file.exists or self.gdb_gzip_file.exists())
-        valid = True
-        if exists:
+    def read_core_head(self, size):
+        ''' The first size bytes of the (decompressed) core. '''
+        if self.gdb_core_file.exists():
+            with self.gdb_core_file.open('rb') as f:
+                return f.read(size)
+        core_file, codec = self.get_compressed_core_file()
+        if codec.name == 'gzip':
+            with gzip.open(str(core_file), 'rb') as f:
+                return f.read(size)
+        proc = subprocess.Popen(codec.decompress(core_file),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        try:
+            return proc.stdout.read(size)
+        finally:
+            proc.kill()
+            proc.wait()
+            proc.stdout.close()
+
+    def get_core_header(self):
+        return CoreHeader(self.read_core_head)
+
+    def is_valid_checkpoint(self, deep=False):
+        '''
+            Whether the checkpoint has its mappings and a sound core. If the
+            core is as it was when its checksum was recorded, that's taken as
+            enough; otherwise only its headers are read, to check that it is
+            a core which holds all of its segments.
+
+            deep: Also read the core's headers to check that its segments
+                  match mappings.json, and check the sizes and leading
+                  hashes of the checkpoint's other files. Like the fast
+                  path, this doesn't read files through, so it can't catch
+                  corruption past their first CHECKSUM_HEAD bytes.
+        '''
+        core_files = self.get_core_files()
+        if not self.mappings_file.exists() or not core_files:
+            return False
+
+        checksums = self.get_checksums()
+        if checksums is not None:
+            if not self.verify_checksums(checksums, [ f.name for f in core_files ]):
+                return False
+            if not deep and core_files[0].name in checksums:
+                return True
+
+        try:
+            header = self.get_core_header()
+        except (ValueError, OSError, EOFError):
+            return False
+        if self.gdb_core_file.exists() and \
+           header.data_size() > self.gdb_core_file.stat().st_size:
+            return False
+        if deep:
+            return self._core_matches_mappings(header) and \
+                   (checksums is None or self.verify_checksums(checksums))
+        return True
+
+    def _core_matches_mappings(self, header):
+        '''
+            Whether the core's segments are what conversion expects: whole
+            pages, all of them in the file, and no larger than the mappings
+            they are copied into.
+        '''
+        pgsize   = resource.getpagesize()
+        mappings = self.get_mappings()
+        for s in header.load_segments():
+            if s['p_filesz'] != s['p_memsz'] or s['p_memsz'] % pgsize != 0:
+                return False
+            mapping = mappings.get(s['p_vaddr'])
+            if mapping is not None and s['p_memsz'] > int(mapping['size']):
+                return False
+        return True
+
+    @classmethod
+    def _checksum(cls, file_path):
+        size = file_path.stat().st_size
+        with file_path.open('rb') as f:
+            head = f.read(cls.CHECKSUM_HEAD)
+        return { 'size': size, 'sha1': hashlib.sha1(head).hexdigest() }
+
+    def write_checksums(self):
+        '''
+            Records the size and a hash of each of the checkpoint's files,
+            so that they can be told apart from truncated or replaced files
+            without reading them through. Returns what was recorded.
+        '''
+        # Not the pmem, which comes and goes as the checkpoint is simulated.
+        files = [ self.mappings_file, self.checkpoint_directory / 'm5.cpt',
+                  self.manifest_file,
+                  self.checkpoint_directory / self.DIFF_FILE ] + \
+                self.get_core_files()
+        checksums = {}
+        for f in files:
             try:
-                with self.get_core_file_handle() as core:
-                    core_elf = ELFFile(core)
-            except:
-                valid = False
-        return exists and valid
+                checksums[f.name] = self._checksum(f)
+            except FileNotFoundError:
+                # e.g. a core removed once it was compressed or converted.
+                pass
+        tmp_file = self.checksums_file.with_suffix('.tmp')
+        with tmp_file.open('w') as f:
+            json.dump(checksums, f, indent=4)
+        tmp_file.rename(self.checksums_file)
+        return checksums
+
+    def get_checksums(self):
+        if not self.checksums_file.exists():
+            return None
+        with self.checksums_file.open() as f:
+            return json.load(f)
+
+    def verify_checksums(self, checksums, names=None):
+        ''' Checks the files in names (all that were recorded by default). '''
+        for name, expected in checksums.items():
+            if names is not None and name not in names:
+                continue
+            file_path = self.checkpoint_directory / name
+            if not file_path.exists():
+                # e.g. a core removed once its diff was written.
+                continue
+            if file_path.stat().st_size != expected['size'] or \
+               self._checksum(file_path) != expected:
+                return False
+        return True
+
+    def get_compressed_core_file(self):
+        ''' Returns (path, codec) of the compressed core, if there is one. '''
+        for codec in CODECS.values():
+            core_file = codec.compressed_path(self.gdb_core_file)
+            if core_file.exists():
+                return core_file, codec
+        return None
+
+    def get_core_files(self):
+        ''' All of the core files for this checkpoint, compressed or not. '''
+        return [ f for f in [self.gdb_core_file] +
+                 [ c.compressed_path(self.gdb_core_file) for c in CODECS.values() ]
+                 if f.exists() ]
 
     def get_core_file_handle(self):
         if self.gdb_core_file.exists():
             return self.gdb_core_file.open('rb')
-        return gzip.open(str(self.gdb_gzip_file), 'rb')
+        core_file, codec = self.get_compressed_core_file()
+        if codec.name == 'gzip':
+            return gzip.open(str(core_file), 'rb')
+        # Other codecs can't be read as a seekable stream, so decompress into
+        # a temporary file that goes away once the handle is closed.
+        tmp = NamedTemporaryFile(dir=str(self.checkpoint_directory),
+                                 prefix='gdb.core.', suffix='.tmp')
+        subprocess.run(codec.decompress(core_file), stdout=tmp, check=True)
+        tmp.seek(0)
+        return tmp
 
-    def get_pmem_file_handle(self):
-        return self.pmem_file.open('wb')
+    def new_pmem_file(self):
+        return NewPmemFile(self.pmem_file)
 
     def pmem_file_exists(self):
         return self.pmem_file.exists()
 
+    def manifest_file_exists(self):
+        return self.manifest_file.exists()
+
+    def get_page_store(self):
+        ''' All checkpoints of a benchmark share one store, next to them. '''
+        return PageStore(self.checkpoint_directory.parent / PageStore.DIRECTORY)
+
+    def get_page_manifest(self):
+        return PageManifest(self.manifest_file, self.get_page_store())
+
+    def get_keyframe(self):
+        '''
+            If this checkpoint was captured as a diff, returns the keyframe
+            checkpoint it is relative to, otherwise None.
+        '''
+        if not self.keyframe_file.exists():
+            return None
+        with self.keyframe_file.open() as f:
+            name = f.read().strip()
+        return Gem5Checkpoint(self.checkpoint_directory.parent / name)
+
+    def set_keyframe(self, keyframe_directory):
+        with self.keyframe_file.open('w') as f:
+            f.write(keyframe_directory.name)
+
+    def get_signature(self):
+        '''
+            Hardware event counts over the native run from this checkpoint up
+            to the next one, if they were profiled (see PerfCounters).
+        '''
+        if not self.signature_file.exists():
+            return None
+        with self.signature_file.open() as f:
+            return json.load(f)
+
+    def set_signature(self, counts):
+        with self.signature_file.open('w') as f:
+            json.dump(counts, f, indent=4)
+
     def __str__(self):
         return str(self.checkpoint_directory)
 
 
 class Gem5Checkpoint(GDBCheckpoint):
-    def is_valid_checkpoint(self):
-        return super().is_valid_checkpoint(self) and self.pmem_file.exists()
+    def is_valid_checkpoint(self, deep=False):
+        ''' The core isn't needed anymore once there's a pmem or manifest. '''
+        if not self.mappings_file.exists() or \
+           not (self.pmem_file.exists() or self.manifest_file.exists()):
+            return False
+        checksums = self.get_checksums()
+        return not deep or checksums is None or self.verify_checksums(checksums)
 
 class Gem5DiffCheckpoint(GDBCheckpoint):
-    
+
     def __init__(self, checkpoint_directory):
-        super().__init__(self, checkpoint_directory)
-        self.pmem_diff_file = self.pmem_file + '.diff'
-    
-    def is_valid_checkpoint(self):
-        return super().is_valid_checkpoint(self) and self.pmem_diff_file.exists()
+        super().__init__(checkpoint_directory)
+        self.pmem_diff_file = self.checkpoint_directory / self.DIFF_FILE
+
+    def get_pmem_diff(self):
+        return PmemDiff(self.pmem_diff_file)
+
+    def is_valid_checkpoint(self, deep=False):
+        ''' The core is removed once the diff is written. '''
+        if not self.mappings_file.exists() or not self.pmem_diff_file.exists():
+            return False
+        checksums = self.get_checksums()
+        return not deep or checksums is None or self.verify_checksums(checksums)
@@ -0,0 +1,200 @@
+from collections import deque
+from multiprocessing import cpu_count
+from pathlib import Path
+from time import time, sleep
+import logging
+import shutil
+import subprocess
+
+from lapidary.utils.Utils import WorkerSlots
+
+class Codec:
+    '''
+        A command line compressor. compress() returns the command to compress
+        a file in place (i.e. file -> file + extension, removing the original)
+        and decompress() the command to decompress a file to stdout.
+    '''
+
+    def __init__(self, name, extension, compress_fn, decompress_args):
+        self.name            = name
+        self.extension       = extension
+        self._compress_fn    = compress_fn
+        self.decompress_args = decompress_args
+
+    def compress(self, file_path, threads):
+        return self._compress_fn(threads) + [str(file_path)]
+
+    def decompress(self, file_path):
+        return self.decompress_args + [str(file_path)]
+
+    def compressed_path(self, file_path):
+        return Path(str(file_path) + self.extension)
+
+    def __str__(self):
+        return self.name
+
+
+def _gzip_command(threads):
+    # pigz produces ordinary gzip files, which is what gem5 expects for pmems.
+    if threads > 1 and shutil.which('pigz') is not None:
+        return ['pigz', '-f', '-p', str(threads)]
+    return ['gzip', '-f']
+
+CODECS = {
+    'gzip': Codec('gzip', '.gz', _gzip_command, ['gzip', '-dc']),
+    'zstd': Codec('zstd', '.zst',
+                  lambda threads: ['zstd', '-q', '-f', '--rm', '-T{}'.format(threads)],
+                  ['zstd', '-dcq']),
+    'lz4':  Codec('lz4', '.lz4', lambda threads: ['lz4', '-q', '-f', '--rm'],
+                  ['lz4', '-dcq']),
+}
+
+def get_codec(name):
+    if name not in CODECS:
+        raise Exception('{} is not a valid codec. Valid codecs: {}'.format(
+            name, ', '.join(CODECS.keys())))
+    return CODECS[name]
+
+
+class CompressionJob:
+    def __init__(self, file_path, codec, keep_name):
+        self.file_path = file_path
+        self.codec     = codec
+        self.keep_name = keep_name
+        self.proc      = None
+        self.start     = None
+        self.in_size   = 0
+
+
+class CompressionPool:
+    '''
+        Runs compression jobs as subprocesses, at most max_workers at a time.
+        Once max_pending jobs are queued up behind those, submit() blocks until
+        a job finishes, which keeps whoever is producing files (e.g. the GDB
+        capture loop) from getting too far ahead of the disk.
+
+        This does not use threads, as the pool is also driven from inside GDB;
+        instead, callers call poll() periodically to reap finished jobs.
+
+        Jobs which fail are not reported as finished; their paths are added
+        to failed instead, and the original files are left in place.
+
+        If slots (a Utils.WorkerSlots) is given, each running job also holds
+        one of its slots, so that pools in different processes share a bound.
+    '''
+
+    def __init__(self, codec='gzip', max_workers=2, threads=None,
+                 max_pending=None, slots=None):
+        self.codec       = get_codec(codec) if isinstance(codec, str) else codec
+        self.max_workers = max(1, int(max_workers))
+        self.threads     = threads if threads is not None else \
+                           max(1, cpu_count() // (4 * self.max_workers))
+        self.max_pending = max_pending if max_pending is not None else \
+                           self.max_workers
+        self.slots       = slots
+        self.queue       = deque()
+        self.running     = []
+        self.failed      = []
+        self.logger      = logging.getLogger(name=__name__)
+
+        self.num_files   = 0
+        self.bytes_in    = 0
+        self.bytes_out   = 0
+        self.busy_time   = 0.0
+
+    def submit(self, file_path, keep_name=False):
+        '''
+            Queue up file_path to be compressed. If keep_name is set, the
+            compressed file is renamed back to file_path, e.g. for pmem files.
+        '''
+        self.queue.append(CompressionJob(Path(file_path), self.codec, keep_name))
+        completed = self.poll()
+        while len(self.queue) > self.max_pending:
+            sleep(0.1)
+            completed += self.poll()
+        return completed
+
+    def _start(self, job, slot=None):
+        job.in_size = job.file_path.stat().st_size
+        job.start   = time()
+        if slot is None:
+            job.proc = subprocess.Popen(job.codec.compress(job.file_path,
+                                                           self.threads))
+        else:
+            # The compressor holds the slot until it exits.
+            job.proc = subprocess.Popen(job.codec.compress(job.file_path,
+                                                           self.threads),
+                                        pass_fds=(slot.fileno(),))
+            WorkerSlots.release(slot)
+        self.running += [job]
+
+    def _finish(self, job):
+        ''' Returns True if the job produced a compressed file. '''
+        elapsed  = time() - job.start
+        out_path = job.codec.compressed_path(job.file_path)
+        if job.proc.returncode != 0 or not out_path.exists():
+            self.logger.error('Compressing {} with {} failed ({})'.format(
+                job.file_path, job.codec, job.proc.returncode))
+            # Don't leave a partial output around next to the original.
+            if job.file_path.exists() and out_path.exists():
+                out_path.unlink()
+            self.failed += [job.file_path]
+            return False
+        out_size = out_path.stat().st_size
+        if job.keep_name:
+            out_path.rename(job.file_path)
+
+        self.num_files += 1
+        self.bytes_in  += job.in_size
+        self.bytes_out += out_size
+        self.busy_time += elapsed
+        return True
+
+    def poll(self):
+        '''
+            Reap finished jobs and start queued ones. Returns the paths which
+            were compressed successfully.
+        '''
+        completed = []
+        for job in list(self.running):
+            if job.proc.poll() is not None:
+                self.running.remove(job)
+                if self._finish(job):
+                    completed += [job.file_path]
+
+        while self.queue and len(self.running) < self.max_workers:
+            slot = None
+            if self.slots is not None:
+                slot = self.slots.try_acquire()
+                if slot is None:
+                    break
+            self._start(self.queue.popleft(), slot)
+
+        return completed
+
+    def wait(self):
+        ''' Block until every submitted job is done. '''
+        completed = self.poll()
+        while self.running or self.queue:
+            sleep(0.1)
+            completed += self.poll()
+        return completed
+
+    def is_pending(self, file_path):
+        file_path = Path(file_path)
+        return any(job.file_path == file_path
+                   for job in list(self.queue) + self.running)
+
+    def __len__(self):
+        return len(self.queue) + len(self.running)
+
+    def report(self):
+        if self.num_files == 0:
+            return 'No files compressed.'
+        mib = 1024.0 * 1024.0
+        throughput = self.bytes_in / mib / self.busy_time if self.busy_time else 0.0
+        return ('Compressed {} files with {}: {:.1f} MiB -> {:.1f} MiB '
+                '({:.2f}x), {:.1f} MiB/s per job').format(
+                    self.num_files, self.codec, self.bytes_in / mib,
+                    self.bytes_out / mib,
+                    self.bytes_in / max(self.bytes_out, 1), throughput)
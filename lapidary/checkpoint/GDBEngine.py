@@ -6,8 +6,8 @@ from multiprocessing import Process
 from pathlib import Path
 from pprint import pprint
 from subprocess import Popen, TimeoutExpired
-from tempfile import NamedTemporaryFile
-from time import sleep
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import sleep, time
 
 # WORK_DIR = os.path.dirname(__file__)
 # if len( WORK_DIR ) == 0:
@@ -22,9 +22,15 @@ except ModuleNotFoundError:
 
 import lapidary.pypatch
 from lapidary.checkpoint.Checkpoints import GDBCheckpoint
+from lapidary.checkpoint.Catalog import Catalog
 from lapidary.checkpoint.CheckpointTemplate import *
 from lapidary.checkpoint import CheckpointConvert
+from lapidary.checkpoint.Compression import CompressionPool
+from lapidary.checkpoint.PerfCounters import InstructionAlarm, PerfSignature
+from lapidary.checkpoint.ProcessMemory import capture_checkpoint, \
+    capture_checkpoint_and_kill, dump_core_and_kill
 from lapidary.config import LapidaryConfig
+from lapidary.utils.Utils import WorkerSlots, run_in_slot
 
 GLIBC_PATH = Path('../libc/glibc/build/install/lib').resolve()
 LD_LIBRARY_PATH_STR = '{}:/usr/lib/x86_64-linux-gnu:/lib/x86_64-linux-gnu'.format(GLIBC_PATH)
@@ -43,20 +49,61 @@ class GDBEngine:
     def __init__(self,
                  checkpoint_root_dir,
                  compress_core_files,
-                 convert_checkpoints):
+                 convert_checkpoints,
+                 dedup_checkpoints=False,
+                 codec='gzip',
+                 compress_workers=2,
+                 profile_phases=False,
+                 fork_capture=False,
+                 direct_capture=False):
         '''
             checkpoint_root_dir: Where to create the checkpoint directory.
-            compress_core_files: Whether or not to gzip the memory images.
+            compress_core_files: Whether or not to compress the memory images.
             convert_checkpoints:
+            dedup_checkpoints: Convert into the shared page store rather than
+                               into full pmem files.
+            codec: What to compress the core files with (see Compression).
+            compress_workers: How many core files can be compressed at once.
+                              The capture loop blocks once this many more are
+                              waiting.
+            profile_phases: Count hardware events between checkpoints, so
+                            that they can be clustered by phase (see
+                            SimPoints).
+            fork_capture: Rather than keeping the inferior stopped while its
+                          memory is dumped with gcore, fork a snapshot of it
+                          and dump that in the background. At most
+                          compress_workers snapshots are kept around.
+            direct_capture: Write the pmem (or manifest, or diff) straight
+                            from the inferior's memory, rather than dumping
+                            a core to convert later. compress_core_files and
+                            convert_checkpoints don't apply then.
         '''
         from lapidary.checkpoint.GDBShell import GDBShell
         import gdb
         self.shell = GDBShell(self)
         self.chk_num = 0
+        self.first_chk = 0
+        # (unit, amount) between checkpoints, to record their positions.
+        self.period = None
         self.compress_core_files = compress_core_files
-        self.compress_processes  = {}
+        # Shared with the other sessions of a "lapidary create --jobs".
+        self.slots               = WorkerSlots.from_env()
+        self.compression         = CompressionPool(codec, compress_workers,
+                                                   slots=self.slots)
         self.convert_checkpoints = convert_checkpoints
         self.convert_processes   = {}
+        self.pending_converts    = []
+        self.dedup_checkpoints   = dedup_checkpoints
+        self.keyframes           = 0
+        self.profile_phases      = profile_phases
+        self.signature           = None
+        self.fork_capture        = fork_capture
+        self.direct_capture      = direct_capture
+        self.max_snapshots       = max(1, int(compress_workers))
+        self.dump_processes      = {}
+        self.helper_dir          = None
+        # source -> address of its function in the inferior, or None
+        self.loaded_helpers      = {}
         self.logger              = logging.getLogger(name=__name__)
 
         # Otherwise long arg strings get mutilated with '...'
@@ -72,6 +119,7 @@ class GDBEngine:
                 '{}_gdb_checkpoints'.format(Path(self.binary).name)
         else:
             self.chk_out_dir = Path( WORK_DIR ) / Path('{}_gdb_checkpoints'.format(Path(self.binary).name))
+        self.catalog = Catalog(self.chk_out_dir)
         gdb.execute('set print elements 200')
 
 
@@ -108,40 +156,26 @@ class GDBEngine:
         return paddrs, vaddrs, sizes, offsets, flags, names
 
     @classmethod
-    def _create_mappings(cls, filter_bad_regions=False, expand=False):
+    def _create_mappings(cls):
         paddrs, vaddrs, sizes, offsets, flags, names = cls._get_memory_regions()
         assert len(paddrs) == len(vaddrs)
         assert len(paddrs) == len(sizes)
         assert len(paddrs) == len(flags)
         assert len(paddrs) == len(names)
-        mappings = {}
+        mappings = []
         index = 0
-        pgsize = resource.getpagesize()
         for p, v, s, o, f, name in zip(paddrs, vaddrs, sizes, offsets, flags, names):
-            # if filter_bad_regions and name in GDBEngine.BAD_MEM_REGIONS:
-            #     print('Skipping region "{}" (v{}->v{}, p{}->p{})'.format(name,
-            #       hex(v), hex(v + s), hex(p), hex(p + s)))
-            #     continue
-            if expand:
-                # print( "Expanding v = 0x%x" % (v) )
-                for off in range(0, s, pgsize):
-                    paddr = p + off if p != 0 else 0
-                    vaddr = v + off
-                    offset = o + off
-                    mappings[vaddr] = MemoryMapping(
-                        index, paddr, vaddr, pgsize, offset, f, name)
-            else:
-                mappings[v] = MemoryMapping(index, p, v, s, o, f, name)
-
+            mappings += [ MemoryMapping(index, p, v, s, o, f, name) ]
             index += 1
 
-        return mappings
+        return MappingTable(mappings)
 
     @staticmethod
-    def _create_convert_process(checkpoint_dir):
+    def _create_convert_process(checkpoint_dir, dedup=False, slots=None):
         gdb_checkpoint = GDBCheckpoint(checkpoint_dir)
-        proc = Process(target=CheckpointConvert.convert_checkpoint,
-                       args=(gdb_checkpoint, True))
+        proc = Process(target=run_in_slot,
+                       args=(slots, CheckpointConvert.convert_checkpoint,
+                             gdb_checkpoint, True, dedup))
         proc.start()
         return proc
 
@@ -150,19 +184,139 @@ class GDBEngine:
         gdb.execute('set use-coredump-filter off')
         gdb.execute('set dump-excluded-mappings on')
         gdb.execute('gcore {}'.format(str(file_path)))
+        self._core_file_complete(file_path)
+
+    def _core_file_complete(self, file_path):
+        self._record_checksums(file_path.parent)
         if self.compress_core_files:
-            print('Creating gzip process for {}'.format(str(file_path)))
-            gzip_proc = Popen(['gzip', '-f', str(file_path)])
-            self.compress_processes[file_path.parent] = gzip_proc
+            print('Queueing {} compression for {}'.format(
+                self.compression.codec, str(file_path)))
+            for core_file in self.compression.submit(file_path):
+                self._compression_complete(core_file)
         elif self.convert_checkpoints:
-            print('Creating convert process for {}'.format(str(file_path.parent)))
-            convert_proc = GDBEngine._create_convert_process(file_path.parent)
-            self.convert_processes[file_path.parent] = convert_proc
+            self._start_convert_process(file_path.parent)
+
+    def _fork_inferior(self):
+        '''
+            Forks a stopped copy of the inferior, which keeps its memory as
+            it is now while the inferior carries on. Returns the copy's pid,
+            or None if it could not be created.
+
+            Memory the inferior shares with other processes (MAP_SHARED) is
+            not copied, so it may change before it is dumped.
+        '''
+        import gdb
+        gdb.execute('set follow-fork-mode parent')
+        gdb.execute('set detach-on-fork on')
+        try:
+            pid = self._run_helper('fork_snapshot.c') or None
+        finally:
+            gdb.execute('set follow-fork-mode child')
+        if pid is None:
+            self.logger.warning('Could not fork a snapshot')
+
+        if pid is not None and not self._wait_until_stopped(pid):
+            self.logger.warning('Snapshot {} never stopped'.format(pid))
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            pid = None
+        return pid
+
+    @staticmethod
+    def _wait_until_stopped(pid, timeout=5.0):
+        deadline = time() + timeout
+        while time() < deadline:
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    # The command name may contain spaces, but not ')'.
+                    state = f.read().rsplit(')', 1)[1].split()[0]
+            except (OSError, IndexError):
+                return False
+            if state in ('T', 't'):
+                return True
+            sleep(0.001)
+        return False
+
+    def _capture_memory(self, checkpoint_dir):
+        '''
+            Write the checkpoint's memory image straight out of the stopped
+            inferior, which we can read as its tracer.
+        '''
+        import gdb
+        self._wait_for_keyframe_dump(checkpoint_dir)
+        capture_checkpoint(gdb.selected_inferior().pid,
+                           GDBCheckpoint(checkpoint_dir),
+                           self.dedup_checkpoints)
+
+    def _wait_for_keyframe_dump(self, checkpoint_dir):
+        keyframe = GDBCheckpoint(checkpoint_dir).get_keyframe()
+        if keyframe is not None and \
+           keyframe.checkpoint_directory in self.dump_processes:
+            self.dump_processes[keyframe.checkpoint_directory].join()
+            self._poll_background_processes()
+
+    def _fork_memory_to_file(self, mappings, checkpoint_dir):
+        '''
+            Dump a snapshot of the inferior in the background, falling back
+            to dumping the inferior itself if one can't be forked.
+        '''
+        while len(self.dump_processes) >= self.max_snapshots:
+            oldest = next(iter(self.dump_processes.values()))
+            oldest.join()
+            self._poll_background_processes()
+
+        if self.direct_capture:
+            # Diffs are written against the keyframe's pmem.
+            self._wait_for_keyframe_dump(checkpoint_dir)
+
+        pid = self._fork_inferior()
+        if pid is None and self.direct_capture:
+            self._capture_memory(checkpoint_dir)
+            return
+        elif pid is None:
+            self._dump_core_to_file(checkpoint_dir / 'gdb.core')
+            return
+
+        self.logger.info('Dumping snapshot {} to {} in the background'.format(
+            pid, str(checkpoint_dir)))
+        if self.direct_capture:
+            proc = Process(target=run_in_slot,
+                args=(self.slots, capture_checkpoint_and_kill, pid,
+                      GDBCheckpoint(checkpoint_dir), self.dedup_checkpoints))
+        else:
+            proc = Process(target=run_in_slot,
+                args=(self.slots, dump_core_and_kill, pid, mappings,
+                      checkpoint_dir / 'gdb.core'))
+        proc.start()
+        self.dump_processes[checkpoint_dir] = proc
+
+    def _start_convert_process(self, checkpoint_dir):
+        '''
+            Diffs are computed against their keyframe's pmem, so they have to
+            wait until the keyframe is done being compressed and converted.
+        '''
+        keyframe = GDBCheckpoint(checkpoint_dir).get_keyframe()
+        if keyframe is not None:
+            keyframe_dir = keyframe.checkpoint_directory
+            if self.compression.is_pending(keyframe_dir / 'gdb.core') or \
+               keyframe_dir in self.dump_processes or \
+               keyframe_dir in self.convert_processes or \
+               keyframe_dir in self.pending_converts:
+                self.pending_converts += [checkpoint_dir]
+                return
+
+        print('Creating convert process for {}'.format(str(checkpoint_dir)))
+        convert_proc = GDBEngine._create_convert_process(checkpoint_dir,
+                                                         self.dedup_checkpoints,
+                                                         self.slots)
+        self.convert_processes[checkpoint_dir] = convert_proc
 
     def _dump_mappings_to_file(self, mappings, mem_size, file_path):
         json_mappings = {'mem_size': mem_size}
         for vaddr, mapping in mappings.items():
-            json_mappings[vaddr] = mapping.__dict__
+            json_mappings[vaddr] = mapping.to_dict()
 
         with file_path.open('w') as f:
             json.dump(json_mappings, f, indent=4)
@@ -204,12 +358,10 @@ class GDBEngine:
         pmem_name = 'system.physmem.store0.pmem'
         chk_file = 'm5.cpt'
 
-        template_mappings = self._create_mappings(True, expand=True)
+        file_mappings = self._create_mappings()
         regs = RegisterValues(self.fs_base)
 
-        total_mem_size = self._calculate_memory_size(template_mappings)
-
-        file_mappings = self._create_mappings(True)
+        total_mem_size = self._calculate_memory_size(file_mappings)
 
         stack_mapping = [ m for v, m in file_mappings.items() if 'stack' in m.name ]
         assert len(stack_mapping) == 1
@@ -217,7 +369,7 @@ class GDBEngine:
 
         fill_checkpoint_template(
             output_file=str(chk_loc / chk_file),
-            mappings=template_mappings,
+            mappings=file_mappings,
             misc_reg_string=regs.get_misc_reg_string(),
             int_reg_string=regs.get_int_reg_string(),
             pc_string=regs.get_pc_string(),
@@ -228,9 +380,25 @@ class GDBEngine:
             brk=self._get_brk_value(),
             mmap_end = self.get_mmap_end())
 
-        self._dump_core_to_file(chk_loc / 'gdb.core')
+        # Every N-th checkpoint is a keyframe; the rest are converted into
+        # diffs against the last keyframe.
+        gdb_checkpoint = GDBCheckpoint(chk_loc)
+        if gdb_checkpoint.keyframe_file.exists():
+            gdb_checkpoint.keyframe_file.unlink()
+        if self.keyframes > 0 and self.chk_num % self.keyframes != 0:
+            keyframe_num = self.chk_num - (self.chk_num % self.keyframes)
+            gdb_checkpoint.set_keyframe(
+                self.chk_out_dir / '{}_check.cpt'.format(keyframe_num))
+
         self._dump_mappings_to_file(file_mappings, total_mem_size,
             chk_loc / 'mappings.json')
+        self._record_checkpoint(gdb_checkpoint, total_mem_size)
+        if self.fork_capture:
+            self._fork_memory_to_file(file_mappings, chk_loc)
+        elif self.direct_capture:
+            self._capture_memory(chk_loc)
+        else:
+            self._dump_core_to_file(chk_loc / 'gdb.core')
         self.chk_num += 1
 
         if debug_mode:
@@ -238,6 +406,31 @@ class GDBEngine:
             import IPython
             IPython.embed()
 
+    def _record_checkpoint(self, gdb_checkpoint, mem_size):
+        '''
+            Adds the checkpoint to the catalog, before its memory is in. Its
+            files are only hashed once they are all written, see
+            _record_checksums.
+        '''
+        chk_loc = gdb_checkpoint.checkpoint_directory
+        fields  = { 'number':   self.chk_num,
+                    'created':  time(),
+                    'format':   None,
+                    'mem_size': mem_size,
+                    'valid':    True }
+        keyframe = gdb_checkpoint.get_keyframe()
+        if keyframe is not None:
+            fields['keyframe'] = keyframe.checkpoint_directory.name
+        if self.period is not None:
+            unit, amount  = self.period
+            fields[unit]  = (self.chk_num + 1) * amount
+        self.catalog.update(chk_loc.name, **fields)
+
+    def _record_checksums(self, checkpoint_dir):
+        checksums = GDBCheckpoint(checkpoint_dir).write_checksums()
+        self.catalog.update(checkpoint_dir.name, checksums=checksums,
+                            **Catalog.describe(checkpoint_dir))
+
     def _interrupt_in(self, sec):
         '''
             Used to pause GDB with running in timed mode so that checkpoints 
@@ -261,15 +454,14 @@ class GDBEngine:
 
 
     def _can_create_valid_checkpoint(self):
+        import gdb
         mappings = self._create_mappings()
-        regs = RegisterValues(self.fs_base)
-
-        current_pc = int(regs.get_pc_string())
-        for vaddr, mapping in mappings.items():
-            if current_pc in mapping and mapping.name in GDBEngine.BAD_MEM_REGIONS:
-                self.logger.debug('Skipping checkpoint at {} since it is in {} region'.format(
-                      hex(current_pc), mapping.name))
-                return False
+        current_pc = int(gdb.selected_frame().pc())
+        mapping = mappings.find(current_pc)
+        if mapping is not None and mapping.name in GDBEngine.BAD_MEM_REGIONS:
+            self.logger.debug('Skipping checkpoint at {} since it is in {} region'.format(
+                  hex(current_pc), mapping.name))
+            return False
 
         return True
 
@@ -295,62 +487,145 @@ class GDBEngine:
         return lang
 
 
-    def _get_brk_value(self):
+    def _write_helper(self, source):
         '''
-            Here we have to compile the get_brk program, which is injected into
-            the running binary so that it can make a syscall to retrieve the 
-            brk value.
-
-            Credit to Ofir Weisse for this particular bit.
+            Wraps one of our C helpers so that it writes its 64-bit result to
+            OUTPUT_FILE, which is in a directory of our own so that parallel
+            runs don't collide. Returns (wrapper_file, output_file).
         '''
-        import struct, gdb
+        if self.helper_dir is None:
+            self.helper_dir = TemporaryDirectory(prefix='lapidary_gdb_')
+        output_file  = Path(self.helper_dir.name) / '{}.out'.format(Path(source).stem)
+        wrapper_file = Path(self.helper_dir.name) / source
+        with wrapper_file.open('w') as f:
+            f.write('#define OUTPUT_FILE "{}"\n'.format(output_file))
+            f.write('#include "{}/{}"\n'.format(Path(WORK_DIR).resolve(), source))
+        return wrapper_file, output_file
+
+    def _load_helper(self, source):
+        '''
+            Builds a helper into a shared object and loads it into the
+            inferior, so that running it for each checkpoint doesn't cost a
+            compile. If it can't be loaded (e.g. into a static binary), it is
+            compiled in with "compile file" every time instead.
+
+            dlopen allocates memory, so this may only be called where the
+            program can't be in the middle of malloc, i.e. at main (see
+            _run_base). From then on, the helper is mapped into the program
+            like any of its shared objects, and so in its checkpoints.
+        '''
+        import gdb
+        if source in self.loaded_helpers:
+            return
+        self.loaded_helpers[source] = None
+        wrapper_file, _ = self._write_helper(source)
 
         orig_lang = self._get_current_language()
-            
         gdb.execute('set language c')
+        try:
+            self.loaded_helpers[source] = self._dlopen_helper(source, wrapper_file)
+        finally:
+            gdb.execute('set language {}'.format(orig_lang))
 
-        brk_file = Path('/tmp/sbrk.txt' )
-        if os.path.exists( brk_file ):
-            os.remove( brk_file )
+    def _dlopen_helper(self, source, wrapper_file):
+        ''' Returns the address of the helper's function, or None. '''
+        import gdb
+        function = 'lapidary_{}'.format(Path(source).stem)
+        lib_file = wrapper_file.with_suffix('.so')
+        try:
+            # Unoptimized, like "compile file", as get_fs_base.c relies on it.
+            subprocess.run(['gcc', '-shared', '-fPIC', '-O0',
+                            '-D_gdb_expr={}'.format(function),
+                            '-o', str(lib_file), str(wrapper_file)],
+                           check=True, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.PIPE)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.warning('Could not build helper {}: {}'.format(source, e))
+            return None
+
+        # dlopen is only in libc itself since glibc 2.34.
+        for dlopen, mode in [('dlopen', '2'), ('__libc_dlopen_mode', '0x80000002')]:
+            try:
+                handle = int(gdb.parse_and_eval(
+                    '(unsigned long) ((void *(*)(const char *, int)) {})("{}", {})'.format(
+                        dlopen, lib_file, mode)))
+                if handle == 0:
+                    continue
+                address = int(gdb.parse_and_eval('(unsigned long) &{}'.format(function)))
+            except gdb.error:
+                continue
+            self.logger.info('Loaded helper {} at {}'.format(source, hex(address)))
+            self.loaded_helpers[source] = address
+            return address
+
+        self.logger.warning('Could not load helper {}, compiling it in instead'.format(source))
+        return None
+
+    def _run_helper(self, source):
+        '''
+            Runs one of our C helpers in the inferior, through the copy
+            _load_helper loaded if there is one. Returns its result, or None
+            if the helper failed.
+        '''
+        import struct, gdb
+        wrapper_file, output_file = self._write_helper(source)
 
-        gdb.execute('compile file -raw %s/get_brk.c' % WORK_DIR )
-        brk = 0
-        self.logger.debug( "#"* 20 + "cwd = %s" % os.getcwd() )
+        orig_lang = self._get_current_language()
+        gdb.execute('set language c')
         try:
-            with brk_file.open('rb') as f:
-                data = f.read()[:8]
-                self.logger.debug(data)
-                self.logger.debug(struct.unpack('Q', data))
-                brk = struct.unpack('Q', data)[0]
-        except:
-            pass
+            address = self.loaded_helpers.get(source)
+            if address is not None:
+                gdb.parse_and_eval('((void (*)(void)) {})()'.format(address))
+            else:
+                gdb.execute('compile file -raw {}'.format(wrapper_file))
+            with output_file.open('rb') as f:
+                return struct.unpack('Q', f.read(8))[0]
+        except (gdb.error, OSError, struct.error) as e:
+            self.logger.warning('Helper {} failed: {}'.format(source, e))
+            return None
         finally:
-            brk_file.unlink()
-        
-        gdb.execute('set language {}'.format(orig_lang))
+            if output_file.exists():
+                output_file.unlink()
+            gdb.execute('set language {}'.format(orig_lang))
+
+    def _get_brk_value(self):
+        '''
+            The program break, as sbrk(0) returns it in the inferior. Without
+            sbrk, this falls back to /proc, where the end of the heap is the
+            break rounded up to a page (or start_brk if there is no heap yet).
+        '''
+        import gdb
+        brk = None
+        try:
+            brk = int(gdb.parse_and_eval('(unsigned long) sbrk(0)'))
+        except gdb.error as e:
+            self.logger.debug('Could not call sbrk: {}'.format(e))
+
+        if brk is None:
+            pid = gdb.selected_inferior().pid
+            with open('/proc/{}/maps'.format(pid)) as f:
+                for line in f:
+                    if line.strip().endswith('[heap]'):
+                        brk = int(line.split()[0].split('-')[1], 16)
+            if brk is None:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    # start_brk is field 47, counting from the command name.
+                    brk = int(f.read().rsplit(')', 1)[1].split()[47 - 3])
+
         self.logger.info('Found brk: {} ({})'.format(brk, hex(brk)))
         return brk
 
 
     def _get_fs_base(self):
-        import struct, gdb
-        orig_lang = self._get_current_language()
-        gdb.execute('set language c')
-        gdb.execute('compile file -raw %s/get_fs_base.c' % WORK_DIR )
-        fs_base = 0
-        fs_base_file = Path('/tmp/fs_base.txt')
+        '''
+            GDB knows fs_base on Linux. Otherwise, we have a helper ask for
+            it with arch_prctl.
+        '''
+        import gdb
         try:
-            with fs_base_file.open('rb') as f:
-                data = f.read()[:8]
-                self.logger.debug(data)
-                self.logger.debug(struct.unpack('Q', data))
-                fs_base = struct.unpack('Q', data)[0]
-        except:
-            pass
-        finally:
-            fs_base_file.unlink()
-        
-        gdb.execute('set language {}'.format(orig_lang))
+            fs_base = int(gdb.selected_frame().read_register('fs_base'))
+        except (gdb.error, ValueError):
+            fs_base = self._run_helper('get_fs_base.c') or 0
         self.logger.debug('Found FS BASE: {} ({})'.format(fs_base, hex(fs_base)))
         return fs_base
 
@@ -369,7 +644,15 @@ class GDBEngine:
         self.logger.info('Running with args: "{}"'.format(self.args))
 
         gdb.execute('run {}'.format(self.args))
+        if self.fork_capture:
+            # Loaded now, while it's safe to, for every checkpoint to use.
+            self._load_helper('fork_snapshot.c')
         self.fs_base = self._get_fs_base()
+        if self.profile_phases:
+            try:
+                self.signature = PerfSignature(gdb.selected_inferior().pid)
+            except OSError as e:
+                self.logger.warning('Cannot profile phases: {}'.format(e))
         if debug_mode:
             self.logger.info("Entering IPython shell for debug mode.")
             import IPython
@@ -389,19 +672,32 @@ class GDBEngine:
         if wait:
             self.logger.info('Waiting for background processes to complete before exit.')
             timeout = None
-        gzip_complete = []
-        for file_path, gzip_proc in self.compress_processes.items():
-            gzip_proc.join(timeout)
-            if not gzip_proc.is_alive():
-                gzip_complete += [file_path]
-                if self.convert_checkpoints:
-                    self.logger.info('Creating convert process for {} after gzip'.format(
-                        str(file_path)))
-                    convert_proc = GDBEngine._create_convert_process(file_path)
-                    self.convert_processes[file_path.parent] = convert_proc
-        for key in gzip_complete:
-            self.logger.info('Background gzip for {} completed'.format(key))
-            self.compress_processes.pop(key)
+
+        dump_complete = []
+        for checkpoint_dir, dump_proc in self.dump_processes.items():
+            dump_proc.join(timeout)
+            if not dump_proc.is_alive():
+                dump_complete += [checkpoint_dir]
+        for checkpoint_dir in dump_complete:
+            dump_proc = self.dump_processes.pop(checkpoint_dir)
+            if dump_proc.exitcode != 0:
+                self.logger.error('Background dump for {} failed'.format(checkpoint_dir))
+                continue
+            self.logger.info('Background dump for {} completed'.format(checkpoint_dir))
+            if not self.direct_capture:
+                self._core_file_complete(checkpoint_dir / 'gdb.core')
+
+        if wait:
+            compress_complete = self.compression.wait()
+            self.logger.info(self.compression.report())
+        else:
+            compress_complete = self.compression.poll()
+        for core_file in compress_complete:
+            self._compression_complete(core_file)
+        compress_failed = self.compression.failed
+        self.compression.failed = []
+        for core_file in compress_failed:
+            self._compression_failed(core_file)
 
         convert_complete = []
         for file_path, convert_proc in self.convert_processes.items():
@@ -412,6 +708,49 @@ class GDBEngine:
             self.logger.info('Background convert for {} completed'.format(key))
             self.convert_processes.pop(key)
 
+        pending_converts = self.pending_converts
+        self.pending_converts = []
+        for checkpoint_dir in pending_converts:
+            self._start_convert_process(checkpoint_dir)
+
+        if wait and (len(self.compression) or self.convert_processes or
+                     self.dump_processes):
+            self._poll_background_processes(True)
+
+    def _compression_complete(self, core_file):
+        self.logger.info('Background compression for {} completed'.format(core_file))
+        self._record_checksums(core_file.parent)
+        if self.convert_checkpoints:
+            self.logger.info('Creating convert process for {} after compression'.format(
+                str(core_file.parent)))
+            self._start_convert_process(core_file.parent)
+
+    def _compression_failed(self, core_file):
+        ''' The raw core is still there, so the checkpoint is still usable. '''
+        self.logger.error('Background compression for {} failed, keeping the '
+                          'uncompressed core'.format(core_file))
+        if self.convert_checkpoints:
+            self._start_convert_process(core_file.parent)
+
+    def _record_signature(self):
+        '''
+            The events counted since the last checkpoint describe what the
+            program did right after it, i.e. what simulating it will cover.
+        '''
+        if self.signature is None:
+            return
+        counts = self.signature.sample()
+        if self.chk_num > self.first_chk:
+            prev_chk = self.chk_out_dir / '{}_check.cpt'.format(self.chk_num - 1)
+            GDBCheckpoint(prev_chk).set_signature(counts)
+            self.catalog.update(prev_chk.name, signature=counts)
+
+    def _finish_profiling(self):
+        if self.signature is not None:
+            self._record_signature()
+            self.signature.close()
+            self.signature = None
+
     def _try_create_checkpoint(self, debug_mode):
         '''
             Attempt to create a checkpoint.
@@ -420,6 +759,7 @@ class GDBEngine:
         self._poll_background_processes()
 
         if self._can_create_valid_checkpoint():
+            self._record_signature()
             self.logger.info('Creating checkpoint #{}'.format(self.chk_num))
             self._create_gem5_checkpoint(debug_mode)
 
@@ -432,8 +772,13 @@ class GDBEngine:
         import gdb
         self.logger.info('Running with {} seconds between checkpoints.'.format(
           sec_between_chk))
+        self.keyframes = int(keyframes)
         self._run_base(debug_mode)
+        self._run_timed(sec_between_chk, max_iter, debug_mode)
 
+    def _run_timed(self, sec_between_chk, max_iter, debug_mode):
+        import gdb
+        self.period = ('seconds', sec_between_chk)
         while max_iter < 0 or self.chk_num < max_iter:
             try:
                 proc = self._interrupt_in(sec_between_chk)
@@ -445,19 +790,128 @@ class GDBEngine:
                 self.logger.error(e)
                 break
         
+        self._finish_profiling()
+        self._poll_background_processes(True)
+
+
+    def run_counted(self, insts_between_chk, sec_between_chk, max_iter,
+                    keyframes, debug_mode):
+        '''
+            Main method for generating checkpoints every N instructions at
+            close to native speed. A hardware counter on the inferior
+            interrupts it every N retired instructions, so checkpoints are
+            spaced the same however loaded the host is.
+
+            Where hardware counters aren't available (e.g. in containers or
+            VMs), falls back to a checkpoint every sec_between_chk seconds.
+        '''
+
+        import gdb
+        self.keyframes = int(keyframes)
+        self._run_base(debug_mode)
+
+        try:
+            alarm = InstructionAlarm(gdb.selected_inferior().pid,
+                                     insts_between_chk, self.SIGNAL)
+        except OSError as e:
+            self.logger.warning(('Cannot count instructions ({}), running with '
+                '{} seconds between checkpoints instead.').format(
+                    e, sec_between_chk))
+            self._run_timed(sec_between_chk, max_iter, debug_mode)
+            return
+
+        self.logger.info('Running with {} counted instructions between checkpoints.'.format(
+          insts_between_chk))
+        self.period = ('insts', insts_between_chk)
+        self._run_alarmed(alarm, max_iter, debug_mode)
+        alarm.close()
+        self._finish_profiling()
+        self._poll_background_processes(True)
+
+    def run_segment(self, insts_between_chk, first_chk, end_chk, keyframes,
+                    debug_mode):
+        '''
+            Creates checkpoints first_chk up to end_chk of what run_counted
+            would, by running natively to the first one, so that several
+            sessions can checkpoint parts of the same run at once. This needs
+            the program to do the same thing every time it is run.
+
+            first_chk should be a keyframe, as the keyframe of a diff must be
+            in the same segment.
+        '''
+
+        import gdb
+        self.keyframes = int(keyframes)
+        self._run_base(debug_mode)
+        self.chk_num   = first_chk
+        self.first_chk = first_chk
+        self.period    = ('insts', insts_between_chk)
+        pid = gdb.selected_inferior().pid
+
+        if first_chk > 0:
+            # As in run_counted, checkpoint N is N + 1 periods in.
+            insts = (first_chk + 1) * insts_between_chk
+            self.logger.info('Fast-forwarding {} instructions to checkpoint {}.'.format(
+                insts, first_chk))
+            fast_forward = InstructionAlarm(pid, insts, self.SIGNAL)
+            try:
+                fast_forward.arm()
+                gdb.execute('continue')
+                fast_forward.disarm()
+            finally:
+                fast_forward.close()
+            if not gdb.selected_inferior().pid:
+                raise Exception(('The program exited before checkpoint {}, '
+                    'so it does not run the same every time.').format(first_chk))
+            if self.signature is not None:
+                # Only what comes after the checkpoint describes it.
+                self.signature.sample()
+            self._try_create_checkpoint(debug_mode)
+
+        alarm = InstructionAlarm(pid, insts_between_chk, self.SIGNAL)
+        self._run_alarmed(alarm, end_chk, debug_mode)
+        if self.signature is not None and gdb.selected_inferior().pid:
+            # So the last signature covers a whole period, like the others.
+            alarm.arm()
+            gdb.execute('continue')
+            alarm.disarm()
+        alarm.close()
+        self._finish_profiling()
+        if gdb.selected_inferior().pid:
+            # The rest belongs to the next segment.
+            gdb.execute('kill')
         self._poll_background_processes(True)
 
+    def _run_alarmed(self, alarm, max_iter, debug_mode):
+        import gdb
+        while max_iter < 0 or self.chk_num < max_iter:
+            try:
+                alarm.arm()
+                gdb.execute('continue')
+                # Don't count what GDB runs in the inferior to checkpoint it.
+                alarm.disarm()
+                if not gdb.selected_inferior().pid:
+                    self.logger.info('Inferior process has exited.')
+                    break
+                self._try_create_checkpoint(debug_mode)
+                self.logger.info('Checkpoint {} has been created, continuing.'.format(self.chk_num))
+            except (gdb.error, KeyboardInterrupt) as e:
+                self.logger.error(e)
+                break
+
 
     def run_inst(self, insts_between_chk, max_iter, keyframes, debug_mode):
         '''
             Main method for generating checkpoints every N instructions.
             Not recommended, as stepping by number of instructions is precise,
-            yet very slow.
+            yet very slow. See run_counted.
         '''
 
         import gdb
         print('Running with {} instructions between checkpoints.'.format(
           insts_between_chk))
+        self.keyframes = int(keyframes)
+        self.period = ('insts', insts_between_chk)
         self._run_base(debug_mode)
 
         while max_iter < 0 or self.chk_num < max_iter:
@@ -467,6 +921,7 @@ class GDBEngine:
             except (gdb.error, KeyboardInterrupt) as e:
                 break
         
+        self._finish_profiling()
         self._poll_background_processes(True)
 
 
@@ -492,4 +947,5 @@ class GDBEngine:
             except (gdb.error, KeyboardInterrupt) as e:
                 break
         
+        self._finish_profiling()
         self._poll_background_processes(True)
@@ -0,0 +1,186 @@
+from pathlib import Path
+from fcntl import lockf, LOCK_UN, LOCK_EX
+import hashlib
+import os
+import resource
+import struct
+
+class PageStore:
+    '''
+        A content-addressed store of memory pages, shared by all of the
+        checkpoints of a single benchmark. Pages are appended once to a data
+        file and located through an index of (digest, offset) records; each
+        checkpoint then only keeps a manifest of which page lives at which
+        physical address (see PageManifest).
+    '''
+
+    DIRECTORY  = 'page_store'
+    DATA_FILE  = 'pages.dat'
+    INDEX_FILE = 'pages.idx'
+    LOCK_FILE  = 'pages.lock'
+
+    # sha1 digest -> offset within the data file
+    RECORD = struct.Struct('<20sQ')
+
+    def __init__(self, directory):
+        assert isinstance(directory, Path)
+        self.directory = directory
+        if not self.directory.exists():
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.data_file    = self.directory / self.DATA_FILE
+        self.index_file   = self.directory / self.INDEX_FILE
+        self.lock_file    = self.directory / self.LOCK_FILE
+        self.pgsize       = resource.getpagesize()
+        self.index        = {}
+        self.index_offset = 0
+
+    @staticmethod
+    def digest(page):
+        return hashlib.sha1(page).digest()
+
+    def _refresh_index(self):
+        ''' Pick up any records appended (possibly by other processes) since
+            we last looked at the index. '''
+        if not self.index_file.exists():
+            return
+        with self.index_file.open('rb') as f:
+            f.seek(self.index_offset)
+            raw = f.read()
+        usable = len(raw) - (len(raw) % self.RECORD.size)
+        for digest, offset in self.RECORD.iter_unpack(raw[:usable]):
+            self.index[digest] = offset
+        self.index_offset += usable
+
+    def add_pages(self, pages):
+        '''
+            pages: list of (digest, data) pairs. Any page whose digest is not
+            yet in the store is appended. Multiple converters may add to the
+            same store at once, so this is done under an exclusive lock.
+        '''
+        with self.lock_file.open('a') as lock:
+            try:
+                lockf(lock, LOCK_EX)
+                self._refresh_index()
+
+                new_records = b''
+                with self.data_file.open('ab') as data:
+                    offset = data.seek(0, os.SEEK_END)
+                    for digest, page in pages:
+                        if digest in self.index:
+                            continue
+                        data.write(page)
+                        self.index[digest] = offset
+                        new_records += self.RECORD.pack(digest, offset)
+                        offset += len(page)
+
+                if new_records:
+                    with self.index_file.open('ab') as idx:
+                        idx.write(new_records)
+                    self.index_offset += len(new_records)
+            finally:
+                lockf(lock, LOCK_UN)
+
+    def get_offset(self, digest):
+        if digest not in self.index:
+            self._refresh_index()
+        return self.index[digest]
+
+    def __str__(self):
+        return str(self.directory)
+
+
+class PageManifest:
+    '''
+        Describes a pmem image in terms of pages in a PageStore. Zero pages
+        are not recorded, as the materialised pmem is sparse.
+
+        Format: a header of (magic, mem_size), then (paddr, digest) records.
+    '''
+
+    MAGIC  = b'LAPIDPM1'
+    HEADER = struct.Struct('<8sQ')
+    RECORD = struct.Struct('<Q20s')
+
+    def __init__(self, manifest_file, store):
+        assert isinstance(manifest_file, Path)
+        assert isinstance(store, PageStore)
+        self.manifest_file = manifest_file
+        self.store         = store
+
+    def writer(self, mem_size):
+        return PageManifestWriter(self, mem_size)
+
+    def records(self):
+        with self.manifest_file.open('rb') as f:
+            magic, mem_size = self.HEADER.unpack(f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise Exception('{} is not a page manifest!'.format(
+                    self.manifest_file))
+            while True:
+                raw = f.read(self.RECORD.size * 4096)
+                if not raw:
+                    break
+                for record in self.RECORD.iter_unpack(raw):
+                    yield record
+
+    def mem_size(self):
+        with self.manifest_file.open('rb') as f:
+            return self.HEADER.unpack(f.read(self.HEADER.size))[1]
+
+    def materialize(self, pmem_file):
+        '''
+            Rebuild a normal (sparse) pmem file from the manifest, so that
+            gem5 can load it like any other checkpoint.
+        '''
+        pgsize = self.store.pgsize
+        with pmem_file.open('wb') as pmem, \
+             self.store.data_file.open('rb') as data:
+            pmem.truncate(self.mem_size())
+            pmem_fd = pmem.fileno()
+            data_fd = data.fileno()
+            for paddr, digest in self.records():
+                page = os.pread(data_fd, pgsize, self.store.get_offset(digest))
+                os.pwrite(pmem_fd, page, paddr)
+        return pmem_file
+
+
+class PageManifestWriter:
+    '''
+        Accepts (paddr, buffer) writes the same way the pmem writer does, but
+        adds the pages to the page store and records them in the manifest
+        instead of writing them out.
+    '''
+
+    def __init__(self, manifest, mem_size):
+        self.manifest  = manifest
+        self.store     = manifest.store
+        self.zero_page = bytes(self.store.pgsize)
+        self.file      = manifest.manifest_file.open('wb')
+        self.file.write(PageManifest.HEADER.pack(PageManifest.MAGIC, mem_size))
+
+    def write(self, paddr, buf):
+        pgsize  = self.store.pgsize
+        pages   = []
+        records = b''
+        for off in range(0, len(buf), pgsize):
+            page = buf[off:off + pgsize]
+            if page == self.zero_page[:len(page)]:
+                continue
+            if len(page) < pgsize:
+                page += self.zero_page[len(page):]
+            digest = PageStore.digest(page)
+            pages += [(digest, page)]
+            records += PageManifest.RECORD.pack(paddr + off, digest)
+        if pages:
+            self.store.add_pages(pages)
+            self.file.write(records)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
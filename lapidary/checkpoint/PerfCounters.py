@@ -0,0 +1,224 @@
+import ctypes, ctypes.util, errno, fcntl, os, signal, struct
+
+class PerfEventAttr(ctypes.Structure):
+    ''' struct perf_event_attr (PERF_ATTR_SIZE_VER5), see perf_event_open(2). '''
+    _fields_ = [
+        ('type',               ctypes.c_uint32),
+        ('size',               ctypes.c_uint32),
+        ('config',             ctypes.c_uint64),
+        ('sample_period',      ctypes.c_uint64),
+        ('sample_type',        ctypes.c_uint64),
+        ('read_format',        ctypes.c_uint64),
+        ('flags',              ctypes.c_uint64),
+        ('wakeup_events',      ctypes.c_uint32),
+        ('bp_type',            ctypes.c_uint32),
+        ('config1',            ctypes.c_uint64),
+        ('config2',            ctypes.c_uint64),
+        ('branch_sample_type', ctypes.c_uint64),
+        ('sample_regs_user',   ctypes.c_uint64),
+        ('sample_stack_user',  ctypes.c_uint32),
+        ('clockid',            ctypes.c_int32),
+        ('sample_regs_intr',   ctypes.c_uint64),
+        ('aux_watermark',      ctypes.c_uint32),
+        ('sample_max_stack',   ctypes.c_uint16),
+        ('reserved_2',         ctypes.c_uint16),
+    ]
+
+class PerfCounter:
+    '''
+        A hardware event counter on a process (and the threads it creates
+        after the counter is opened), through perf_event_open(2). Only
+        user-space events are counted.
+    '''
+
+    NR_PERF_EVENT_OPEN = 298 # x86_64
+
+    PERF_TYPE_HARDWARE = 0
+
+    # perf_event_attr.flags bits
+    FLAG_DISABLED       = 1 << 0
+    FLAG_INHERIT        = 1 << 1
+    FLAG_EXCLUDE_KERNEL = 1 << 5
+    FLAG_EXCLUDE_HV     = 1 << 6
+    FLAG_ENABLE_ON_EXEC = 1 << 12
+
+    # ioctls
+    IOC_ENABLE  = 0x2400
+    IOC_DISABLE = 0x2401
+    IOC_REFRESH = 0x2402
+    IOC_RESET   = 0x2403
+
+    EVENTS = {
+        'cycles':           0,
+        'instructions':     1,
+        'cache_references': 2,
+        'cache_misses':     3,
+        'branches':         4,
+        'branch_misses':    5,
+    }
+
+    _libc = None
+
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            cls._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return cls._libc
+
+    def __init__(self, pid, event, sample_period=0, inherit=True,
+                 disabled=False, enable_on_exec=False):
+        self.fd    = None
+        attr = PerfEventAttr()
+        attr.type          = self.PERF_TYPE_HARDWARE
+        attr.size          = ctypes.sizeof(PerfEventAttr)
+        attr.config        = self.EVENTS[event]
+        attr.sample_period = sample_period
+        attr.flags         = self.FLAG_EXCLUDE_KERNEL | self.FLAG_EXCLUDE_HV
+        if inherit:
+            attr.flags    |= self.FLAG_INHERIT
+        if disabled:
+            attr.flags    |= self.FLAG_DISABLED
+        if enable_on_exec:
+            attr.flags    |= self.FLAG_ENABLE_ON_EXEC
+        if sample_period:
+            attr.wakeup_events = 1
+
+        libc = self._get_libc()
+        libc.syscall.restype = ctypes.c_long
+        fd = libc.syscall(self.NR_PERF_EVENT_OPEN, ctypes.byref(attr),
+                          ctypes.c_int(pid), ctypes.c_int(-1),
+                          ctypes.c_int(-1), ctypes.c_ulong(0))
+        if fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'perf_event_open({}) failed: {}'.format(
+                event, os.strerror(err)))
+        self.fd    = fd
+        self.event = event
+
+    def ioctl(self, request, arg=0):
+        libc = self._get_libc()
+        if libc.ioctl(self.fd, request, arg) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def read(self):
+        return struct.unpack('Q', os.read(self.fd, 8))[0]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+    @classmethod
+    def is_available(cls, pid=0):
+        ''' Whether hardware counters can be used at all (e.g. in a VM). '''
+        try:
+            cls(pid, 'instructions').close()
+            return True
+        except OSError:
+            return False
+
+
+class PerfSignature:
+    '''
+        Counts a few cheap hardware events on a process. The counts between
+        two samples make up a signature of what the program was doing then,
+        which is good enough to tell its phases apart.
+    '''
+
+    EVENTS = ['instructions', 'cycles', 'branches', 'branch_misses',
+              'cache_references', 'cache_misses']
+
+    def __init__(self, pid):
+        self.counters = []
+        try:
+            for event in self.EVENTS:
+                self.counters += [ PerfCounter(pid, event) ]
+        except OSError:
+            self.close()
+            raise
+        self.last = { c.event: 0 for c in self.counters }
+
+    def sample(self):
+        ''' Returns the event counts since the last sample. '''
+        counts = { c.event: c.read() for c in self.counters }
+        deltas = { e: counts[e] - self.last[e] for e in counts }
+        self.last = counts
+        return deltas
+
+    def close(self):
+        for counter in self.counters:
+            counter.close()
+
+
+class InstructionAlarm:
+    '''
+        Sends a process a signal after every period user-space instructions
+        it retires, through the overflow notification of an instructions
+        counter. The alarm is one-shot: it has to be re-armed after it goes
+        off. Only the thread given by pid is counted.
+
+        Delivery isn't exact, as the counter overflows a few instructions
+        before the signal arrives, but the error doesn't add up over alarms.
+    '''
+
+    def __init__(self, pid, period, signum=signal.SIGINT):
+        self.counter = PerfCounter(pid, 'instructions', sample_period=period,
+                                   inherit=False, disabled=True)
+        fd = self.counter.fd
+        fcntl.fcntl(fd, fcntl.F_SETOWN, pid)
+        fcntl.fcntl(fd, fcntl.F_SETSIG, signum)
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_ASYNC)
+        self.period  = period
+
+    def arm(self):
+        ''' Enables the counter until it next overflows. '''
+        self.counter.ioctl(PerfCounter.IOC_REFRESH, 1)
+
+    def disarm(self):
+        self.counter.ioctl(PerfCounter.IOC_DISABLE)
+
+    def read(self):
+        ''' Instructions counted so far. '''
+        return self.counter.read()
+
+    def close(self):
+        self.counter.close()
+
+
+def count_instructions(arg_list, cwd=None):
+    '''
+        Runs a command natively to completion through the shell (so that
+        redirections work) and returns how many user-space instructions it
+        and its children retired.
+    '''
+    pid = os.fork()
+    if pid == 0:
+        try:
+            if cwd is not None:
+                os.chdir(str(cwd))
+            # Wait for the counter to be attached.
+            os.kill(os.getpid(), signal.SIGSTOP)
+            os.execv('/bin/sh', ['/bin/sh', '-c', 'exec ' + ' '.join(arg_list)])
+        finally:
+            os._exit(127)
+
+    os.waitpid(pid, os.WUNTRACED)
+    try:
+        counter = PerfCounter(pid, 'instructions', disabled=True,
+                              enable_on_exec=True)
+    except OSError:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+    os.kill(pid, signal.SIGCONT)
+    _, status = os.waitpid(pid, 0)
+    insts = counter.read()
+    counter.close()
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise Exception('{} failed ({})'.format(' '.join(arg_list), status))
+    return insts
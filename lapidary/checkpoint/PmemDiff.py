@@ -0,0 +1,238 @@
+from bisect import bisect_right
+from pathlib import Path
+import gzip
+import os
+import resource
+import struct
+from tempfile import TemporaryFile
+
+class RegionIndex:
+    '''
+        Translates addresses through a checkpoint's mappings.json regions,
+        i.e. from one address space (vaddr or paddr) to the other.
+    '''
+
+    def __init__(self, mappings, key):
+        assert key in ('vaddr', 'paddr')
+        other = 'paddr' if key == 'vaddr' else 'vaddr'
+        regions = sorted((int(m[key]), int(m[other]), int(m['size']))
+                         for k, m in mappings.items()
+                         if k != 'mem_size' and k != 0)
+        self.starts  = [ r[0] for r in regions ]
+        self.regions = regions
+
+    def translate(self, addr):
+        idx = bisect_right(self.starts, addr) - 1
+        if idx < 0:
+            return None
+        start, other, size = self.regions[idx]
+        if addr >= start + size:
+            return None
+        return other + (addr - start)
+
+
+class PmemImage:
+    '''
+        Random read access to an existing pmem. A gzipped pmem is decompressed
+        once into a (sparse, unnamed) temporary file next to it, as seeking
+        around a gzip stream means decompressing it from the start again.
+    '''
+
+    GZIP_MAGIC = b'\x1f\x8b'
+    CHUNK      = 4 * 1024 * 1024
+
+    def __init__(self, pmem_file):
+        self.pmem_file = pmem_file
+        with pmem_file.open('rb') as f:
+            compressed = f.read(2) == self.GZIP_MAGIC
+        if compressed:
+            self.file = self._decompress(pmem_file)
+        else:
+            self.file = pmem_file.open('rb')
+
+    @classmethod
+    def _decompress(cls, pmem_file):
+        zero = bytes(cls.CHUNK)
+        tmp  = TemporaryFile(dir=str(pmem_file.parent))
+        try:
+            with gzip.open(str(pmem_file), 'rb') as src:
+                while True:
+                    buf = src.read(cls.CHUNK)
+                    if not buf:
+                        break
+                    if buf == zero[:len(buf)]:
+                        tmp.seek(len(buf), os.SEEK_CUR)
+                    else:
+                        tmp.write(buf)
+            tmp.truncate()
+            tmp.flush()
+        except:
+            tmp.close()
+            raise
+        return tmp
+
+    def read(self, offset, size):
+        return os.pread(self.file.fileno(), size, offset)
+
+    def copy_to(self, dst_fd, dst_offset, src_offset, size):
+        if hasattr(os, 'copy_file_range'):
+            done = 0
+            while done < size:
+                copied = os.copy_file_range(self.file.fileno(), dst_fd,
+                                            size - done, src_offset + done,
+                                            dst_offset + done)
+                if copied == 0:
+                    break
+                done += copied
+            return
+        chunk = 4 * 1024 * 1024
+        for off in range(0, size, chunk):
+            buf = self.read(src_offset + off, min(chunk, size - off))
+            os.pwrite(dst_fd, buf, dst_offset + off)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PmemDiff:
+    '''
+        A pmem described as page-level changes against a keyframe checkpoint's
+        pmem. Pages are matched up by virtual address, since physical
+        addresses shift whenever the set of mappings changes.
+
+        Format: a header of (magic, mem_size, keyframe name length), the
+        keyframe name, then a series of records:
+            'R' (paddr, keyframe paddr, length): copy a run from the keyframe.
+            'D' (paddr, length), data:           new data.
+        Zero pages are not recorded, as the materialised pmem is sparse.
+    '''
+
+    MAGIC  = b'LAPIDDF1'
+    HEADER = struct.Struct('<8sQH')
+    REF    = struct.Struct('<QQQ')
+    DATA   = struct.Struct('<QQ')
+
+    def __init__(self, diff_file):
+        assert isinstance(diff_file, Path)
+        self.diff_file = diff_file
+
+    def _read_header(self, f):
+        magic, mem_size, name_len = self.HEADER.unpack(f.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise Exception('{} is not a pmem diff!'.format(self.diff_file))
+        keyframe_name = f.read(name_len).decode()
+        return mem_size, keyframe_name
+
+    def get_keyframe_name(self):
+        with self.diff_file.open('rb') as f:
+            return self._read_header(f)[1]
+
+    def writer(self, mem_size, mappings, keyframe_name, keyframe_mappings,
+               keyframe_image):
+        return PmemDiffWriter(self, mem_size, mappings, keyframe_name,
+                              keyframe_mappings, keyframe_image)
+
+    def materialize(self, pmem_file, keyframe_image):
+        with self.diff_file.open('rb') as f, pmem_file.open('wb') as pmem:
+            mem_size, _ = self._read_header(f)
+            pmem.truncate(mem_size)
+            pmem_fd = pmem.fileno()
+            while True:
+                tag = f.read(1)
+                if not tag:
+                    break
+                if tag == b'R':
+                    paddr, src, size = self.REF.unpack(f.read(self.REF.size))
+                    keyframe_image.copy_to(pmem_fd, paddr, src, size)
+                elif tag == b'D':
+                    paddr, size = self.DATA.unpack(f.read(self.DATA.size))
+                    os.pwrite(pmem_fd, f.read(size), paddr)
+                else:
+                    raise Exception('Corrupt diff record in {}'.format(
+                        self.diff_file))
+        return pmem_file
+
+
+class PmemDiffWriter:
+    '''
+        Accepts (paddr, buffer) writes like the other pmem sinks, comparing
+        every page against the keyframe page at the same virtual address and
+        coalescing the results into runs.
+    '''
+
+    MAX_DATA_RUN = 4 * 1024 * 1024
+
+    def __init__(self, diff, mem_size, mappings, keyframe_name,
+                 keyframe_mappings, keyframe_image):
+        self.pgsize         = resource.getpagesize()
+        self.zero_page      = bytes(self.pgsize)
+        self.to_vaddr       = RegionIndex(mappings, 'paddr')
+        self.to_kf_paddr    = RegionIndex(keyframe_mappings, 'vaddr')
+        self.keyframe_image = keyframe_image
+        self.run            = None
+        self.file           = diff.diff_file.open('wb')
+
+        name = keyframe_name.encode()
+        self.file.write(PmemDiff.HEADER.pack(PmemDiff.MAGIC, mem_size,
+                                             len(name)) + name)
+
+    def _flush(self):
+        if self.run is None:
+            return
+        kind, paddr, src, size, pages = self.run
+        if kind == 'R':
+            self.file.write(b'R' + PmemDiff.REF.pack(paddr, src, size))
+        else:
+            self.file.write(b'D' + PmemDiff.DATA.pack(paddr, size))
+            self.file.write(b''.join(pages))
+        self.run = None
+
+    def _extend(self, kind, paddr, src, page):
+        ''' Add a page to the current run, or start a new one. '''
+        run = self.run
+        if run is not None and run[0] == kind and run[1] + run[3] == paddr \
+           and (kind == 'D' or run[2] + run[3] == src):
+            run[3] += len(page)
+            if kind == 'D':
+                run[4] += [page]
+                # Don't buffer unbounded amounts of new data.
+                if run[3] >= self.MAX_DATA_RUN:
+                    self._flush()
+            return
+        self._flush()
+        self.run = [kind, paddr, src, len(page), [page] if kind == 'D' else None]
+
+    def write(self, paddr, buf):
+        pgsize = self.pgsize
+        for off in range(0, len(buf), pgsize):
+            page = buf[off:off + pgsize]
+            if page == self.zero_page[:len(page)]:
+                self._flush()
+                continue
+
+            kf_paddr = None
+            vaddr = self.to_vaddr.translate(paddr + off)
+            if vaddr is not None:
+                kf_paddr = self.to_kf_paddr.translate(vaddr)
+
+            if kf_paddr is not None and \
+               self.keyframe_image.read(kf_paddr, len(page)) == page:
+                self._extend('R', paddr + off, kf_paddr, page)
+            else:
+                self._extend('D', paddr + off, None, page)
+
+    def close(self):
+        self._flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,155 @@
+import os, signal, struct
+
+from lapidary.checkpoint.CheckpointConvert import SparsePmemWriter, convert_checkpoint
+
+class ProcessMemory:
+    '''
+        Reads the memory of a stopped process through /proc/<pid>/mem. We
+        have to be allowed to ptrace the process, e.g. as its parent or
+        because it made itself traceable with PR_SET_PTRACER.
+    '''
+
+    # How much memory is held at once while copying.
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.fd  = os.open('/proc/{}/mem'.format(pid), os.O_RDONLY)
+
+    def read_range(self, vaddr, size):
+        '''
+            Yields (offset, buf) chunks of [vaddr, vaddr + size). Raises
+            OSError if the range can't be read at all, e.g. [vsyscall].
+        '''
+        done = 0
+        while done < size:
+            length = min(self.CHUNK_SIZE, size - done)
+            try:
+                buf = os.pread(self.fd, length, vaddr + done)
+            except OverflowError:
+                # Kernel addresses don't fit in an off_t.
+                raise OSError('{} is not readable'.format(hex(vaddr)))
+            except OSError:
+                buf = self._read_pages(vaddr + done, length)
+            if not buf:
+                raise OSError('{} is not readable'.format(hex(vaddr + done)))
+            yield done, buf
+            done += len(buf)
+
+    def _read_pages(self, vaddr, size):
+        '''
+            Pages that can't be read, e.g. past the end of a mapped file or
+            in the PROT_NONE gaps of shared objects, read as zeros.
+        '''
+        pgsize = os.sysconf('SC_PAGE_SIZE')
+        pages  = []
+        for off in range(0, size, pgsize):
+            length = min(pgsize, size - off)
+            try:
+                pages += [ os.pread(self.fd, length, vaddr + off) ]
+            except OSError:
+                pages += [ bytes(length) ]
+        return b''.join(pages)
+
+    def is_readable(self, vaddr):
+        try:
+            os.pread(self.fd, 1, vaddr)
+            return True
+        except (OSError, OverflowError):
+            return False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CoreFileWriter:
+    '''
+        Writes memory as a minimal ELF core file: one PT_LOAD segment per
+        mapping and nothing else, which is all CheckpointConvert reads from
+        gcore's output.
+    '''
+
+    EHDR_FORMAT = '<16sHHIQQQIHHHHHH'
+    PHDR_FORMAT = '<IIQQQQQQ'
+
+    ET_CORE   = 4
+    EM_X86_64 = 62
+    PT_LOAD   = 1
+    PF_RWX    = 7
+
+    @classmethod
+    def write(cls, memory, mappings, core_file):
+        '''
+            memory: ProcessMemory to copy from.
+            mappings: { vaddr: MemoryMapping }, as in mappings.json.
+        '''
+        pgsize   = os.sysconf('SC_PAGE_SIZE')
+        segments = [ (m.vaddr, m.size) for v, m in sorted(mappings.items())
+                     if m.vaddr != 0 and memory.is_readable(m.vaddr) ]
+        assert len(segments) < 0xffff
+
+        ehdr_size   = struct.calcsize(cls.EHDR_FORMAT)
+        phdr_size   = struct.calcsize(cls.PHDR_FORMAT)
+        data_offset = ehdr_size + phdr_size * len(segments)
+        data_offset = (data_offset + pgsize - 1) // pgsize * pgsize
+
+        ident = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+        header = struct.pack(cls.EHDR_FORMAT, ident, cls.ET_CORE,
+            cls.EM_X86_64, 1, 0, ehdr_size, 0, 0, ehdr_size, phdr_size,
+            len(segments), 64, 0, 0)
+
+        phdrs  = b''
+        offset = data_offset
+        for vaddr, size in segments:
+            phdrs  += struct.pack(cls.PHDR_FORMAT, cls.PT_LOAD, cls.PF_RWX,
+                offset, vaddr, 0, size, size, pgsize)
+            offset += size
+
+        with core_file.open('wb') as f:
+            sink = SparsePmemWriter(f, offset)
+            os.pwrite(f.fileno(), header + phdrs, 0)
+            offset = data_offset
+            for vaddr, size in segments:
+                for done, buf in memory.read_range(vaddr, size):
+                    sink.write(offset + done, buf)
+                offset += size
+
+def _kill_snapshot(pid):
+    try:
+        os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def dump_core_and_kill(pid, mappings, core_file):
+    '''
+        Writes the memory of a stopped snapshot process to core_file, then
+        gets rid of the snapshot.
+    '''
+    try:
+        with ProcessMemory(pid) as memory:
+            CoreFileWriter.write(memory, mappings, core_file)
+    finally:
+        _kill_snapshot(pid)
+
+def capture_checkpoint(pid, gdb_checkpoint, dedup=False):
+    '''
+        Writes the memory of a stopped process straight into the checkpoint's
+        pmem (or page manifest, or diff against its keyframe), following its
+        mappings.json. No core file is written.
+    '''
+    with ProcessMemory(pid) as memory:
+        return convert_checkpoint(gdb_checkpoint, True, dedup, memory=memory)
+
+def capture_checkpoint_and_kill(pid, gdb_checkpoint, dedup=False):
+    try:
+        capture_checkpoint(pid, gdb_checkpoint, dedup)
+    finally:
+        _kill_snapshot(pid)
@@ -0,0 +1,180 @@
+'''
+    SimPoint-style selection of representative checkpoints. Rather than
+    basic-block vectors, each checkpoint is described by the hardware events
+    counted natively between it and the next checkpoint (create with
+    --profile-phases). The checkpoints are clustered into phases with
+    k-means, picking k by BIC as SimPoint does, and the checkpoint closest to
+    the center of each phase stands in for the rest of it, weighted by the
+    fraction of instructions the phase covers.
+'''
+import json
+import numpy as np
+
+from math import log, pi, sqrt
+from pathlib import Path
+
+from lapidary.checkpoint.Catalog import Catalog
+
+SIMPOINTS_FILE = 'simpoints.json'
+
+# Events which are divided by the instruction count into rates.
+RATE_EVENTS = ['cycles', 'branches', 'branch_misses', 'cache_references',
+               'cache_misses']
+# One event per thousand instructions.
+RATE_FLOOR  = 1e-3
+
+def get_features(signatures):
+    '''
+        Per-instruction event rates, on a log scale so that phases differ by
+        how many times more often an event happens rather than by how common
+        the event is. Rates below RATE_FLOOR count as noise.
+    '''
+    rates = np.array([ [ s[e] / s['instructions'] for e in RATE_EVENTS ]
+                       for s in signatures ], dtype=float)
+    features = np.log(rates + RATE_FLOOR)
+    # Events which don't vary say nothing about phases.
+    return features[:, features.std(axis=0) > 0]
+
+def kmeans(points, k, rng, iterations=100):
+    ''' Lloyd's algorithm, seeded with k-means++. Returns (labels, centroids). '''
+    centroids = [ points[rng.randint(len(points))] ]
+    for _ in range(1, k):
+        dists = np.min([ ((points - c) ** 2).sum(axis=1) for c in centroids ],
+                       axis=0)
+        if dists.sum() == 0:
+            centroids += [ points[rng.randint(len(points))] ]
+        else:
+            centroids += [ points[rng.choice(len(points), p=dists / dists.sum())] ]
+    centroids = np.array(centroids)
+
+    labels = None
+    for _ in range(iterations):
+        dists      = ((points[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+        new_labels = dists.argmin(axis=1)
+        if labels is not None and (new_labels == labels).all():
+            break
+        labels = new_labels
+        for c in range(k):
+            if (labels == c).any():
+                centroids[c] = points[labels == c].mean(axis=0)
+
+    return labels, centroids
+
+def distortion(points, labels, centroids):
+    return float(((points - centroids[labels]) ** 2).sum())
+
+def bic(points, labels, centroids):
+    '''
+        The Bayesian Information Criterion of a clustering, as in SimPoint
+        (and X-means, Pelleg and Moore 2000).
+    '''
+    num, dims = points.shape
+    k = len(centroids)
+    if num <= k:
+        return float('-inf')
+    variance = max(distortion(points, labels, centroids) / ((num - k) * dims),
+                   1e-12)
+
+    likelihood = 0.0
+    for c in range(k):
+        size = int((labels == c).sum())
+        if size == 0:
+            continue
+        likelihood += size * log(size) - size * log(num) \
+                    - size / 2.0 * log(2.0 * pi) \
+                    - size * dims / 2.0 * log(variance) \
+                    - (size - k) / 2.0
+    params = (k - 1) + dims * k + 1
+    return likelihood - params / 2.0 * log(num)
+
+def choose_simpoints(signatures, max_k=10, seed=0, restarts=5,
+                     bic_threshold=0.9):
+    '''
+        signatures: { name: event counts }
+        Returns ({ name: weight }, k), where the weights sum to 1.
+    '''
+    names      = sorted(signatures.keys())
+    names      = [ n for n in names if signatures[n].get('instructions', 0) > 0 ]
+    if not names:
+        raise Exception('No checkpoints with a usable signature!')
+    sigs       = [ signatures[n] for n in names ]
+    points     = get_features(sigs)
+    insts      = np.array([ s['instructions'] for s in sigs ], dtype=float)
+    rng        = np.random.RandomState(seed)
+
+    # With only a few checkpoints per cluster, BIC keeps rewarding more
+    # clusters for fitting the noise.
+    max_k = max(min(max_k, int(sqrt(len(names)))), 1)
+    clusterings = []
+    for k in range(1, max_k + 1):
+        best = None
+        for _ in range(restarts):
+            labels, centroids = kmeans(points, k, rng)
+            if best is None or distortion(points, labels, centroids) < \
+                               distortion(points, *best):
+                best = (labels, centroids)
+        clusterings += [ (k, best, bic(points, *best)) ]
+
+    # The smallest k which scores within bic_threshold of the best.
+    scores = [ score for _, _, score in clusterings if score != float('-inf') ]
+    chosen = clusterings[0]
+    if scores:
+        cutoff = min(scores) + bic_threshold * (max(scores) - min(scores))
+        chosen = next(c for c in clusterings if c[2] >= cutoff)
+    k, (labels, centroids), _ = chosen
+
+    weights = {}
+    for c in range(k):
+        members = np.flatnonzero(labels == c)
+        if len(members) == 0:
+            continue
+        dists   = ((points[members] - centroids[c]) ** 2).sum(axis=1)
+        closest = members[dists.argmin()]
+        weights[names[closest]] = float(insts[members].sum() / insts.sum())
+
+    return weights, len(weights)
+
+def get_simpoints_file(checkpoint_dir):
+    return Path(checkpoint_dir) / SIMPOINTS_FILE
+
+def load_simpoints(checkpoint_dir):
+    ''' Returns { checkpoint name: weight }. '''
+    simpoints_file = get_simpoints_file(checkpoint_dir)
+    if not simpoints_file.exists():
+        raise Exception('No {} in {}, run "lapidary simpoints" first!'.format(
+            SIMPOINTS_FILE, checkpoint_dir))
+    with simpoints_file.open() as f:
+        return json.load(f)['simpoints']
+
+def add_args(parser):
+    parser.add_argument('--checkpoint-dir', '-d', required=True,
+        help='Checkpoints created with --profile-phases.')
+    parser.add_argument('--max-k', default=10, type=int,
+        help=('Most phases (and so checkpoints) to pick, though never more '
+              'than the square root of the number of checkpoints. Default is 10.'))
+    parser.add_argument('--seed', default=0, type=int,
+        help='Seed for k-means.')
+
+def main(args):
+    chkdir = Path(args.checkpoint_dir)
+    signatures = {}
+    missing    = 0
+    catalog = Catalog(chkdir)
+    records = catalog.records() if catalog.exists() else catalog.scan()
+    for name, record in records.items():
+        if 'signature' not in record:
+            missing += 1
+            continue
+        signatures[name] = record['signature']
+
+    if missing:
+        print('Skipping {} checkpoints without a signature.'.format(missing))
+
+    weights, k = choose_simpoints(signatures, args.max_k, args.seed)
+    with get_simpoints_file(chkdir).open('w') as f:
+        json.dump({ 'simpoints': weights, 'k': k,
+                    'checkpoints': len(signatures) }, f, indent=4)
+
+    print('Picked {} of {} checkpoints:'.format(k, len(signatures)))
+    for name, weight in sorted(weights.items(), key=lambda x: -x[1]):
+        print('\t{}: {:.3f}'.format(name, weight))
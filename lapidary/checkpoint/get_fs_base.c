@@ -10,6 +10,10 @@
 #include <sys/stat.h>
 #include <fcntl.h>
 
+#ifndef OUTPUT_FILE
+#define OUTPUT_FILE "/tmp/fs_base.txt"
+#endif
+
 void get_fs_base(uint64_t *ret) {
     register int       syscall_no  asm("rax") = 158;
     register int       arg1        asm("rdi") = 0x1003;
@@ -18,11 +22,10 @@ void get_fs_base(uint64_t *ret) {
 }
 
 void _gdb_expr() {
-    char buf[BUFSIZ] = {'\0'};
     uint64_t addr = 0;
     get_fs_base(&addr);
-    int fd = open("/tmp/fs_base.txt", O_CREAT | O_APPEND | O_WRONLY, 0666);
-    write(fd, &addr, BUFSIZ);
+    int fd = open(OUTPUT_FILE, O_CREAT | O_TRUNC | O_WRONLY, 0666);
+    write(fd, &addr, sizeof(addr));
     close(fd);
 }
 //gistsnip:end:fsreghack2
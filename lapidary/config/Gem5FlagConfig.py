@@ -68,6 +68,24 @@ class Gem5FlagConfig:
         config_classes = cls._get_config_classes()
         return [ name for name in config_classes ]
 
+    @classmethod
+    def get_config_group_names(cls, group_name):
+        group_name = group_name.lower()
+        config_groups = cls._get_config_groups()
+        if group_name not in config_groups:
+            raise Exception('{} not a valid group. Valid groups: {}'.format(
+              group_name, ', '.join(config_groups.keys())))
+        return [ c.__name__.lower() for c in config_groups[group_name] ]
+
+    @classmethod
+    def is_forkable(cls, config_name):
+        '''
+            A config can be forked off a warmed-up simulation if it only
+            differs from the default in its after_warmup hook.
+        '''
+        before_init_fn, _ = cls.get_config(config_name)
+        return before_init_fn is FlagConfigure.before_init
+
     @classmethod
     def get_config(cls, config_name):
         assert isinstance(config_name, str)
@@ -52,6 +52,8 @@ class Report:
 
         # benchmark -> configs -> dict{ checkpoint -> series }
         self.sim_series = defaultdict(lambda: defaultdict(dict))
+        # benchmark -> configs -> dict{ checkpoint -> simpoint weight }
+        self.weights    = defaultdict(dict)
         for summary in self.summary_data:
             if 'checkpoints' not in summary:
                 # Means the run was terminated early
@@ -68,6 +70,11 @@ class Report:
                 if status == 'successful':
                     result_dirs[num] = res_dir / '{}_{}'.format(chk_prefix, chk_name)
 
+            if 'weights' in summary:
+                self.weights[summary['bench']][summary['mode']] = {
+                    int(Path(c).name.split('_')[0]): w
+                    for c, w in summary['weights'].items() }
+
             for checkpoint_num, dirent in result_dirs.items():
                 if not dirent.exists():
                     present[benchmark][mode][checkpoint_num] = 0
@@ -126,6 +133,15 @@ class Report:
 
         return res_by_type
 
+    @staticmethod
+    def _weighted_mean_std(df, weights):
+        ''' Like df.mean() and df.std(ddof=0), for weighted checkpoints. '''
+        w     = pd.Series(weights)[df.index].astype(float)
+        total = df.notna().mul(w, axis=0).sum()
+        mean  = df.mul(w, axis=0).sum() / total
+        var   = ((df - mean) ** 2).mul(w, axis=0).sum() / total
+        return mean, np.sqrt(var)
+
     def _construct_data_frames(self):
         '''
         I want the following:
@@ -158,16 +174,24 @@ class Report:
             for config_name, checkpoint_results in config_series.items():
                 if not self.do_intersection:
                     only_use = [k for k in checkpoint_results.keys()]
+                weights = self.weights[benchmark].get(config_name, None)
+                if weights is not None:
+                    # Simpoints stand in for the checkpoints of their phase.
+                    only_use = [k for k in only_use if k in weights]
                 df = pd.DataFrame(checkpoint_results)[only_use].T
                 if 'inorder' in config_name:
                     df['MLP'] = pd.Series(list(itertools.repeat(1.0, df.shape[1])))
                     df['avgLatencyToIssue'] = pd.Series(list(itertools.repeat(0.0, df.shape[1])))
 
-                stat_means = df.mean().rename('mean')
-                stat_stdev = df.std(ddof=0).rename('std')
+                if weights is not None:
+                    stat_means, stat_stdev = self._weighted_mean_std(df, weights)
+                else:
+                    stat_means, stat_stdev = df.mean(), df.std(ddof=0)
+                stat_means = stat_means.rename('mean')
+                stat_stdev = stat_stdev.rename('std')
                 stat_nums  = df.count().rename('count')
                 assert stat_nums.min() >= 0
-                stat_ci    = ((1.96 * df.std(ddof=0)) / np.sqrt(stat_nums)).rename('ci')
+                stat_ci    = ((1.96 * stat_stdev) / np.sqrt(stat_nums)).rename('ci')
                 summary_df = pd.DataFrame([stat_means, stat_stdev, stat_ci, stat_nums])
                 if not self.verbatim:
                     if 'inorder' in config_name or 'invisispec' in config_name:
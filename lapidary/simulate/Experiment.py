@@ -41,7 +41,9 @@ class ExitCause:
     SIMULATION_DONE  = "exiting with last active thread context"
     WORK_BEGIN       = "workbegin"
     SIMULATE_LIMIT   = 'simulate() limit reached'
-    VALID_STOP       = [SIMULATION_DONE, SIMULATE_LIMIT]
+    WARMUP_DONE      = 'lapidary warmup instruction count reached'
+    ROI_DONE         = 'lapidary reportable instruction count reached'
+    VALID_STOP       = [SIMULATION_DONE, SIMULATE_LIMIT, WARMUP_DONE, ROI_DONE]
 
 def ToggleFlags(exit_cause, flags):
     import m5
@@ -54,6 +56,101 @@ def ToggleFlags(exit_cause, flags):
             m5.debug.flags[ flagName ].disable()
 
 
+def _print_progress(insts_done, insts):
+    if insts < 0:
+        print('inst: {}/unlimited'.format(insts_done))
+        return
+    percentCompleted = ( float(insts_done) / max(insts, 1) ) * 100
+    print('{:5.2f}% inst: {}/{}'.format(percentCompleted, insts_done, insts))
+
+def _run_phase_by_insts(system, stats_file, insts, offset, cause, granularity):
+    '''
+        Run until the first CPU has committed exactly insts more instructions,
+        using a scheduled instruction event so the phase ends in a single
+        simulate() call. A negative insts runs until the program exits.
+
+        Returns (instructions done since offset, exit cause).
+    '''
+    import m5
+    if insts == 0:
+        return 0, cause
+
+    if insts > 0:
+        system.cpu[0].scheduleInstStop(0, insts, cause)
+    exit_event = m5.simulate()
+    exit_cause = exit_event.getCause()
+
+    insts_done = int(stats_file.get_progress_stats(system)['sim_insts']) - offset
+    _print_progress(insts_done, insts)
+    return insts_done, exit_cause
+
+def _run_phase_by_ticks(system, stats_file, insts, offset, cause, granularity):
+    '''
+        The old way of running a phase: simulate in slices of ticks, sized as
+        a fraction (granularity) of the instruction count, polling the
+        instruction count in between. Overshoots the requested count.
+    '''
+    import m5
+    limit = max(int(insts * granularity * 500), 1000 * 500)
+    insts_done = 0
+    exit_cause = cause
+    while insts_done < insts or insts < 0:
+        exit_event = m5.simulate(limit)
+        exit_cause = exit_event.getCause()
+
+        insts_done = int(stats_file.get_progress_stats(system)['sim_insts']) - offset
+        _print_progress(insts_done, insts)
+        if exit_cause != ExitCause.SIMULATE_LIMIT:
+            break
+
+    return insts_done, exit_cause
+
+def _run_forked_config(options, system, resobj, run_phase, config_name,
+        insts, offset):
+    '''
+        Fork the warmed-up simulator and run the reportable instructions in
+        the child with config_name's after_warmup hook applied. The child
+        writes its own stats.txt/res.json into its own output directory and
+        exits; the parent waits for it, so forks don't compete for cores.
+    '''
+    import m5
+    outdir = Path(options.fork_outdir.format(config=config_name))
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = m5.fork(str(outdir))
+    if pid != 0:
+        _, status = os.waitpid(pid, 0)
+        if status != 0:
+            print('Forked config {} failed with status {}'.format(
+                config_name, status))
+        return
+
+    status = 1
+    try:
+        print('**** FORKED CONFIG {} -> {} ****'.format(config_name, outdir))
+        _, after_warmup_fn = Gem5FlagConfig.get_config(config_name)
+        after_warmup_fn()
+
+        # The copy shares the warmup stats, but reads the child's stats file.
+        child_resobj = copy.copy(resobj)
+        child_resobj.stats_file = StatsFile(outdir / 'stats.txt')
+
+        _, exit_cause = run_phase(system, child_resobj.stats_file, insts,
+            offset, ExitCause.ROI_DONE, 0.05)
+        print( '='*10 + ' Exiting @ tick %i because %s' % ( m5.curTick(), exit_cause ) )
+
+        child_resobj.get_final_stats()
+        child_resobj.dump_stats_to_file(outdir / 'res.json')
+        status = 0
+    except Exception as e:
+        print('{} raised in forked config {}: {}'.format(type(e), config_name, e))
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # Skip the parent's exit handlers (stats dumps, StatsFile cleanup).
+        os._exit(status)
+
 def RunExperiment( options, root, system, FutureClass ):
     # The following are imported here, since they will be available when RunExperiment
     # will be called from within gem5:
@@ -111,6 +208,13 @@ def RunExperiment( options, root, system, FutureClass ):
 
     cpu = system.cpu[0]
 
+    fork_configs = [c for c in options.fork_configs.split(',') if len(c)]
+    if options.fork_outdir is None:
+        options.fork_outdir = str(outdir) + '.{config}'
+    if fork_configs:
+        # gem5 refuses to fork while it has listeners open.
+        m5.disableAllListeners()
+
     if options.checkpoint is not None:
         assert checkpoint_in.exists()
         m5.instantiate(str(checkpoint_in))
@@ -118,46 +222,31 @@ def RunExperiment( options, root, system, FutureClass ):
         m5.instantiate()
 
     try:
-        limit = max(int(num_warmup_insts * 0.01 * 500), 1000 * 500)
-        warmup_insts_done = 0
-        print('**** WARMUP SIMULATION ({} instructions, {} cycle granularity) ****'.format(
-          num_warmup_insts, limit))
-
-        quit = False
-        while warmup_insts_done < num_warmup_insts:
-            exit_event = m5.simulate(limit)
-            exit_cause = exit_event.getCause()
-            if exit_cause != ExitCause.SIMULATE_LIMIT:
-                print( '='*10 + ' Exiting @ tick %i because %s' % ( m5.curTick(), exit_cause ) )
-                quit = True
-
-            stats             = stats_file.get_current_stats()
-            warmup_insts_done = int(stats['sim_insts'])
-            percentCompleted  = ( float(warmup_insts_done) / num_warmup_insts ) * 100
-            print('{:5.2f}% inst: {}/{}'.format(
-              percentCompleted, warmup_insts_done, num_warmup_insts))
-
-            if quit:
-                return
+        if options.tick_slices:
+            run_phase = _run_phase_by_ticks
+        else:
+            run_phase = _run_phase_by_insts
+
+        print('**** WARMUP SIMULATION ({} instructions) ****'.format(
+          num_warmup_insts))
+        warmup_insts_done, exit_cause = run_phase(system, stats_file,
+            num_warmup_insts, 0, ExitCause.WARMUP_DONE, 0.01)
+        if exit_cause not in [ExitCause.WARMUP_DONE, ExitCause.SIMULATE_LIMIT]:
+            print( '='*10 + ' Exiting @ tick %i because %s' % ( m5.curTick(), exit_cause ) )
+            return
 
         resobj.get_warmup_stats()
+
+        for config_name in fork_configs:
+            _run_forked_config(options, system, resobj, run_phase, config_name,
+                real, warmup_insts_done)
+
         after_warmup_config()
 
-        realInstructionsDone = 0
-        limit = max(int(real * 0.05 * 500), 1000 * 500)
-        print('**** REAL SIMULATION ({} instructions, {} cycle granularity) ****'.format(
-          'unlimited' if real < 0 else real, limit))
-        while realInstructionsDone < real or real < 0:
-            exit_event = m5.simulate(limit)
-            exit_cause = exit_event.getCause()
-
-            stats                 = stats_file.get_current_stats()
-            realInstructionsDone  = int(stats['sim_insts']) - warmup_insts_done
-            percentCompleted      = float(realInstructionsDone) / real * 100
-            print('{:5.2f}% Completed instructions: {}/{} '.format(
-              percentCompleted, realInstructionsDone, real))
-            if exit_cause != ExitCause.SIMULATE_LIMIT:
-                break
+        print('**** REAL SIMULATION ({} instructions) ****'.format(
+          'unlimited' if real < 0 else real))
+        _, exit_cause = run_phase(system, stats_file, real, warmup_insts_done,
+            ExitCause.ROI_DONE, 0.05)
 
         print( '='*10 + ' Exiting @ tick %i because %s' % ( m5.curTick(), exit_cause ) )
 
@@ -242,6 +331,15 @@ def run_binary_on_gem5(bin_path, bin_args, parsed_args):
 
     if hasattr(parsed_args, 'flag_config') and parsed_args.flag_config:
         debug_args += [ '--flag-config', parsed_args.flag_config ]
+    if getattr(parsed_args, 'fork_configs', None):
+        Gem5FlagConfig.parse_plugins(parsed_args.config)
+        for config_name in parsed_args.fork_configs:
+            if not Gem5FlagConfig.is_forkable(config_name):
+                raise Exception(('{} changes the system before init, so it '
+                    'cannot be forked after warmup.').format(config_name))
+        debug_args += [ '--fork-configs', ','.join(parsed_args.fork_configs) ]
+        if parsed_args.fork_output_dir is not None:
+            debug_args += [ '--fork-outdir', str(parsed_args.fork_output_dir) ]
     if parsed_args.output_dir is not None:
         extra_args += [ '--outdir', str(parsed_args.output_dir) ]
 
@@ -304,6 +402,14 @@ def add_experiment_args(parser):
                         default='', nargs='+')
     parser.add_argument('--syscalls-hook', action='store_true',
                         default=False, help='Use strace log to replace syscalls')
+    parser.add_argument('--fork-configs', default=[], nargs='+',
+                        help=('After warmup, fork the simulation once per '
+                        'given flag config, rather than re-running the '
+                        'warmup for each of them.'))
+    parser.add_argument('--fork-output-dir', default=None,
+                        help=('Output directory for forked configs, where '
+                        '{config} is replaced by the config name. Default is '
+                        '[OUTPUT DIR].{config}'))
 
     Gem5FlagConfig.add_parser_args(parser)
     SpecBench.add_parser_args(parser)
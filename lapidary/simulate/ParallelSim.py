@@ -3,6 +3,11 @@ import lapidary.utils
 from lapidary.utils import Utils
 from lapidary.config.specbench.SpecBench import *
 from lapidary.config import Gem5FlagConfig
+from lapidary.checkpoint import CheckpointConvert
+from lapidary.checkpoint.Catalog import Catalog
+from lapidary.checkpoint import SimPoints
+from lapidary.simulate.Scheduler import Scheduler, Task
+from lapidary.simulate.RemoteExecutor import RemoteExecutor
 
 import json
 import os
@@ -10,10 +15,11 @@ import progressbar
 import sys, io
 
 from argparse import ArgumentParser
-from collections import defaultdict
+from collections import defaultdict, deque
+from copy import copy
 from datetime import datetime
 from fcntl import lockf, LOCK_UN, LOCK_EX
-from multiprocessing import Process, cpu_count, Lock, Pool
+from multiprocessing import cpu_count
 from pathlib import Path, PosixPath
 from pprint import pprint
 from progressbar import ProgressBar
@@ -25,7 +31,8 @@ from tempfile import TemporaryFile
 class ParallelSim:
 
     def __init__(self, args, append_log_file=False):
-        output_dir_parent = Path('simulation_results')
+        # Absolute, as remote workers run simulations in scratch directories.
+        output_dir_parent = Path('simulation_results').resolve()
         if not output_dir_parent.exists():
             output_dir_parent.mkdir()
 
@@ -60,9 +67,23 @@ class ParallelSim:
         assert args.checkpoint_dir is not None
 
         chkdir = Path(args.checkpoint_dir)
-        dirents = Utils.get_directory_entries_by_time(chkdir)
+        # The catalog saves looking into every checkpoint directory.
+        self.catalog = Catalog(chkdir)
+        records = self.catalog.records() if self.catalog.exists() else \
+                  self.catalog.scan()
+        dirents = [ chkdir / name for name in records ]
+        if args.simpoints:
+            if args.num_checkpoints is not None or args.target_ci is not None:
+                raise Exception(('--simpoints already picks the checkpoints, '
+                    'so it cannot be used with --num-checkpoints or --target-ci.'))
+            weights = SimPoints.load_simpoints(chkdir)
+            dirents = [ d for d in dirents if d.name in weights ]
+            self.summary['weights'] = { str(d): weights[d.name] for d in dirents }
+            print('\tSimulating {} simpoints.'.format(len(dirents)))
+        elif 'weights' in self.summary:
+            del self.summary['weights']
         if 'checkpoints' in self.summary:
-            self.chkpts = [x for x in dirents if x.is_dir()]
+            self.chkpts = list(dirents)
             rm_count = 0
             for chk, status in self.summary['checkpoints'].items():
                 chk_path = PosixPath(chk)
@@ -81,7 +102,7 @@ class ParallelSim:
 
             print('\tRemoved {} checkpoints from consideration.'.format(rm_count))
         else:
-            self.chkpts = [x for x in dirents if x.is_dir()]
+            self.chkpts = list(dirents)
 
         exp_args = {}
 
@@ -89,10 +110,15 @@ class ParallelSim:
         # Always update this, for it could change!
         self.summary['total_checkpoints'] = len(self.chkpts)
 
+        # Configs forked off after warmup -> { checkpoint: res.json }
+        self.fork_result_files = { c: {} for c in args.fork_configs }
+
         self.result_files = {}
+        self.memory_sizes = {}
         for chkpt in self.chkpts:
-            pmem_file = chkpt / 'system.physmem.store0.pmem'
-            if not pmem_file.exists():
+            # Checkpoints which haven't been converted yet are converted by
+            # the first simulation which needs them.
+            if not Catalog.is_usable(records[chkpt.name]):
                 invalid_counter += 1
                 self.summary['checkpoints'][str(chkpt)] = 'invalid'
                 #print('{} -- invalid checkpoint, skipping'.format(str(chkpt)))
@@ -105,17 +131,31 @@ class ParallelSim:
                 '--suite', args.suite,
                 '--warmup-insts', str(args.warmup_insts),
                 '--reportable-insts', str(args.reportable_insts),
-                '--start-checkpoint', str(chkpt),
+                '--start-checkpoint', str(chkpt.resolve()),
                 '--output-dir', str(output_dir),
                 '--flag-config', str(args.flag_config)]
             if args.in_order:
                 arg_list += ['--in-order']
+            if args.fork_configs:
+                fork_output_dir = output_dir_parent / '{}_{{config}}_{}'.format(
+                    args.bench, str(chkpt.name))
+                arg_list += ['--fork-configs'] + args.fork_configs
+                arg_list += ['--fork-output-dir', str(fork_output_dir)]
+                for config_name in args.fork_configs:
+                    self.fork_result_files[config_name][str(chkpt)] = Path(
+                        str(fork_output_dir).format(config=config_name)) / 'res.json'
             # if args.invisispec:
             #     arg_list += ['--invisispec', '--scheme', args.scheme]
             exp_args[str(chkpt)] = arg_list
 
             result_file = output_dir / 'res.json'
             self.result_files[str(chkpt)] = result_file
+            mem_size = records[chkpt.name].get('mem_size')
+            if mem_size is None:
+                # Recorded before the catalog kept memory sizes.
+                mem_size = Utils.get_mem_size_from_mappings_file(
+                    chkpt / 'mappings.json')
+            self.memory_sizes[str(chkpt)] = mem_size
 
         if 'invalid_counter' not in self.summary:
             self.summary['invalid_checkpoints'] = invalid_counter
@@ -133,10 +173,42 @@ class ParallelSim:
                     args.num_checkpoints, self.num_checkpoints))
 
         self.all_proc_args = exp_args
-        self.max_procs     = int(args.pool_size)
+        self.ranks         = ParallelSim._rank_coarse_to_fine(list(exp_args.keys()))
+        self.queued_tasks  = []
         self.log_file      = args.log_file
         self.append        = append_log_file
-        self.timeout_seconds = (60.0 * 60.0)
+
+        # With a target CI, start with a small sample and only grow it while
+        # the CI of the chosen stat is too wide.
+        self.sample_size   = self.num_checkpoints
+        self.running_stat  = Utils.RunningStat()
+        self.converged     = False
+        if args.target_ci is not None:
+            self.sample_size = min(args.ci_min_checkpoints, self.num_checkpoints)
+            for chk, status in self.summary['checkpoints'].items():
+                if status == 'successful':
+                    self._add_result(output_dir_parent / '{}_{}_{}'.format(
+                        args.bench, mode, PosixPath(chk).name) / 'res.json')
+
+    def _add_result(self, result_file):
+        if not result_file.exists():
+            return
+        with result_file.open() as f:
+            results = json.load(f)
+        if self.args.ci_stat not in results:
+            print('Warning: {} has no {} stat.'.format(result_file,
+                self.args.ci_stat))
+            return
+        self.running_stat.add(float(results[self.args.ci_stat]))
+
+    @staticmethod
+    def _get_memory_budget(memory_budget):
+        if memory_budget is None:
+            return None
+        if memory_budget == 'auto':
+            total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+            return int(total * 0.9)
+        return Utils.parse_mem_size_string(memory_budget)
 
 
     def __del__(self):
@@ -167,7 +239,10 @@ class ParallelSim:
 
             sys.stdout = out
             sys.stderr = err
-            Experiment.do_experiment(args, config=config)
+            # Checkpoints may only have a core, manifest or diff, so make
+            # sure there is a pmem for the duration of this simulation.
+            with CheckpointConvert.MaterializedCheckpoint(args.start_checkpoint):
+                Experiment.do_experiment(args, config=config)
             out.seek(0)
             err.seek(0)
 
@@ -183,131 +258,190 @@ class ParallelSim:
                 lockf(f, LOCK_UN)
 
 
-    def start(self):
+    @staticmethod
+    def _rank_coarse_to_fine(checkpoints):
+        '''
+            Order checkpoints so that any prefix of them is (roughly) evenly
+            spaced: the middle one first, then the middles of the halves on
+            either side of it, and so on, breadth first.
+        '''
+        from natsort import natsorted, ns
+        sorted_keys = natsorted(checkpoints, alg=ns.IGNORECASE)
+        ranks = {}
+        spans = deque([(0, len(sorted_keys))])
+        while spans:
+            lo, hi = spans.popleft()
+            if lo >= hi:
+                continue
+            mid = (lo + hi) // 2
+            ranks[sorted_keys[mid]] = len(ranks)
+            spans += [(lo, mid), (mid + 1, hi)]
+        return ranks
+
+    def _submit_needed(self, scheduler):
+        '''
+            Top the scheduler up with evenly spaced checkpoints, until enough
+            are queued or running to reach the requested number.
+
+            Each simulation's checkpoints are prioritized coarse to fine, so
+            that a scheduler shared by several simulations first gets a
+            sparse, evenly spaced sample done for every one of them.
+        '''
+        needed = self.sample_size - self.summary['successful_checkpoints'] \
+                    - len(self.queued_tasks)
+        if self.converged or needed <= 0 or not self.all_proc_args:
+            return
+
+        proc_args = Utils.select_evenly_spaced(self.all_proc_args, needed)
+        # Ranked within this batch, so that simulations with many more
+        # checkpoints than others don't get pushed back behind them.
+        batch = sorted(proc_args.keys(), key=lambda c: self.ranks[c])
+        ranks = { chkpt: rank for rank, chkpt in enumerate(batch) }
+        for chkpt, experiment_args in proc_args.items():
+            assert chkpt in self.all_proc_args
+            del self.all_proc_args[chkpt]
+
+            fn_args     = (experiment_args, self.log_file, self.args.config)
+            result_file = self.result_files[chkpt]
+            outputs     = [ (str(result_file), 'w'), (self.log_file, 'a') ]
+            outputs    += [ (str(f[chkpt]), 'w')
+                            for f in self.fork_result_files.values() ]
+            task = Task(chkpt, ParallelSim._run_process, fn_args,
+                lambda task, f=result_file: f.exists(),
+                memory=self.memory_sizes[chkpt],
+                priority=ranks[chkpt],
+                on_finish=lambda task: self._on_finish(task, scheduler),
+                outputs=outputs,
+                # The forked configs run one after another after the warmup.
+                timeout_scale=1 + len(self.args.fork_configs))
+            scheduler.submit(task)
+            self.queued_tasks += [task]
+
+    def _update_sample_size(self, scheduler):
+        '''
+            Stop once the CI of the chosen stat is within the target, otherwise
+            grow the sample to however many checkpoints it looks like it
+            needs to get there.
+        '''
+        stat = self.running_stat
+        if stat.count < 2:
+            return
+
+        if stat.count >= self.args.ci_min_checkpoints and \
+           stat.ci_percent() <= self.args.target_ci:
+            print('{} ({}): {} converged to {:.3f} +/- {:.2f}% after {} checkpoints.'.format(
+                self.args.bench, self.summary['mode'], self.args.ci_stat,
+                stat.mean, stat.ci_percent(), stat.count))
+            self.converged = True
+            for task in list(self.queued_tasks):
+                if scheduler.cancel(task):
+                    self.queued_tasks.remove(task)
+            return
+
+        wanted = stat.count_for_ci_percent(self.args.target_ci)
+        self.sample_size = min(max(wanted, self.sample_size), self.num_checkpoints)
+        self._submit_needed(scheduler)
+
+    def _on_finish(self, task, scheduler):
+        self.queued_tasks.remove(task)
+        self.summary['checkpoints'][task.key] = task.status
+        self.catalog.update(Path(task.key).name,
+                            **{ 'sim_' + self.summary['mode']: task.status })
+        if task.status == 'successful':
+            self.summary['successful_checkpoints'] += 1
+            if self.args.target_ci is not None:
+                self._add_result(self.result_files[task.key])
+                self._update_sample_size(scheduler)
+        else:
+            self.summary['failed_checkpoints'] += 1
+            # Replace the failed checkpoint with another one.
+            self._submit_needed(scheduler)
+
+    def _start_log(self):
         with open(self.log_file, 'w' if not self.append else 'a') as f:
             f.write('*' * 80 + '\n')
-            f.write('Starting simulation run at {}...\n'.format(datetime.utcnow()))
+            f.write('Starting simulation run for {} ({}) at {}...\n'.format(
+                self.args.bench, self.summary['mode'], datetime.utcnow()))
 
+    @staticmethod
+    def run_all(sims, args):
+        '''
+            Run the checkpoints of several simulations (e.g. every benchmark
+            and config of a sweep) from one queue, so that the machine doesn't
+            drain at the end of each of them.
+        '''
+        total = sum(sim.num_checkpoints for sim in sims)
         widgets = [
                     progressbar.Percentage(),
-                    ' (', progressbar.Counter(), ' of {})'.format(self.num_checkpoints),
+                    ' (', progressbar.Counter(), ' of {})'.format(total),
                     ' ', progressbar.Bar(left='[', right=']'),
                     ' ', progressbar.Timer(),
                     ' ', progressbar.ETA(),
                   ]
-        with Pool(self.max_procs) as pool, \
-             ProgressBar(widgets=widgets, max_value=self.num_checkpoints) as bar:
-
+        executor = None
+        if args.workers:
+            executor = RemoteExecutor(args.workers, args.worker_authkey)
+        scheduler = Scheduler(int(args.pool_size), float(args.task_timeout),
+            int(args.max_retries), float(args.retry_backoff),
+            ParallelSim._get_memory_budget(args.memory_budget), executor)
+
+        with ProgressBar(widgets=widgets, max_value=total) as bar:
             bar.start()
 
-            wait_time = 0.001
-            failed_counter        = 0
-            successful_counter    = self.summary['successful_checkpoints']
-            failed_counter        = self.summary['failed_checkpoints']
-            remaining_checkpoints = len(self.all_proc_args)
-            tasks = {}
-            task_results = {}
-            task_checkpoint = {}
-
-            def do_visual_update(self):
-                counter = min(successful_counter, self.num_checkpoints)
-                bar.update(counter)
-
-            self.__class__.do_visual_update = do_visual_update
-
-            while successful_counter < self.num_checkpoints and \
-                  remaining_checkpoints > 0:
-
-                needed_checkpoints = self.num_checkpoints - successful_counter
-                proc_args = Utils.select_evenly_spaced(self.all_proc_args, needed_checkpoints)
-
-                for chkpt in proc_args:
-                    assert chkpt in self.all_proc_args
-                    del self.all_proc_args[chkpt]
-                remaining_checkpoints = len(self.all_proc_args)
-
-                for chkpt, experiment_args in proc_args.items():
-                    fn_args = (experiment_args, self.log_file, self.args.config)
-                    task = pool.apply_async(ParallelSim._run_process, fn_args)
-
-                    tasks[task] = time()
-                    task_results[task] = self.result_files[chkpt]
-                    task_checkpoint[task] = chkpt
-
-                finished_tasks = []
-                done_waiting = False
-                while not done_waiting:
-                    done_waiting = True
-                    successful   = False
-                    max_time     = 0.0
-                    for task, start_time in tasks.items():
-                        task.wait(wait_time)
-                        if task.ready():
-                            # This re-raises any exceptions.
-                            task.get()
-                            successful      = True
-                            finished_tasks += [task]
-                            result_file     = task_results.pop(task)
-                            checkpoint      = task_checkpoint.pop(task)
-                            if not result_file.exists():
-                                failed_counter += 1
-                                self.summary['checkpoints'][checkpoint] = 'failed'
-                            else:
-                                successful_counter += 1
-                                self.summary['checkpoints'][checkpoint] = 'successful'
-                        elif successful:
-                            done_waiting = False
-                            tasks[task] = time()
-                        else:
-                            done_waiting = False
-                            max_time = max(time() - start_time, max_time)
-
-                    tasks = {t:s for t, s in tasks.items() if t not in finished_tasks}
-                    if not successful and max_time > self.timeout_seconds:
-                        done_waiting = True
-                    if len(tasks) == 0:
-                        done_waiting = True
-                    if successful_counter >= self.num_checkpoints:
-                        done_waiting = True
-
-                    self.do_visual_update()
-
-            # Now we're waiting on straggler processes
-            ready_to_terminate = successful_counter >= self.num_checkpoints
-            while not ready_to_terminate:
-                ready_to_terminate = True
-                finished_tasks = []
-                for task, start_time in tasks.items():
-                    successful = False
-                    task.wait(wait_time)
-                    if task.ready():
-                        successful = True
-                        # Only terminate if completely stagnant
-                        ready_to_terminate = False
-                        finished_tasks += [task]
-                        result_file = task_results.pop(task)
-                        checkpoint  = task_checkpoint.pop(task)
-                        if not result_file.exists():
-                            failed_counter += 1
-                            self.summary['checkpoints'][checkpoint] = 'failed'
-                        else:
-                            successful_counter += 1
-                            self.summary['checkpoints'][checkpoint] = 'successful'
-                    elif time() - start_time < self.timeout_seconds:
-                        ready_to_terminate = False
-                    else:
-                        finished_tasks += [task]
-                        result_file = task_results.pop(task)
-                        checkpoint  = task_checkpoint.pop(task)
-                        failed_counter += 1
-                        self.summary['checkpoints'][checkpoint] = 'failed (timeout)'
-
-
-                tasks = {t:s for t, s in tasks.items() if t not in finished_tasks}
-                self.do_visual_update()
-
-            self.summary['successful_checkpoints'] = successful_counter
-            self.summary['failed_checkpoints']     = failed_counter
+            def do_visual_update(task):
+                bar.update(sum(min(sim.summary['successful_checkpoints'],
+                                   sim.num_checkpoints) for sim in sims))
+
+            for sim in sims:
+                sim._start_log()
+                sim._submit_needed(scheduler)
+            scheduler.run(do_visual_update)
+
+        report = scheduler.report()
+        for sim in sims:
+            sim.summary['scheduler'] = report
+            if args.target_ci is not None:
+                sim.summary['sampling'] = {
+                    'stat':       args.ci_stat,
+                    'mean':       sim.running_stat.mean,
+                    'ci_percent': sim.running_stat.ci_percent(),
+                    'count':      sim.running_stat.count,
+                    'converged':  sim.converged,
+                }
+            sim._write_fork_summaries()
+        print('Slot utilization: {:.1%} ({:.0f} idle slot-seconds)'.format(
+            report['utilization'], report['idle_slot_seconds']))
+
+    def start(self):
+        ParallelSim.run_all([self], self.args)
+
+    def _write_fork_summaries(self):
+        '''
+            Forked configs ran alongside the checkpoints of this simulation,
+            so write them the same summary file a separate run would have.
+        '''
+        for config_name, result_files in self.fork_result_files.items():
+            summary = defaultdict(dict)
+            summary['mode']  = config_name
+            summary['bench'] = self.args.bench
+            if 'weights' in self.summary:
+                summary['weights'] = self.summary['weights']
+            for chkpt, result_file in result_files.items():
+                status = self.summary['checkpoints'].get(chkpt, 'not run')
+                if status != 'not run' and not result_file.exists():
+                    status = 'failed'
+                summary['checkpoints'][chkpt] = status
+
+            statuses = list(summary['checkpoints'].values())
+            summary['successful_checkpoints'] = statuses.count('successful')
+            summary['failed_checkpoints']     = len(
+                [s for s in statuses if s.startswith('failed')])
+            summary['total_checkpoints']      = len(statuses)
+
+            summary_path = self.summary_path.parent / '{}_{}_summary.json'.format(
+                self.args.bench, config_name)
+            with summary_path.open('w') as f:
+                json.dump(summary, f, indent=4)
 
 
     @staticmethod
@@ -317,7 +451,8 @@ class ParallelSim:
         # Gem5FlagConfig.add_parser_args(parser)
 
         parser.add_argument('--checkpoint-dir', '-d',
-                            help='Locations of all the checkpoints')
+                            help=('Locations of all the checkpoints. With several '
+                            'benchmarks, "{bench}" is replaced by each name.'))
         parser.add_argument('--pool-size', '-p', default=cpu_count(),
                             help='Number of threads to use')
         parser.add_argument('--log-file', '-l', 
@@ -331,55 +466,117 @@ class ParallelSim:
             help='Run parallel sim for all configurations')
         parser.add_argument('--force-rerun', action='store_true',
             help='Ignore previous summary files and rerun from scratch')
+        parser.add_argument('--task-timeout', default=(60.0 * 60.0), type=float,
+            help=('Seconds a single simulation may run before it is killed. '
+                  'Defaults to an hour. With --fork-configs, a checkpoint may '
+                  'run this long once for each config.'))
+        parser.add_argument('--max-retries', default=1, type=int,
+            help='How many times to retry a failed or timed out simulation.')
+        parser.add_argument('--retry-backoff', default=60.0, type=float,
+            help=('Seconds to wait before the first retry of a simulation, '
+                  'doubling for each further retry.'))
+        parser.add_argument('--memory-budget', default=None,
+            help=('Only run as many simulations at once as fit in this much '
+                  'memory (e.g. 256GB), going by the mem_size of each '
+                  'checkpoint and the memory use measured so far. "auto" '
+                  'uses 90%% of physical memory. Unlimited by default.'))
+        parser.add_argument('--target-ci', default=None, type=float,
+            help=('Sample checkpoints adaptively: keep adding evenly spaced '
+                  'checkpoints (up to --num-checkpoints) only until the 95%% '
+                  'confidence interval of --ci-stat is within this percentage '
+                  'of its mean.'))
+        parser.add_argument('--ci-stat', default='cpi',
+            help='Stat from res.json to use with --target-ci. Default is cpi')
+        parser.add_argument('--ci-min-checkpoints', default=10, type=int,
+            help='Minimum number of checkpoints to simulate with --target-ci')
+        parser.add_argument('--simpoints', action='store_true',
+            help=('Only simulate the representative checkpoints picked by '
+                  '"lapidary simpoints", so that the report weighs them.'))
+        parser.add_argument('--workers', default=None, nargs='+',
+            help=('Run simulations on these "lapidary simulate-worker" '
+                  'nodes (host:port) instead of locally. Checkpoints must be '
+                  'at the same paths on every node.'))
+        parser.add_argument('--worker-authkey', default=None,
+            help='Shared secret with the workers. Defaults to $LAPIDARY_WORKER_AUTHKEY')
+        parser.add_argument('--fork-after-warmup', action='store_true',
+            help=('With --all-configs or --flag-config-group, warm each '
+                  'checkpoint up once and fork off every config that only '
+                  'differs after warmup.'))
 
     @classmethod
-    def main(cls, args):
-        # parser = ArgumentParser(description='Run a pool of experiments on gem5.')
-        # cls.add_args(parser)
+    def _create_simulations(cls, args, append_log_file=False):
+        '''
+            Create a ParallelSim for each mode (in-order, out-of-order, flag
+            configs) that should be run for args.bench.
+        '''
+        if not args.all_configs and args.flag_config_group is None:
+            return [ cls(args, append_log_file) ]
+
+        config_names = Gem5FlagConfig.get_all_config_names() \
+                        if args.all_configs \
+                        else Gem5FlagConfig.get_config_group_names(args.flag_config_group)
+
+        sims = []
+        # In-order:
+        sim_args = copy(args)
+        sim_args.in_order     = True
+        sim_args.fork_configs = []
+        sims += [ cls(sim_args, append_log_file) ]
+        # Everything else:
+        forked_configs = []
+        if args.fork_after_warmup:
+            forked_configs = [ c for c in config_names
+                               if c not in ['default', 'empty'] and
+                                  Gem5FlagConfig.is_forkable(c) ]
+            print('\tForking {} after out-of-order warmup'.format(
+                ', '.join(forked_configs)))
+            sim_args = copy(args)
+            sim_args.in_order     = False
+            sim_args.flag_config  = 'empty'
+            sim_args.fork_configs = forked_configs
+            sims += [ cls(sim_args, append_log_file=True) ]
+            forked_configs += ['empty']
+
+        for flag_config_name in config_names:
+            if flag_config_name == 'default':
+                print('\tSkipping default configuration')
+                continue
+            if flag_config_name in forked_configs:
+                continue
+            sim_args = copy(args)
+            sim_args.in_order     = False
+            sim_args.flag_config  = flag_config_name
+            sim_args.fork_configs = []
+            sims += [ cls(sim_args, append_log_file=True) ]
 
-        # args = parser.parse_args()
-        # SpecBench.maybe_display_spec_info(args)
-        # CooldownConfig.maybe_show_configs(args)
+        return sims
 
+    @classmethod
+    def main(cls, args):
         benchmarks = SpecBench.get_benchmarks(args)
 
-        if len(benchmarks) != 1:
-            raise Exception(
-                    'For now, ParallelSim only supports one benchmark at a time.')
-
-        benchmark = benchmarks[0]
-
-        print('ParallelSim for {}'.format(benchmark))
-        args.bench = benchmark
-        if args.all_configs or args.flag_config_group is not None:
-            config_names = CooldownConfig.get_all_config_names() \
-                            if args.all_configs \
-                            else CooldownConfig.get_config_group_names(args.config_group)
-            # Run In-Order:
-            args.in_order = True
-            print('In-order simulation')
-            sim = ParallelSim(args)
-            sim.start()
-            # Run everything else:
-            args.in_order = False
-            for flag_config_name in config_names:
-                if flag_config_name == 'default':
-                    print('Skipping default configuration')
-                    continue
-                if flag_config_name == 'empty':
-                    print('Out-of-order simulation')
-                else:
-                    print('Cooldown config {} simulation'.format(flag_config_name))
-                args.flag_config = flag_config_name
-                sim = ParallelSim(args, append_log_file=True)
-                sim.start()
+        if len(benchmarks) > 1 and '{bench}' not in str(args.checkpoint_dir):
+            raise Exception(('To simulate several benchmarks, --checkpoint-dir '
+                'must contain "{bench}", e.g. checkpoints/{bench}.'))
 
-        else:
+        Gem5FlagConfig.parse_plugins(args.config)
+
+        sims = []
+        for benchmark in benchmarks:
+            print('ParallelSim for {}'.format(benchmark))
+            bench_args = copy(args)
+            bench_args.bench          = benchmark
+            bench_args.checkpoint_dir = str(args.checkpoint_dir).format(
+                bench=benchmark)
             try:
-                sim = cls(args)
-                sim.start()
+                sims += cls._create_simulations(bench_args,
+                    append_log_file=len(sims) > 0)
             except Exception as e:
-                print('Could not start simulations:', e)
-                return 1
+                print('Could not start simulations for {}: {}'.format(
+                    benchmark, e))
+
+        if not sims:
+            return 1
 
-        return 0
\ No newline at end of file
+        cls.run_all(sims, args)
+        return 0
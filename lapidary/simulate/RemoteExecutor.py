@@ -0,0 +1,211 @@
+import os
+
+from fcntl import lockf, LOCK_UN, LOCK_EX
+from multiprocessing import Process, active_children
+from multiprocessing.connection import Client, Listener, AuthenticationError, wait
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import time
+
+from lapidary.simulate.Scheduler import Task
+
+AUTHKEY_ENV = 'LAPIDARY_WORKER_AUTHKEY'
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+def get_authkey(authkey=None):
+    if authkey is None:
+        authkey = os.environ.get(AUTHKEY_ENV, None)
+    if authkey is None:
+        raise Exception('No worker authkey given (use --worker-authkey or {})'.format(
+            AUTHKEY_ENV))
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+class RemoteExecutor:
+    '''
+        Runs tasks on SimulationWorkers, possibly on other nodes. Each task
+        gets its own connection to a worker, which runs it in a scratch
+        directory and sends back its exit code, max RSS and outputs.
+
+        Tasks run in a scratch directory, so paths in the task arguments
+        (i.e. checkpoints and output directories) must be absolute, and valid
+        on the workers too. Only the task's outputs may be relative: to the
+        scratch directory on the worker, and to the current directory here.
+        If a worker goes away, its tasks are marked as lost and it is not
+        used again. If only a task's connection fails, the task has failed.
+    '''
+
+    def __init__(self, addresses, authkey):
+        self.authkey = get_authkey(authkey)
+        # address -> [slots, running tasks]
+        self.nodes   = {}
+        for address in addresses:
+            if isinstance(address, str):
+                address = parse_address(address)
+            try:
+                with Client(address, authkey=self.authkey) as conn:
+                    conn.send(('slots',))
+                    self.nodes[address] = [conn.recv(), 0]
+            except (OSError, EOFError, AuthenticationError) as e:
+                print('Worker {}:{} is unavailable: {}'.format(*address, e))
+
+        if not self.nodes:
+            raise Exception('No simulation workers available!')
+
+    @property
+    def slots(self):
+        return sum(slots for slots, _ in self.nodes.values())
+
+    def _is_alive(self, address):
+        try:
+            with Client(address, authkey=self.authkey) as conn:
+                conn.send(('slots',))
+                conn.recv()
+            return True
+        except (OSError, EOFError, AuthenticationError):
+            return False
+
+    def _node_lost(self, address):
+        if address in self.nodes:
+            print('Lost simulation worker {}:{}'.format(*address))
+            del self.nodes[address]
+
+    def start(self, task):
+        by_free_slots = sorted(self.nodes.items(), key=lambda n: n[1][1] - n[1][0])
+        for address, node in by_free_slots:
+            if node[1] >= node[0]:
+                continue
+            try:
+                conn = Client(address, authkey=self.authkey)
+                conn.send(('run', task.fn, task.args, task.outputs))
+            except (OSError, EOFError, AuthenticationError):
+                self._node_lost(address)
+                continue
+
+            node[1]        += 1
+            task.attempts  += 1
+            task.start_time = time()
+            task.node       = address
+            task.conn       = conn
+            return conn
+
+        # Every worker with a free slot has gone away.
+        return None
+
+    def _release(self, task):
+        if task.node in self.nodes:
+            self.nodes[task.node][1] -= 1
+        task.conn.close()
+        task.conn = None
+        return time() - task.start_time
+
+    def finish(self, task):
+        try:
+            _, task.exitcode, task.max_rss, outputs = task.conn.recv()
+        except Exception:
+            # Either the worker is gone, or only this task's handler died
+            # (e.g. it was OOM-killed or couldn't send the outputs back), in
+            # which case the task failed like any other.
+            task.exitcode = None
+            if not self._is_alive(task.node):
+                task.lost = True
+                self._node_lost(task.node)
+            return self._release(task)
+
+        for path, mode, data in outputs:
+            path = Path(path)
+            if not path.parent.exists():
+                path.parent.mkdir(parents=True)
+            with path.open(mode + 'b') as f:
+                lockf(f, LOCK_EX)
+                try:
+                    f.write(data)
+                finally:
+                    lockf(f, LOCK_UN)
+
+        return self._release(task)
+
+    def kill(self, task):
+        # The worker kills the task when the connection goes away.
+        return self._release(task)
+
+    def close(self):
+        pass
+
+
+class SimulationWorker:
+    '''
+        Serves tasks for a RemoteExecutor. Each connection is handled in its
+        own process, which runs the task in a new scratch directory and kills
+        it if the connection drops.
+    '''
+
+    def __init__(self, address, authkey, slots):
+        self.slots    = slots
+        self.listener = Listener(address, authkey=get_authkey(authkey))
+        self.address  = self.listener.address
+
+    @staticmethod
+    def _run_task(conn, fn, args, outputs):
+        with TemporaryDirectory(prefix='lapidary_worker_') as workdir:
+            os.chdir(workdir)
+            task = Task(None, fn, args)
+            task.start()
+
+            ready = wait([task.process.sentinel, conn])
+            if task.process.sentinel not in ready:
+                # The coordinator has gone away or given up on the task.
+                task.kill()
+                task.finish()
+                return
+
+            task.finish()
+            files = [ (path, mode, Path(path).read_bytes())
+                      for path, mode in outputs if Path(path).exists() ]
+            conn.send(('done', task.exitcode, task.max_rss, files))
+
+    def _serve(self, conn):
+        try:
+            request = conn.recv()
+            if request[0] == 'slots':
+                conn.send(self.slots)
+            elif request[0] == 'run':
+                SimulationWorker._run_task(conn, *request[1:])
+        except (OSError, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        print('Serving simulations on {}:{} with {} slots'.format(
+            *self.address, self.slots))
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, AuthenticationError) as e:
+                print('Rejected connection: {}'.format(e))
+                continue
+            Process(target=self._serve, args=(conn,)).start()
+            conn.close()
+            # Reap the handlers that are done.
+            active_children()
+
+    @staticmethod
+    def add_args(parser):
+        from multiprocessing import cpu_count
+        parser.add_argument('--listen', default='0.0.0.0:7878',
+            help='host:port to accept simulations on')
+        parser.add_argument('--slots', default=cpu_count(), type=int,
+            help='How many simulations to run at once')
+        parser.add_argument('--worker-authkey', default=None,
+            help=('Shared secret with the coordinator. Defaults to ${}'.format(
+                AUTHKEY_ENV)))
+
+    @staticmethod
+    def main(args):
+        worker = SimulationWorker(parse_address(args.listen),
+            args.worker_authkey, args.slots)
+        worker.serve_forever()
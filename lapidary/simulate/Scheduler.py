@@ -0,0 +1,361 @@
+import os
+import signal
+
+from multiprocessing import Pipe, Process
+from resource import getrusage, RUSAGE_SELF, RUSAGE_CHILDREN
+from multiprocessing.connection import wait
+from time import time, sleep
+
+
+class Task:
+    '''
+        One unit of work for the Scheduler. fn(*args) is run in its own
+        process, which becomes the leader of a new process group so that
+        anything it spawns (i.e. gem5) is killed along with it.
+
+        memory is how many bytes the task is expected to need. Once it has
+        run, max_rss holds what it (and its children) actually used.
+
+        Tasks with a lower priority value are started first. on_finish(task)
+        is called once the task has succeeded or run out of retries.
+
+        timeout_scale is how many times the Scheduler's timeout the task may
+        run for, e.g. for a task which does the work of several.
+
+        outputs are (path, mode) pairs of files the task creates, relative to
+        its working directory. Executors that run the task elsewhere copy them
+        back, overwriting (mode 'w') or appending to (mode 'a') the local file.
+    '''
+
+    def __init__(self, key, fn, args, is_successful=None, memory=0,
+                 priority=0, on_finish=None, outputs=[], timeout_scale=1):
+        self.key           = key
+        self.fn            = fn
+        self.args          = args
+        self.memory        = memory
+        self.priority      = priority
+        self.on_finish     = on_finish
+        self.outputs       = outputs
+        self.timeout_scale = timeout_scale
+        self.sequence      = None
+        self.node          = None
+        self.lost          = False
+        self.reservation   = 0
+        self.skips         = 0
+        self.max_rss       = None
+        self.is_successful = is_successful
+        if self.is_successful is None:
+            self.is_successful = lambda task: task.exitcode == 0
+        self.status        = 'not run'
+        self.attempts      = 0
+        self.not_before    = 0.0
+        self.start_time    = None
+        self.exitcode      = None
+        self.process       = None
+        self.conn          = None
+
+    @staticmethod
+    def _run(fn, args, conn):
+        os.setsid()
+        try:
+            fn(*args)
+        finally:
+            # ru_maxrss is in kB. Children only count once they're waited on.
+            max_rss = max(getrusage(RUSAGE_SELF).ru_maxrss,
+                          getrusage(RUSAGE_CHILDREN).ru_maxrss)
+            conn.send(max_rss * 1024)
+
+    def start(self):
+        self.attempts  += 1
+        self.start_time = time()
+        self.conn, child_conn = Pipe(duplex=False)
+        self.process    = Process(target=Task._run,
+                                  args=(self.fn, self.args, child_conn))
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # It never got as far as creating its process group.
+            self.process.kill()
+        self.process.join()
+
+    def finish(self):
+        self.process.join()
+        self.exitcode = self.process.exitcode
+        self.process  = None
+        try:
+            if self.conn.poll():
+                self.max_rss = self.conn.recv()
+        except EOFError:
+            # Killed before it could report its memory use.
+            pass
+        self.conn.close()
+        return time() - self.start_time
+
+
+class LocalExecutor:
+    '''
+        Runs tasks as processes on this machine. An executor starts a task
+        and returns something to wait on (see multiprocessing.connection.wait)
+        until it is done, or None if it has nowhere left to run it. It then
+        finishes or kills the task, returning how many seconds it ran for.
+    '''
+
+    def __init__(self, slots):
+        self.slots = slots
+
+    def start(self, task):
+        task.start()
+        return task.process.sentinel
+
+    def finish(self, task):
+        return task.finish()
+
+    def kill(self, task):
+        task.kill()
+        return task.finish()
+
+    def close(self):
+        pass
+
+
+class Scheduler:
+    '''
+        Runs Tasks in up to max_procs processes. Rather than polling, it
+        blocks on the process sentinels until a task finishes, a task runs
+        past its timeout (it is then killed) or a retry's backoff elapses.
+
+        Failed tasks are retried up to max_retries times, waiting
+        backoff_seconds * 2^(attempt - 1) before each retry.
+
+        If memory_budget is given, tasks are also only started while the
+        memory reserved for the running tasks fits in the budget. Tasks which
+        fit are started ahead of queued tasks that don't, so that small tasks
+        are packed around large ones, until the first task that doesn't fit
+        has been passed over MAX_SKIPS times; after that, nothing more is
+        started until there is room for it. A task's reservation is its declared
+        memory, scaled by the ratio of measured max RSS to declared memory
+        over all the tasks that have finished so far (or its own max RSS, if
+        it is being retried).
+
+        Tasks are run by the executor, a LocalExecutor with max_procs slots
+        by default. Tasks that are lost along with the node they ran on are
+        re-queued without counting as an attempt.
+    '''
+
+    # Headroom on top of measured memory use.
+    RSS_MARGIN = 1.1
+    # How many tasks may be started ahead of one that doesn't fit.
+    MAX_SKIPS  = 4
+
+    def __init__(self, max_procs, timeout_seconds=None, max_retries=0,
+                 backoff_seconds=60.0, memory_budget=None, executor=None):
+        self.executor        = executor
+        if self.executor is None:
+            self.executor    = LocalExecutor(max_procs)
+        self.max_procs       = self.executor.slots
+        assert self.max_procs > 0
+        self.timeout_seconds = timeout_seconds
+        self.max_retries     = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.memory_budget   = memory_budget
+        self.rss_ratio       = None
+        self.measured_rss    = 0
+        self.measured_memory = 0
+        self.pending         = []
+        # sentinel -> Task
+        self.running         = {}
+        self.reserved        = 0
+        self.peak_reserved   = 0
+        self.num_submitted   = 0
+
+        self.elapsed_seconds   = 0.0
+        self.busy_seconds      = 0.0
+        self.num_successful    = 0
+        self.num_failed        = 0
+        self.num_timeouts      = 0
+        self.num_retries       = 0
+        self.num_requeued      = 0
+
+    def __len__(self):
+        return len(self.pending) + len(self.running)
+
+    def submit(self, task):
+        assert isinstance(task, Task)
+        task.sequence = self.num_submitted
+        self.num_submitted += 1
+        self.pending.append(task)
+
+    def cancel(self, task):
+        '''
+            Drop a task which hasn't been started yet. Returns whether it was.
+        '''
+        if task in self.pending:
+            self.pending.remove(task)
+            return True
+        return False
+
+    def reserved_memory(self, task):
+        if task.max_rss is not None:
+            return int(task.max_rss * self.RSS_MARGIN)
+        if self.rss_ratio is not None:
+            return int(task.memory * self.rss_ratio)
+        return task.memory
+
+    def _fits(self, task):
+        if self.memory_budget is None or not self.running:
+            # Always allow one task to run, however large it is.
+            return True
+        return self.reserved + self.reserved_memory(task) <= self.memory_budget
+
+    def _start_ready_tasks(self, now):
+        ready = [ t for t in self.pending if t.not_before <= now ]
+        blocked = None
+        for task in sorted(ready, key=lambda t: (t.priority, t.sequence)):
+            if len(self.running) >= self.executor.slots:
+                break
+            if blocked is not None and blocked.skips >= self.MAX_SKIPS:
+                # Reserve what frees up for it, rather than starving it.
+                break
+            if not self._fits(task):
+                if blocked is None:
+                    blocked = task
+                continue
+            sentinel = self.executor.start(task)
+            if sentinel is None:
+                # The executor lost the slots it had free.
+                break
+            if blocked is not None:
+                blocked.skips += 1
+            self.pending.remove(task)
+            task.skips          = 0
+            task.reservation    = self.reserved_memory(task)
+            self.reserved      += task.reservation
+            self.peak_reserved  = max(self.reserved, self.peak_reserved)
+            self.running[sentinel] = task
+
+    def _release_task(self, task):
+        self.reserved -= task.reservation
+        if task.memory and task.max_rss:
+            self.measured_rss    += task.max_rss
+            self.measured_memory += task.memory
+            self.rss_ratio = float(self.measured_rss) / self.measured_memory * \
+                self.RSS_MARGIN
+
+    def _timeout(self, task):
+        return self.timeout_seconds * task.timeout_scale
+
+    def _next_wakeup(self, now):
+        wakeups = []
+        if self.timeout_seconds is not None:
+            wakeups += [ t.start_time + self._timeout(t)
+                         for t in self.running.values() ]
+        if len(self.running) < self.executor.slots:
+            # Tasks that are ready but don't fit wait for a task to finish.
+            wakeups += [ t.not_before for t in self.pending
+                         if t.not_before > now ]
+
+        if not wakeups:
+            return None
+        return max(min(wakeups) - now, 0.0)
+
+    def _finish_task(self, task, successful, status, on_finish, retry=True):
+        if task.lost:
+            task.lost      = False
+            task.attempts -= 1
+            self.num_requeued += 1
+            self.pending.append(task)
+            return
+
+        if successful:
+            task.status = 'successful'
+            self.num_successful += 1
+        elif retry and task.attempts <= self.max_retries:
+            task.status      = 'retrying'
+            task.not_before  = time() + \
+                self.backoff_seconds * (2 ** (task.attempts - 1))
+            self.num_retries += 1
+            self.pending.append(task)
+            return
+        else:
+            task.status = status
+            self.num_failed += 1
+
+        if task.on_finish is not None:
+            task.on_finish(task)
+        if on_finish is not None:
+            on_finish(task)
+
+    def _fail_pending(self, status, on_finish):
+        ''' Fails every pending task, including those on_finish submits. '''
+        while self.pending:
+            task = self.pending.pop(0)
+            self._finish_task(task, False, status, on_finish, retry=False)
+
+    def run(self, on_finish=None):
+        '''
+            Run until every submitted task is done. on_finish(task) is called
+            once a task has succeeded or run out of retries, and may submit
+            more tasks.
+        '''
+        start_time = time()
+        try:
+            while len(self):
+                self._start_ready_tasks(time())
+                if not self.running and not self.executor.slots:
+                    # e.g. every remote worker has gone away.
+                    self._fail_pending('failed (no slots left)', on_finish)
+                    continue
+
+                timeout = self._next_wakeup(time())
+                if self.running:
+                    finished = wait(list(self.running.keys()), timeout)
+                else:
+                    sleep(timeout)
+                    finished = []
+
+                for sentinel in finished:
+                    task = self.running.pop(sentinel)
+                    self.busy_seconds += self.executor.finish(task)
+                    self._release_task(task)
+                    self._finish_task(task, task.is_successful(task), 'failed',
+                        on_finish)
+
+                if self.timeout_seconds is None:
+                    continue
+
+                now = time()
+                for sentinel, task in list(self.running.items()):
+                    if now - task.start_time > self._timeout(task):
+                        del self.running[sentinel]
+                        self.busy_seconds += self.executor.kill(task)
+                        self._release_task(task)
+                        self.num_timeouts += 1
+                        self._finish_task(task, False, 'failed (timeout)',
+                            on_finish)
+        finally:
+            for task in self.running.values():
+                self.executor.kill(task)
+            self.running = {}
+            self.elapsed_seconds += time() - start_time
+
+    def report(self):
+        capacity = self.max_procs * self.elapsed_seconds
+        return {
+            'slots':                self.max_procs,
+            'elapsed_seconds':      self.elapsed_seconds,
+            'busy_slot_seconds':    self.busy_seconds,
+            'idle_slot_seconds':    max(capacity - self.busy_seconds, 0.0),
+            'utilization':          self.busy_seconds / capacity if capacity else 0.0,
+            'successful':           self.num_successful,
+            'failed':               self.num_failed,
+            'timeouts':             self.num_timeouts,
+            'retries':              self.num_retries,
+            'requeued':             self.num_requeued,
+            'memory_budget':        self.memory_budget,
+            'peak_reserved_memory': self.peak_reserved,
+            'rss_ratio':            self.rss_ratio,
+        }
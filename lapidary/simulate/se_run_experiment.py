@@ -85,6 +85,13 @@ def add_benchmark_args(parser):
                         help='Where to output stuff like stats')
     parser.add_option('--syscalls-hook', action='store_true',
                         default=False, help='Use strace log to replace syscalls')
+    parser.add_option('--tick-slices', action='store_true', default=False,
+        help=('Poll the instruction count between fixed tick slices rather '
+              'than exiting exactly at the warmup/reportable instruction counts'))
+    parser.add_option('--fork-configs', default='',
+        help='Comma-separated flag configs to fork off after warmup')
+    parser.add_option('--fork-outdir', default=None,
+        help='Output directory of forked configs, {config} is the config name')
     # parser.add_option('--config', help='What Lapidary config to use')
 
 
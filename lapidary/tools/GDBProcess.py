@@ -3,13 +3,14 @@ import gzip, json, os, re, resource, signal, shutil, subprocess, sys, copy
 import glob, shlex, logging
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 from elftools.elf.elffile import ELFFile
 from multiprocessing import Process
 from pathlib import Path
 from pprint import pprint
 from subprocess import Popen, TimeoutExpired
 
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
 from time import sleep
 
 WORK_DIR = os.path.dirname(__file__)
@@ -28,6 +29,9 @@ from lapidary.checkpoint.CheckpointTemplate import *
 import lapidary.checkpoint.CheckpointConvert
 from lapidary.config import LapidaryConfig
 from lapidary.checkpoint.GDBEngine import GDBEngine
+from lapidary.checkpoint.Compression import CODECS
+from lapidary.checkpoint.PerfCounters import count_instructions
+from lapidary.utils.Utils import WorkerSlots
 import lapidary.pypatch 
 
 GLIBC_PATH = Path('../libc/glibc/build/install/lib').resolve()
@@ -38,6 +42,7 @@ class GDBProcess:
     def __init__(self, arg_list,
                        checkpoint_interval=None,
                        checkpoint_instructions=None,
+                       counted_instructions=None,
                        checkpoint_locations=None,
                        max_checkpoints=-1,
                        root_dir='.',
@@ -45,16 +50,44 @@ class GDBProcess:
                        convert=True,
                        debug_mode=False,
                        ld_path=None,
-                       keyframes=5):
+                       keyframes=5,
+                       dedup=False,
+                       codec='gzip',
+                       compress_workers=2,
+                       profile_phases=False,
+                       fork_capture=False,
+                       direct_capture=False,
+                       work_dir=None,
+                       tmp_dir=None,
+                       slots=None,
+                       segment=None):
+        '''
+            segment: (first, end) to only create checkpoints first up to end
+                     of the counted_instructions checkpoints, see
+                     GDBEngine.run_segment.
+            work_dir: Where to run gdb (and so the program) from, with its
+                      own TMPDIR. Defaults to the current directory.
+            tmp_dir: TMPDIR, if not work_dir/tmp.
+            slots: A WorkerSlots which bounds the background workers of
+                   every session using it together.
+        '''
 
         set_arg_string = 'set $args = "{}"'.format(' '.join(arg_list))
         print(set_arg_string)
-        self.args = ['gdb', '--batch', '-ex', set_arg_string, '-x', __file__]
+        self.args = ['gdb', '--batch', '-ex', set_arg_string,
+                     '-x', str(Path(__file__).resolve())]
+        self.work_dir = work_dir
 
         env = copy.deepcopy(os.environ)
 
         if checkpoint_instructions is not None:
             env['CHECKPOINT_INSTS']    = str(checkpoint_instructions)
+        elif counted_instructions is not None:
+            env['CHECKPOINT_COUNTED_INSTS'] = str(counted_instructions)
+            if segment is not None:
+                env['CHECKPOINT_SEGMENT'] = '{} {}'.format(*segment)
+            # To fall back on without hardware counters.
+            env['CHECKPOINT_INTERVAL'] = str(checkpoint_interval)
         elif checkpoint_locations is not None:
             env['CHECKPOINT_LOCS']     = ' '.join(checkpoint_locations)
         elif checkpoint_interval is not None:
@@ -66,19 +99,47 @@ class GDBProcess:
         env['CHECKPOINT_COMPRESS']   = str(compress)
         env['CHECKPOINT_CONVERT']    = str(convert)
         env['CHECKPOINT_KEYFRAMES']  = str(keyframes)
+        env['CHECKPOINT_DEDUP']      = str(dedup)
+        env['CHECKPOINT_CODEC']      = str(codec)
+        env['CHECKPOINT_COMPRESS_WORKERS'] = str(compress_workers)
+        env['CHECKPOINT_PROFILE']    = str(profile_phases)
+        env['CHECKPOINT_FORK']       = str(fork_capture)
+        env['CHECKPOINT_DIRECT']     = str(direct_capture)
         # By setting the python path, we preserve the import paths of the 
         # virtual environment, as sys.path is populated in part from the 
         # $PYTHONPATH environment variable.
         env['PYTHONPATH']            = ':'.join(sys.path)
 
+        if tmp_dir is None and work_dir is not None:
+            tmp_dir = Path(work_dir) / 'tmp'
+        if tmp_dir is not None:
+            Path(tmp_dir).mkdir(parents=True, exist_ok=True)
+            env['TMPDIR'] = str(tmp_dir)
+        if slots is not None:
+            env[WorkerSlots.ENV] = slots.to_env()
+
         if ld_path is not None:
             assert ld_path.exists()
             env['CUSTOM_LD'] = str(ld_path)
 
         self.env = env
 
-    def run(self):
-        subprocess.run(self.args, env=self.env)
+    def run(self, prefix=None):
+        '''
+            If prefix is given, each line of output is printed with it, so
+            that sessions running side by side can be told apart.
+        '''
+        if prefix is None:
+            return subprocess.run(self.args, env=self.env,
+                                  cwd=self.work_dir).returncode
+
+        env = dict(self.env, PYTHONUNBUFFERED='1')
+        proc = Popen(self.args, env=env, cwd=self.work_dir,
+                     stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                     universal_newlines=True, errors='replace')
+        for line in proc.stdout:
+            print('[{}] {}'.format(prefix, line), end='', flush=True)
+        return proc.wait()
 
 
 def add_arguments(parser):
@@ -86,15 +147,49 @@ def add_arguments(parser):
         help='Run a custom command instead of a SPEC benchmark', nargs='*')
     parser.add_argument('--compress', default=False, action='store_true',
         help='Compress corefile or not.')
+    parser.add_argument('--codec', default='gzip', choices=list(CODECS.keys()),
+        help='What to compress corefiles with. zstd is multi-threaded.')
+    parser.add_argument('--compress-workers', default=2, type=int,
+        help=('Maximum number of corefiles to compress at once. Checkpointing '
+              'pauses if compression falls further behind than this.'))
     parser.add_argument('--no-convert', action='store_true',
-        help='Do not convert checkpoints in the backgroud')
+        help=('Do not convert checkpoints in the backgroud. "lapidary '
+              'parallel-simulate" then converts each checkpoint the first '
+              'time it is simulated.'))
+    parser.add_argument('--dedup', default=False, action='store_true',
+        help=('Convert checkpoints into a page store shared by all checkpoints '
+              'of the benchmark instead of full pmem files.'))
+    parser.add_argument('--fork-capture', default=False, action='store_true',
+        help=('Fork a snapshot of the program for each checkpoint and dump '
+              'its memory in the background, instead of pausing the program '
+              'for gcore. At most --compress-workers snapshots are kept.'))
+    parser.add_argument('--direct', default=False, action='store_true',
+        help=('Write pmem files (or manifests, or diffs) straight from the '
+              'program\'s memory, without a core file or a separate '
+              'conversion. --compress and --no-convert have no effect.'))
+    parser.add_argument('--profile-phases', default=False, action='store_true',
+        help=('Count hardware events between checkpoints with perf, so that '
+              '"lapidary simpoints" can pick representative checkpoints.'))
+    parser.add_argument('--jobs', '-j', default=1, type=int,
+        help=('Checkpoint this many benchmarks at once, each from its own '
+              'create_<benchmark> directory. --compress-workers then bounds '
+              'the compression and conversion workers of all of them.'))
+    parser.add_argument('--segments', default=1, type=int,
+        help=('With --insts, run the program natively once to count its '
+              'instructions, then split its checkpoints into this many '
+              'segments which are created at once, each session running '
+              'natively to the start of its own. The program has to run the '
+              'same every time, and not read back what it writes. Each '
+              'segment of a benchmark runs in its own copy of '
+              'create_<benchmark>; those of a --cmd share the current '
+              'directory, so it must be safe to run several times at once.'))
     parser.add_argument('--max-checkpoints', '-m', default=-1, type=int,
         help='Create a maximum number of checkpoints. -1 for unlimited')
     parser.add_argument('--debug-mode', default=False, action='store_true',
         help='For debugging program execution, run IPython after checkpointing.')
     parser.add_argument('--directory', '-d', default=None,
         help='The parent directory of the output checkpoint directories.')
-    parser.add_argument('--keyframes', '-k', default=5, type=int, nargs=1,
+    parser.add_argument('--keyframes', '-k', default=5, type=int,
         help=('Create a checkpoint "keyframe" every N checkpoints, with the '
               'rest of the checkpoints being diffs off of these keyframes in '
               'order to save space. Default is every 5 checkpoints. Set to 0 '
@@ -104,6 +199,10 @@ def add_arguments(parser):
     group.add_argument('--stepi', '-s', nargs='?', type=int,
         help=('Rather than stepping by time, '
           'create checkpoints by number of instructions.'))
+    group.add_argument('--insts', type=int, default=None,
+        help=('Create a checkpoint every N instructions, counted by a hardware '
+              'performance counter. Falls back to a checkpoint every second '
+              'where counters are not available.'))
     group.add_argument('--interval', type=float, default=1.0,
         help='How often to stop and take a checkpoint.')
     group.add_argument('--breakpoints', type=str, nargs='*',
@@ -124,11 +223,29 @@ def gdb_main():
     compress_core_files = os.environ['CHECKPOINT_COMPRESS'] == 'True'
     convert_checkpoints = os.environ['CHECKPOINT_CONVERT'] == 'True'
     keyframes           = os.environ['CHECKPOINT_KEYFRAMES']
+    dedup_checkpoints   = os.environ['CHECKPOINT_DEDUP'] == 'True'
+    codec               = os.environ['CHECKPOINT_CODEC']
+    compress_workers    = int(os.environ['CHECKPOINT_COMPRESS_WORKERS'])
+    profile_phases      = os.environ['CHECKPOINT_PROFILE'] == 'True'
+    fork_capture        = os.environ['CHECKPOINT_FORK'] == 'True'
+    direct_capture      = os.environ['CHECKPOINT_DIRECT'] == 'True'
 
     engine = GDBEngine(checkpoint_root_dir, compress_core_files,
-                       convert_checkpoints)
-
-    if 'CHECKPOINT_INTERVAL' in os.environ:
+                       convert_checkpoints, dedup_checkpoints, codec,
+                       compress_workers, profile_phases, fork_capture,
+                       direct_capture)
+
+    if 'CHECKPOINT_SEGMENT' in os.environ:
+        counted_instructions = int(os.environ['CHECKPOINT_COUNTED_INSTS'])
+        first_chk, end_chk   = map(int, os.environ['CHECKPOINT_SEGMENT'].split())
+        engine.run_segment(counted_instructions, first_chk, end_chk,
+                           keyframes, debug_mode)
+    elif 'CHECKPOINT_COUNTED_INSTS' in os.environ:
+        counted_instructions = int(os.environ['CHECKPOINT_COUNTED_INSTS'])
+        checkpoint_interval  = float(os.environ['CHECKPOINT_INTERVAL'])
+        engine.run_counted(counted_instructions, checkpoint_interval,
+                           max_checkpoints, keyframes, debug_mode)
+    elif 'CHECKPOINT_INTERVAL' in os.environ:
         checkpoint_interval = float(os.environ['CHECKPOINT_INTERVAL'])
         engine.run_time(checkpoint_interval, max_checkpoints, keyframes, debug_mode)
     elif 'CHECKPOINT_INSTS' in os.environ:
@@ -186,52 +303,162 @@ def modify_binary_ldd(config, old_bin):
 
     return old_bin
 
+def _create_benchmark(args, benchmark, work_dir=None):
+    ''' Sets up benchmark's inputs in work_dir, if given. '''
+    cwd = os.getcwd()
+    if work_dir is not None:
+        os.chdir(str(work_dir))
+    try:
+        return SpecBench(args.config).create(
+            args.suite, benchmark, args.input_type)
+    finally:
+        os.chdir(cwd)
+
+def _copy_work_dir(work_dir, index):
+    '''
+        A copy of work_dir (i.e. of the benchmark's inputs) for one of the
+        segments which run at the same time, so that they don't overwrite
+        each other's outputs.
+    '''
+    copy_dir = work_dir.parent / '{}_{}'.format(work_dir.name, index)
+    if copy_dir.exists():
+        shutil.rmtree(str(copy_dir))
+    shutil.copytree(str(work_dir), str(copy_dir), symlinks=True,
+                    ignore=shutil.ignore_patterns('tmp'))
+    return copy_dir
+
+def get_segments(total_insts, insts_between_chk, num_segments, keyframes,
+                 max_checkpoints=-1):
+    '''
+        Splits the checkpoints of a run of total_insts instructions into
+        num_segments (first, end) ranges, each starting on a keyframe. The
+        last segment runs to the end of the program unless max_checkpoints
+        says otherwise.
+    '''
+    num_chks = max(1, total_insts // insts_between_chk)
+    if max_checkpoints >= 0:
+        num_chks = min(num_chks, max_checkpoints)
+    per_segment = -(-num_chks // max(1, num_segments))
+    if keyframes > 0:
+        per_segment = -(-per_segment // keyframes) * keyframes
+
+    segments = [ [first, first + per_segment]
+                 for first in range(0, num_chks, per_segment) ]
+    segments[-1][1] = num_chks if max_checkpoints >= 0 else -1
+    return [ tuple(segment) for segment in segments ]
+
+def _create_gdbprocs(args, name, arg_list, directory, work_dir=None,
+                     slots=None):
+    ''' Returns [ (name, GDBProcess) ], one per segment. '''
+    kwargs = dict(checkpoint_interval=args.interval,
+                  checkpoint_instructions=args.stepi,
+                  counted_instructions=args.insts,
+                  checkpoint_locations=args.breakpoints,
+                  max_checkpoints=args.max_checkpoints,
+                  root_dir=Path(directory).resolve(),
+                  compress=args.compress,
+                  convert=not args.no_convert,
+                  debug_mode=args.debug_mode,
+                  keyframes=args.keyframes,
+                  dedup=args.dedup,
+                  codec=args.codec,
+                  compress_workers=args.compress_workers,
+                  profile_phases=args.profile_phases,
+                  fork_capture=args.fork_capture,
+                  direct_capture=args.direct,
+                  work_dir=work_dir,
+                  slots=slots)
+    if args.segments <= 1:
+        return [(name, GDBProcess(arg_list, **kwargs))]
+
+    print('Counting the instructions of {}...'.format(name))
+    try:
+        total_insts = count_instructions(arg_list, work_dir)
+    except OSError as e:
+        raise Exception('--segments needs hardware performance counters: {}'.format(e))
+    segments = get_segments(total_insts, args.insts, args.segments,
+                            args.keyframes, args.max_checkpoints)
+    print('{} runs {} instructions, checkpointing it in {} segments.'.format(
+        name, total_insts, len(segments)))
+    gdbprocs = []
+    for i, segment in enumerate(segments):
+        if work_dir is not None:
+            kwargs['work_dir'] = _copy_work_dir(work_dir, i)
+        else:
+            # A custom command's paths are relative to the current
+            # directory, so only its temporary files can be kept apart.
+            kwargs['tmp_dir'] = Path('create_{}_{}'.format(name, i)).resolve() / 'tmp'
+        gdbprocs += [ ('{}:{}'.format(name, i),
+                       GDBProcess(arg_list, segment=segment, **kwargs)) ]
+    return gdbprocs
+
+def _run_segments(segments, max_sessions):
+    ''' Runs a benchmark's segments. Returns the names of those which failed. '''
+    with ThreadPoolExecutor(max_workers=max_sessions) as pool:
+        futures = { name: pool.submit(gdbproc.run, name)
+                    for name, gdbproc in segments }
+        return [ name for name, future in futures.items()
+                 if future.result() != 0 ]
+
 def main(args):
     if args.cmd and args.bench:
         raise Exception('Can only pick one!')
+    if args.segments > 1 and args.insts is None:
+        raise Exception('--segments needs --insts!')
 
     arg_list = []
     gdbprocs = []
+    slots    = None
     if args.cmd:
+        if args.segments > 1:
+            slots = WorkerSlots(mkdtemp(prefix='lapidary_slots_'),
+                                args.compress_workers)
         args.cmd[0] = modify_binary_ldd(args.config, args.cmd[0])
 
         arg_list = args.cmd
         directory = args.directory if args.directory is not None else '.'
-        gdbproc = GDBProcess(arg_list,
-                             checkpoint_interval=args.interval,
-                             checkpoint_instructions=args.stepi,
-                             checkpoint_locations=args.breakpoints,
-                             max_checkpoints=args.max_checkpoints,
-                             root_dir=directory,
-                             compress=args.compress,
-                             convert=not args.no_convert,
-                             debug_mode=args.debug_mode,
-                             keyframes=args.keyframes)
-        gdbprocs = [gdbproc]
+        gdbprocs = [ _create_gdbprocs(args, Path(arg_list[0]).name, arg_list,
+                                      directory, slots=slots) ]
     else:
         benchmarks = SpecBench.get_benchmarks(args)
+        # Every session that can run at the same time as another gets a
+        # directory of its own, segments included (see _create_gdbprocs).
+        isolate    = (args.jobs > 1 and len(benchmarks) > 1) or args.segments > 1
+        if isolate:
+            slots = WorkerSlots(mkdtemp(prefix='lapidary_slots_'),
+                                args.compress_workers)
         for benchmark in benchmarks:
             print('Setting up process for {}...'.format(benchmark))
-            bench = SpecBench(args.config).create(
-                                        args.suite, benchmark, args.input_type)
-            mod_bin = modify_binary_ldd(args.config, str(bench.binary))
+            work_dir = None
+            if isolate:
+                # Benchmarks copy their inputs into the current directory.
+                work_dir = Path('create_{}'.format(benchmark)).resolve()
+                work_dir.mkdir(exist_ok=True)
+            bench = _create_benchmark(args, benchmark, work_dir)
+            mod_bin = modify_binary_ldd(args.config, str(bench.binary.resolve()))
             arg_list = [mod_bin] + bench.args
 
             directory = args.directory if args.directory is not None else args.config['spec2017_config']['workspace_path']
-            gdbproc = GDBProcess(arg_list,
-                                 checkpoint_interval=args.interval,
-                                 checkpoint_instructions=args.stepi,
-                                 checkpoint_locations=args.breakpoints,
-                                 max_checkpoints=args.max_checkpoints,
-                                 root_dir=directory,
-                                 compress=args.compress,
-                                 convert=not args.no_convert,
-                                 debug_mode=args.debug_mode,
-                                 keyframes=args.keyframes)
-            gdbprocs += [gdbproc]
-
-    for gdbproc in gdbprocs:
-        gdbproc.run()
+            gdbprocs += [ _create_gdbprocs(args, benchmark, arg_list, directory,
+                                           work_dir, slots) ]
+
+    if slots is None:
+        for segments in gdbprocs:
+            for _, gdbproc in segments:
+                gdbproc.run()
+        return
+
+    try:
+        # Up to --jobs benchmarks at a time, each running its segments.
+        with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+            futures = [ pool.submit(_run_segments, segments, args.segments)
+                        for segments in gdbprocs ]
+            failed  = sum([ future.result() for future in futures ], [])
+    finally:
+        shutil.rmtree(str(slots.directory), ignore_errors=True)
+
+    if failed:
+        print('Checkpointing failed for: {}'.format(', '.join(sorted(failed))))
 
 if __name__ == '__main__':
     try:
@@ -53,6 +53,22 @@ class LapidaryTools:
 
         return lambda args: GDBProcess.main(args)
 
+    @staticmethod
+    @ToolDecorator("simpoints")
+    def add_simpoints_args(parser):
+        from lapidary.checkpoint import SimPoints
+        SimPoints.add_args(parser)
+
+        return lambda args: SimPoints.main(args)
+
+    @staticmethod
+    @ToolDecorator("catalog")
+    def add_catalog_args(parser):
+        from lapidary.checkpoint import Catalog
+        Catalog.add_args(parser)
+
+        return lambda args: Catalog.main(args)
+
     @staticmethod
     @ToolDecorator("simulate")
     def add_simulate_args(parser):
@@ -69,6 +85,14 @@ class LapidaryTools:
 
         return lambda args: ParallelSim.main(args)
 
+    @staticmethod
+    @ToolDecorator("simulate-worker")
+    def add_simulate_worker_args(parser):
+        from lapidary.simulate.RemoteExecutor import SimulationWorker
+        SimulationWorker.add_args(parser)
+
+        return lambda args: SimulationWorker.main(args)
+
     @staticmethod
     @ToolDecorator("report")
     def add_report_args(parser):
@@ -13,9 +13,10 @@ class StatsFile:
 
     def __del__(self):
         '''
-            The accumulated stats file can actually get quite large, since we 
-            just dump the file several hundred times as we count instructions.
-            This will ensure it doesn't linger and absorb the entire disk.
+            The accumulated stats file can actually get quite large, since every
+            dump appends the entire stat tree to it. Progress polling goes
+            through get_progress_stats, but this will still ensure it doesn't
+            linger and absorb the entire disk.
         '''
         if self.file_path.exists():
             self.file_path.unlink()
@@ -34,16 +35,35 @@ class StatsFile:
             for line in fd:
                 if '--------' in line or len(line.strip()) == 0:
                     continue
-                pieces = [x for x in line.split(' ') if len(x.strip()) > 0]
+                pieces = line.split(None, 2)
                 if len(pieces) > 1:
-                    key = pieces[0].strip()
-                    val = pieces[1].strip()
-                    stats[key] = val
+                    stats[pieces[0]] = pieces[1]
 
             self.current_offset = fd.tell()
         self.cached_stats = stats
         return stats
 
+    # Stats which can be read straight from the simulator, without a dump.
+    PROGRESS_STATS = {
+        'sim_insts': lambda system, m5: sum(cpu.totalInsts() for cpu in system.cpu),
+        'sim_ticks': lambda system, m5: m5.curTick(),
+    }
+
+    def get_progress_stats(self, system, names=('sim_insts',)):
+        '''
+            A lightweight alternative to get_current_stats for polling
+            progress during simulation. Rather than dumping every stat to
+            stats.txt and parsing it back, this reads the few requested
+            counters directly from the simulator.
+        '''
+        import m5
+        stats = {}
+        for name in names:
+            if name not in self.PROGRESS_STATS:
+                raise Exception('{} cannot be read without a stats dump!'.format(name))
+            stats[name] = self.PROGRESS_STATS[name](system, m5)
+        return stats
+
 def parse_perf_output_insts(stderr_str):
     inst_pattern = re.compile('([0-9\,]+)\s*instructions')
 
@@ -91,6 +111,107 @@ def parse_mem_size_string(mem_size_str):
 
     return mem_size
 
+class RunningStat:
+    '''
+        Running mean and variance of a stat (Welford's algorithm), with the
+        same 95% confidence interval the report uses.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean  = 0.0
+        self.m2    = 0.0
+
+    def add(self, value):
+        self.count += 1
+        delta       = value - self.mean
+        self.mean  += delta / self.count
+        self.m2    += delta * (value - self.mean)
+
+    def std(self):
+        if self.count == 0:
+            return 0.0
+        return (self.m2 / self.count) ** 0.5
+
+    def ci(self):
+        if self.count == 0:
+            return float('inf')
+        return 1.96 * self.std() / (self.count ** 0.5)
+
+    def ci_percent(self):
+        if self.mean == 0:
+            return float('inf')
+        return 100.0 * self.ci() / abs(self.mean)
+
+    def count_for_ci_percent(self, target):
+        '''
+            How many samples it should take for the CI to shrink to target%
+            of the mean, assuming the standard deviation holds.
+        '''
+        if self.mean == 0:
+            return self.count
+        return int((1.96 * self.std() * 100.0 / (target * abs(self.mean))) ** 2) + 1
+
+class WorkerSlots:
+    '''
+        A counting semaphore shared by unrelated processes, e.g. several
+        "lapidary create" sessions bounding their background workers together.
+        Each slot is a lock file in directory, held for as long as it is
+        flock'd, so the slots of a process that dies are given back with it.
+    '''
+
+    ENV = 'LAPIDARY_WORKER_SLOTS'
+
+    def __init__(self, directory, count):
+        self.directory = Path(directory)
+        self.count     = max(1, int(count))
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def try_acquire(self):
+        ''' Returns an open slot file, or None if every slot is taken. '''
+        import fcntl
+        for i in range(self.count):
+            slot = (self.directory / 'slot{}.lock'.format(i)).open('a')
+            try:
+                fcntl.flock(slot.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except (BlockingIOError, PermissionError):
+                slot.close()
+        return None
+
+    def acquire(self, poll_interval=0.1):
+        slot = self.try_acquire()
+        while slot is None:
+            sleep(poll_interval)
+            slot = self.try_acquire()
+        return slot
+
+    @staticmethod
+    def release(slot):
+        # Subprocesses which inherited the slot keep it until they exit.
+        slot.close()
+
+    def to_env(self):
+        return '{}:{}'.format(self.count, self.directory)
+
+    @classmethod
+    def from_env(cls, environ=None):
+        import os
+        environ = environ if environ is not None else os.environ
+        if cls.ENV not in environ:
+            return None
+        count, directory = environ[cls.ENV].split(':', 1)
+        return cls(directory, int(count))
+
+def run_in_slot(slots, fn, *args):
+    ''' Runs fn(*args) once one of slots is free, if slots isn't None. '''
+    if slots is None:
+        return fn(*args)
+    slot = slots.acquire()
+    try:
+        return fn(*args)
+    finally:
+        WorkerSlots.release(slot)
+
 def select_at_random(list_of_things, num_to_select):
     import random
     return random.sample(list_of_things, num_to_select)
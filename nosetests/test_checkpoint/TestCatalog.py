@@ -0,0 +1,52 @@
+from lapidary.checkpoint.Catalog import Catalog
+from lapidary.checkpoint.CheckpointConvert import convert_checkpoint
+
+from nosetests.test_checkpoint.TestCheckpointConvert import make_checkpoint, \
+                                                            PGSIZE
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import shutil
+
+def test_scan_and_convert():
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        checkpoints = [ make_checkpoint(root / '{}_check.cpt'.format(i),
+                                        [(0x400000, bytes([i + 1]) * PGSIZE)])
+                        for i in range(3) ]
+        (root / '10_check.cpt').mkdir()
+
+        catalog = Catalog(root)
+        assert catalog.checkpoints() == \
+            [ c.checkpoint_directory for c in checkpoints ]
+        assert catalog.records()['0_check.cpt']['format'] == 'core'
+        assert catalog.records()['0_check.cpt']['mem_size'] == \
+            checkpoints[0].get_mappings()['mem_size']
+
+        convert_checkpoint(checkpoints[0], False)
+        record = catalog.records()['0_check.cpt']
+        assert record['format'] == 'pmem'
+        assert record['size'] == checkpoints[0].get_mappings()['mem_size']
+        assert record['checksums'] == checkpoints[0].get_checksums()
+
+        catalog.update('1_check.cpt', sim_o3='successful')
+        assert catalog.records()['1_check.cpt']['format'] == 'core'
+        assert catalog.records()['1_check.cpt']['sim_o3'] == 'successful'
+
+def test_rescan():
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        for i in range(2):
+            make_checkpoint(root / '{}_check.cpt'.format(i),
+                            [(0x400000, bytes(PGSIZE))])
+        catalog = Catalog(root)
+        catalog.scan()
+        catalog.update('0_check.cpt', valid=False)
+        assert len(catalog.checkpoints()) == 1
+
+        shutil.rmtree(str(root / '1_check.cpt'))
+        records = catalog.rescan()
+        assert list(records.keys()) == ['0_check.cpt']
+        assert catalog.checkpoints() == [root / '0_check.cpt']
+        with catalog.catalog_file.open() as f:
+            assert len(f.readlines()) == 1
@@ -0,0 +1,204 @@
+from lapidary.checkpoint.Checkpoints import GDBCheckpoint, Gem5DiffCheckpoint
+from lapidary.checkpoint.CheckpointConvert import GDBCheckpointConverter, \
+    convert_checkpoint, materialize_checkpoint, MaterializedCheckpoint
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import gzip
+import json
+import os
+import resource
+import struct
+
+PGSIZE = resource.getpagesize()
+
+def write_core(path, segments):
+    '''
+        Write a minimal ELF core file. segments is a list of (vaddr, data)
+        pairs, each of which becomes a PT_LOAD segment.
+    '''
+    phoff = 64
+    data_off = phoff + 56 * len(segments)
+    data_off += (-data_off) % PGSIZE
+
+    ident = b'\x7fELF' + bytes([2, 1, 1, 0]) + bytes(8)
+    header = ident + struct.pack('<HHIQQQIHHHHHH', 4, 62, 1, 0, phoff, 0, 0,
+                                 64, 56, len(segments), 64, 0, 0)
+    phdrs = b''
+    offset = data_off
+    for vaddr, data in segments:
+        phdrs += struct.pack('<IIQQQQQQ', 1, 6, offset, vaddr, 0, len(data),
+                             len(data), PGSIZE)
+        offset += len(data)
+
+    with path.open('wb') as f:
+        f.write(header + phdrs)
+        f.seek(data_off)
+        for _, data in segments:
+            f.write(data)
+
+def write_mappings(path, regions, mem_size):
+    mappings = {'mem_size': mem_size}
+    paddr = PGSIZE
+    for index, (vaddr, size) in enumerate(regions):
+        mappings[vaddr] = {'index': index, 'paddr': paddr, 'vaddr': vaddr,
+                           'size': size, 'offset': 0, 'flags': 0,
+                           'name': '[anon]'}
+        paddr += size
+    with path.open('w') as f:
+        json.dump(mappings, f)
+
+def make_checkpoint(directory, segments):
+    directory.mkdir(parents=True, exist_ok=True)
+    write_core(directory / GDBCheckpoint.GDB_CORE_FILE, segments)
+    regions = [ (vaddr, len(data)) for vaddr, data in segments ]
+    mem_size = 2 * (PGSIZE + sum(len(d) for _, d in segments))
+    write_mappings(directory / GDBCheckpoint.MAPPINGS_JSON, regions, mem_size)
+    return GDBCheckpoint(directory)
+
+def test_create_pmem_file():
+    segments = [
+        (0x400000, b'\x01' * PGSIZE + bytes(PGSIZE) + b'\x02' * PGSIZE),
+        (0x7ff000, bytes(2 * PGSIZE)),
+    ]
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt', segments)
+        converter = GDBCheckpointConverter(checkpoint)
+        converter.CHUNK_SIZE = PGSIZE
+        pmem = converter.create_pmem_file()
+
+        mappings = checkpoint.get_mappings()
+        with pmem.open('rb') as f:
+            image = f.read()
+        assert len(image) == mappings['mem_size']
+
+        for vaddr, data in segments:
+            paddr = mappings[vaddr]['paddr']
+            assert image[paddr:paddr + len(data)] == data
+
+        # Only the two non-zero pages should have been allocated.
+        assert os.stat(str(pmem)).st_blocks * 512 <= 4 * PGSIZE
+
+def test_page_store_dedup():
+    shared = b'\x03' * PGSIZE
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        first = make_checkpoint(root / '0_check.cpt',
+                                [(0x400000, shared + b'\x04' * PGSIZE)])
+        second = make_checkpoint(root / '1_check.cpt',
+                                 [(0x400000, shared + b'\x05' * PGSIZE)])
+
+        for checkpoint in (first, second):
+            GDBCheckpointConverter(checkpoint).create_page_manifest()
+            assert checkpoint.manifest_file_exists()
+            assert not checkpoint.pmem_file_exists()
+
+        # Three unique pages between both checkpoints.
+        store = second.get_page_store()
+        assert store.data_file.stat().st_size == 3 * PGSIZE
+
+        for checkpoint, data in ((first, b'\x04'), (second, b'\x05')):
+            assert materialize_checkpoint(checkpoint.checkpoint_directory)
+            paddr = checkpoint.get_mappings()[0x400000]['paddr']
+            with checkpoint.pmem_file.open('rb') as f:
+                image = f.read()
+            assert len(image) == checkpoint.get_mappings()['mem_size']
+            assert image[paddr:paddr + 2 * PGSIZE] == shared + data * PGSIZE
+
+def test_keyframe_diff():
+    heap = b'\x06' * PGSIZE + b'\x07' * PGSIZE + bytes(PGSIZE)
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        keyframe = make_checkpoint(root / '0_check.cpt', [(0x600000, heap)])
+        assert convert_checkpoint(keyframe, False) == keyframe.pmem_file
+
+        # A new mapping shifts the heap's physical address, and one page of
+        # the heap changes.
+        new_heap = heap[:PGSIZE] + b'\x08' * PGSIZE + heap[2 * PGSIZE:]
+        segments = [(0x500000, b'\x09' * PGSIZE), (0x600000, new_heap)]
+        checkpoint = make_checkpoint(root / '1_check.cpt', segments)
+        checkpoint.set_keyframe(keyframe.checkpoint_directory)
+
+        diff_file = convert_checkpoint(checkpoint, False)
+        diff_checkpoint = Gem5DiffCheckpoint(checkpoint.checkpoint_directory)
+        assert diff_file == diff_checkpoint.pmem_diff_file
+        assert diff_checkpoint.is_valid_checkpoint()
+        assert not checkpoint.gdb_core_file.exists()
+        assert diff_file.stat().st_size < 3 * PGSIZE
+
+        assert materialize_checkpoint(checkpoint.checkpoint_directory)
+        mappings = checkpoint.get_mappings()
+        with checkpoint.pmem_file.open('rb') as f:
+            image = f.read()
+        assert len(image) == mappings['mem_size']
+        for vaddr, data in segments:
+            paddr = mappings[vaddr]['paddr']
+            assert image[paddr:paddr + len(data)] == data
+
+def test_gzip_keyframe_diff():
+    heap = b'\x0b' * PGSIZE + bytes(PGSIZE) + b'\x0c' * PGSIZE
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        keyframe = make_checkpoint(root / '0_check.cpt', [(0x600000, heap)])
+        pmem = convert_checkpoint(keyframe, False)
+        # Keyframes are gzipped in place, under their original name.
+        raw = pmem.read_bytes()
+        with gzip.open(str(pmem), 'wb') as f:
+            f.write(raw)
+
+        new_heap = heap[:2 * PGSIZE] + b'\x0d' * PGSIZE
+        checkpoint = make_checkpoint(root / '1_check.cpt', [(0x600000, new_heap)])
+        checkpoint.set_keyframe(keyframe.checkpoint_directory)
+        convert_checkpoint(checkpoint, False)
+
+        assert materialize_checkpoint(checkpoint.checkpoint_directory)
+        paddr = checkpoint.get_mappings()[0x600000]['paddr']
+        with checkpoint.pmem_file.open('rb') as f:
+            image = f.read()
+        assert image[paddr:paddr + len(new_heap)] == new_heap
+        # The decompressed keyframe should not have been left behind.
+        assert not any(p.name.startswith('tmp')
+                       for p in keyframe.checkpoint_directory.iterdir())
+
+def test_materialize_from_core():
+    segments = [(0x400000, b'\x0a' * PGSIZE)]
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt', segments)
+        with MaterializedCheckpoint(checkpoint.checkpoint_directory):
+            assert checkpoint.pmem_file_exists()
+        # Converted once and kept.
+        assert checkpoint.pmem_file_exists()
+
+class FailingConverter(GDBCheckpointConverter):
+    def _write_image(self, sink):
+        sink.write(0, b'\x01' * PGSIZE)
+        raise Exception('Killed')
+
+def test_failed_pmem_not_kept():
+    segments = [(0x400000, b'\x0a' * PGSIZE)]
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt', segments)
+        try:
+            FailingConverter(checkpoint).create_pmem_file()
+            assert False
+        except Exception as e:
+            assert str(e) == 'Killed'
+        assert not checkpoint.pmem_file_exists()
+        assert not [ f for f in checkpoint.checkpoint_directory.iterdir()
+                     if 'pmem' in f.name ]
+
+def test_materialized_shared():
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt',
+                                     [(0x400000, b'\x0b' * PGSIZE)])
+        GDBCheckpointConverter(checkpoint).create_page_manifest()
+        directory = checkpoint.checkpoint_directory
+
+        first = MaterializedCheckpoint(directory)
+        first.__enter__()
+        with MaterializedCheckpoint(directory):
+            assert checkpoint.pmem_file_exists()
+        # Still in use by the first holder.
+        assert checkpoint.pmem_file_exists()
+        first.__exit__(None, None, None)
+        assert not checkpoint.pmem_file_exists()
@@ -0,0 +1,70 @@
+from lapidary.checkpoint.Compression import Codec, CompressionPool, get_codec
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import gzip
+import shutil
+
+def test_gzip_keep_name():
+    with TemporaryDirectory() as d:
+        f = Path(d) / 'system.physmem.store0.pmem'
+        f.write_bytes(b'lapidary' * 4096)
+
+        pool = CompressionPool('gzip', max_workers=1)
+        pool.submit(f, keep_name=True)
+        assert pool.wait() == [f]
+
+        assert f.exists()
+        with gzip.open(str(f), 'rb') as g:
+            assert g.read() == b'lapidary' * 4096
+        assert 'Compressed 1 files' in pool.report()
+
+def test_failed_job():
+    codec = Codec('false', '.false', lambda threads: ['false'], ['cat'])
+    with TemporaryDirectory() as d:
+        f = Path(d) / 'gdb.core'
+        f.write_bytes(bytes(4096))
+
+        pool = CompressionPool(codec, max_workers=1)
+        pool.submit(f)
+        assert pool.wait() == []
+        assert pool.failed == [f]
+        assert f.exists()
+        assert pool.report() == 'No files compressed.'
+
+def test_back_pressure():
+    codec = 'zstd' if shutil.which('zstd') else 'gzip'
+    with TemporaryDirectory() as d:
+        pool = CompressionPool(codec, max_workers=1, max_pending=1)
+        files = []
+        for i in range(4):
+            f = Path(d) / 'gdb.core.{}'.format(i)
+            f.write_bytes(bytes(1024 * 1024))
+            files += [f]
+            pool.submit(f)
+            assert len(pool.queue) <= 1
+        pool.wait()
+        assert len(pool) == 0
+        for f in files:
+            assert not f.exists()
+            assert get_codec(codec).compressed_path(f).exists()
+
+def test_shared_slots():
+    from lapidary.utils.Utils import WorkerSlots
+    with TemporaryDirectory() as d:
+        slots = WorkerSlots(Path(d) / 'slots', 1)
+        held  = WorkerSlots.from_env({ WorkerSlots.ENV: slots.to_env() })
+        slot  = held.try_acquire()
+        assert slot is not None
+        assert slots.try_acquire() is None
+
+        f = Path(d) / 'gdb.core'
+        f.write_bytes(bytes(4096))
+        pool = CompressionPool('gzip', max_workers=2, slots=slots)
+        pool.submit(f)
+        assert len(pool.running) == 0
+
+        WorkerSlots.release(slot)
+        pool.wait()
+        assert not f.exists()
+        assert slots.try_acquire() is not None
@@ -0,0 +1,58 @@
+from lapidary.checkpoint.CheckpointTemplate import MemoryMapping, MappingTable, \
+                                                  fill_checkpoint_template, \
+                                                  write_page_table, \
+                                                  PAGE_TABLE_ENTRY
+
+from io import StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import resource
+
+PGSIZE = resource.getpagesize()
+
+def _table():
+    return MappingTable([
+        MemoryMapping(2, 3 * PGSIZE, 0x7f0000, 2 * PGSIZE, 0, 0, '[stack]'),
+        MemoryMapping(0, 0, 0, PGSIZE, 0, 0, 'null'),
+        MemoryMapping(1, PGSIZE, 0x400000, 2 * PGSIZE, 0, 0, 'a.out'),
+    ])
+
+def test_find():
+    mappings = _table()
+    assert list(mappings) == [0, 0x400000, 0x7f0000]
+    assert mappings.find(0x400000 + PGSIZE + 8).name == 'a.out'
+    assert mappings.find(0x400000 + 2 * PGSIZE) is None
+    assert 0x7f0000 in mappings
+    # Like the dict it replaces, only the starts of regions are keys.
+    assert 0x7f0000 + 8 not in mappings
+    assert mappings[0x400000].index == 1
+
+PAGES = [
+    (0, 0),
+    (0x400000, PGSIZE), (0x400000 + PGSIZE, 2 * PGSIZE),
+    (0x7f0000, 3 * PGSIZE), (0x7f0000 + PGSIZE, 4 * PGSIZE)]
+
+def test_pages():
+    mappings = _table()
+    assert mappings.num_pages() == 5
+
+    with TemporaryDirectory() as d:
+        output_file = Path(d) / 'm5.cpt'
+        fill_checkpoint_template(output_file=str(output_file),
+                                 mappings=mappings,
+                                 stack_mapping=mappings[0x7f0000])
+        text = output_file.read_text()
+        assert 'ptable.size=5\n\n\n[system.cpu.workload.Entry0]\n' in text
+        assert 'flags=0\n\n\n[system.cpu.tracer]' in text
+        assert 'pagePtr=5\n' in text
+        assert '[system.cpu.workload.Entry4]\nvaddr={}\npaddr={}\n'.format(
+            0x7f0000 + PGSIZE, 4 * PGSIZE) in text
+
+def test_page_table_batches():
+    mappings = _table()
+    expected = ''.join(PAGE_TABLE_ENTRY % (i, v, p)
+                       for i, (v, p) in enumerate(PAGES))
+    for batch_size in [1, 2, 3, 1024]:
+        f = StringIO()
+        write_page_table(f, mappings, batch_size)
+        assert f.getvalue() == expected
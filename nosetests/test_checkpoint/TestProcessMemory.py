@@ -0,0 +1,94 @@
+from lapidary.checkpoint.CheckpointTemplate import MemoryMapping
+from lapidary.checkpoint.Checkpoints import GDBCheckpoint
+from lapidary.checkpoint.ProcessMemory import capture_checkpoint, dump_core_and_kill
+
+from elftools.elf.elffile import ELFFile
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import ctypes
+import json
+import mmap
+import os
+import signal
+
+def test_dump_stopped_child():
+    size = 4 * mmap.PAGESIZE
+    buf  = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
+    buf[:8]  = b'lapidary'
+    buf[-8:] = b'snapshot'
+    vaddr = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+    pid = os.fork()
+    if pid == 0:
+        os.kill(os.getpid(), signal.SIGSTOP)
+        os._exit(0)
+
+    try:
+        os.waitpid(pid, os.WUNTRACED)
+        # The child's copy doesn't change with ours.
+        buf[:8] = b'modified'
+
+        mappings = {}
+        with open('/proc/{}/maps'.format(pid)) as maps:
+            for i, line in enumerate(maps):
+                start, end = [ int(a, 16) for a in line.split()[0].split('-') ]
+                mappings[start] = MemoryMapping(i, 0, start, end - start, 0, 0, '')
+
+        with TemporaryDirectory() as d:
+            core_file = Path(d) / 'gdb.core'
+            dump_core_and_kill(pid, mappings, core_file)
+
+            with core_file.open('rb') as f:
+                segments = [ s for s in ELFFile(f).iter_segments()
+                             if s['p_type'] == 'PT_LOAD' ]
+                assert all(s['p_filesz'] == s['p_memsz'] for s in segments)
+
+                segment = [ s for s in segments if s['p_vaddr'] <= vaddr and
+                            vaddr < s['p_vaddr'] + s['p_memsz'] ]
+                assert len(segment) == 1
+                data = segment[0].data()[vaddr - segment[0]['p_vaddr']:]
+                assert data[:8] == b'lapidary'
+                assert data[size - 8:size] == b'snapshot'
+    finally:
+        os.waitpid(pid, 0)
+
+def test_capture_pmem():
+    size = 4 * mmap.PAGESIZE
+    buf  = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE)
+    buf[:8] = b'lapidary'
+    vaddr = ctypes.addressof(ctypes.c_char.from_buffer(buf))
+
+    pid = os.fork()
+    if pid == 0:
+        os.kill(os.getpid(), signal.SIGSTOP)
+        os._exit(0)
+
+    try:
+        os.waitpid(pid, os.WUNTRACED)
+        with TemporaryDirectory() as d:
+            checkpoint_dir = Path(d) / '0_check.cpt'
+            checkpoint_dir.mkdir()
+            mappings = {}
+            paddr    = mmap.PAGESIZE
+            with open('/proc/{}/maps'.format(pid)) as maps:
+                for i, line in enumerate(maps):
+                    start, end = [ int(a, 16) for a in line.split()[0].split('-') ]
+                    mappings[start] = MemoryMapping(
+                        i, paddr, start, end - start, 0, 0, '').to_dict()
+                    if start <= vaddr < end:
+                        buf_paddr = paddr + vaddr - start
+                    paddr += end - start
+            mappings['mem_size'] = paddr
+            with (checkpoint_dir / 'mappings.json').open('w') as f:
+                json.dump(mappings, f)
+
+            gdb_checkpoint = GDBCheckpoint(checkpoint_dir)
+            assert capture_checkpoint(pid, gdb_checkpoint) == gdb_checkpoint.pmem_file
+            assert not gdb_checkpoint.gdb_core_file.exists()
+            with gdb_checkpoint.pmem_file.open('rb') as pmem:
+                assert os.fstat(pmem.fileno()).st_size == paddr
+                pmem.seek(buf_paddr)
+                assert pmem.read(8) == b'lapidary'
+    finally:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
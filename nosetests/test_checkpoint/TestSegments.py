@@ -0,0 +1,14 @@
+from lapidary.tools.GDBProcess import get_segments
+
+def test_segments_start_on_keyframes():
+    segments = get_segments(100 * 1000, 1000, 4, 5)
+    assert segments == [(0, 25), (25, 50), (50, 75), (75, -1)]
+
+    segments = get_segments(100 * 1000, 1000, 3, 5)
+    assert [ first % 5 for first, _ in segments ] == [0, 0, 0]
+    assert segments[-1] == (70, -1)
+
+def test_segments_max_checkpoints():
+    segments = get_segments(100 * 1000, 1000, 4, 0, max_checkpoints=10)
+    assert segments == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert get_segments(10, 1000, 4, 5) == [(0, -1)]
@@ -0,0 +1,39 @@
+from lapidary.checkpoint.SimPoints import choose_simpoints
+
+import numpy as np
+
+def make_signatures(phases, seed=0):
+    ''' phases: [(number of checkpoints, CPI, cache misses per instruction)] '''
+    rng = np.random.RandomState(seed)
+    signatures = {}
+    for cpi, miss_rate in [ (p[1], p[2]) for p in phases for _ in range(p[0]) ]:
+        insts = 1e9
+        signatures['{}_check.cpt'.format(len(signatures))] = {
+            'instructions':     insts,
+            'cycles':           insts * (cpi + rng.normal(0, 0.02)),
+            'branches':         insts * (0.2 + rng.normal(0, 0.001)),
+            'branch_misses':    insts * 0.01,
+            'cache_references': insts * 0.1,
+            'cache_misses':     insts * (miss_rate + rng.normal(0, 0.00005)),
+        }
+    return signatures
+
+def test_one_checkpoint_per_phase():
+    signatures = make_signatures([(20, 1.0, 0.001), (12, 3.0, 0.05), (8, 2.0, 0.001)])
+    weights, k = choose_simpoints(signatures)
+
+    assert k == 3
+    assert abs(sum(weights.values()) - 1.0) < 1e-9
+    phase_of = lambda name: 0 if int(name.split('_')[0]) < 20 else \
+                            1 if int(name.split('_')[0]) < 32 else 2
+    assert sorted(phase_of(n) for n in weights) == [0, 1, 2]
+    for name, weight in weights.items():
+        assert abs(weight - [0.5, 0.3, 0.2][phase_of(name)]) < 1e-9
+
+def test_skips_empty_signatures():
+    signatures = make_signatures([(10, 1.0, 0.001), (10, 3.0, 0.05)])
+    signatures['20_check.cpt'] = dict(signatures['0_check.cpt'], instructions=0)
+    weights, k = choose_simpoints(signatures)
+
+    assert k == 2
+    assert '20_check.cpt' not in weights
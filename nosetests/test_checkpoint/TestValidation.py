@@ -0,0 +1,69 @@
+from lapidary.checkpoint.Catalog import Catalog
+from lapidary.checkpoint.Checkpoints import GDBCheckpoint
+from lapidary.checkpoint.Compression import CompressionPool
+
+from nosetests.test_checkpoint.TestCheckpointConvert import make_checkpoint, \
+                                                            write_mappings, \
+                                                            PGSIZE
+
+from pathlib import Path
+from tempfile import TemporaryDirectory
+import os
+
+def test_core_headers():
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt',
+                                     [(0x400000, b'\x01' * PGSIZE),
+                                      (0x600000, b'\x02' * 2 * PGSIZE)])
+        header = checkpoint.get_core_header()
+        assert [ (s['p_vaddr'], s['p_memsz']) for s in header.load_segments() ] == \
+            [(0x400000, PGSIZE), (0x600000, 2 * PGSIZE)]
+        assert header.data_size() == checkpoint.gdb_core_file.stat().st_size
+        assert checkpoint.is_valid_checkpoint(deep=True)
+
+        # Only the headers of a compressed core are decompressed.
+        compression = CompressionPool('gzip', max_workers=1)
+        compression.submit(checkpoint.gdb_core_file)
+        compression.wait()
+        assert not checkpoint.gdb_core_file.exists()
+        assert checkpoint.get_core_header().segments == header.segments
+        assert checkpoint.is_valid_checkpoint(deep=True)
+
+def test_truncated_core():
+    with TemporaryDirectory() as d:
+        checkpoint = make_checkpoint(Path(d) / '0_check.cpt',
+                                     [(0x400000, b'\x01' * 4 * PGSIZE)])
+        size = checkpoint.gdb_core_file.stat().st_size
+        os.truncate(str(checkpoint.gdb_core_file), size - PGSIZE)
+        assert not checkpoint.is_valid_checkpoint()
+
+        os.truncate(str(checkpoint.gdb_core_file), 32)
+        assert not checkpoint.is_valid_checkpoint()
+
+def test_checksums():
+    with TemporaryDirectory() as d:
+        root = Path(d)
+        checkpoint = make_checkpoint(root / '0_check.cpt',
+                                     [(0x400000, b'\x01' * 2 * PGSIZE)])
+        checkpoint.write_checksums()
+        assert checkpoint.is_valid_checkpoint()
+
+        # A core that no longer matches its checksum isn't trusted, even if
+        # its headers look fine.
+        with checkpoint.gdb_core_file.open('r+b') as f:
+            f.seek(PGSIZE)
+            f.write(b'\x02')
+        assert not GDBCheckpoint(checkpoint.checkpoint_directory).is_valid_checkpoint()
+
+        # Deep validation also catches mappings which don't fit the core.
+        other = make_checkpoint(root / '1_check.cpt',
+                                [(0x400000, b'\x01' * 2 * PGSIZE)])
+        write_mappings(other.mappings_file, [(0x400000, PGSIZE)], 4 * PGSIZE)
+        other.write_checksums()
+        assert other.is_valid_checkpoint()
+        assert not GDBCheckpoint(other.checkpoint_directory).is_valid_checkpoint(deep=True)
+
+        catalog = Catalog(root)
+        catalog.scan()
+        assert catalog.validate(deep=True) == ['0_check.cpt', '1_check.cpt']
+        assert catalog.checkpoints() == []
@@ -0,0 +1,133 @@
+from lapidary.simulate.RemoteExecutor import RemoteExecutor, SimulationWorker
+from lapidary.simulate.Scheduler import Scheduler, Task
+
+from multiprocessing import Process
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep
+import os
+import signal
+
+AUTHKEY = b'lapidary'
+
+def write_result(name, delay):
+    sleep(delay)
+    Path('results').mkdir()
+    Path('results', name).write_text(name)
+    Path('log.txt').write_text('{} done\n'.format(name))
+
+def start_worker(slots):
+    worker = SimulationWorker(('localhost', 0), AUTHKEY, slots)
+    def serve():
+        os.setsid()
+        worker.serve_forever()
+    proc = Process(target=serve)
+    proc.start()
+    worker.listener.close()
+    return worker.address, proc
+
+def stop_worker(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    proc.join()
+
+def make_task(name, delay):
+    outputs = [ ('results/{}'.format(name), 'w'), ('log.txt', 'a') ]
+    return Task(name, write_result, (name, delay), outputs=outputs,
+        is_successful=lambda task: Path('results', name).exists())
+
+def test_remote_outputs():
+    cwd = os.getcwd()
+    address, proc = start_worker(2)
+    try:
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            scheduler = Scheduler(1, executor=RemoteExecutor([address], AUTHKEY))
+            assert scheduler.max_procs == 2
+            for name in ['a', 'b', 'c']:
+                scheduler.submit(make_task(name, 0.1))
+            scheduler.run()
+
+            assert scheduler.report()['successful'] == 3
+            for name in ['a', 'b', 'c']:
+                assert Path('results', name).read_text() == name
+            assert len(Path('log.txt').read_text().splitlines()) == 3
+    finally:
+        os.chdir(cwd)
+        stop_worker(proc)
+
+def test_requeue_on_lost_worker():
+    cwd = os.getcwd()
+    good, good_proc = start_worker(1)
+    bad,  bad_proc  = start_worker(1)
+    try:
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            scheduler = Scheduler(1, executor=RemoteExecutor([good, bad], AUTHKEY))
+            killer = Process(target=lambda: (sleep(0.5),
+                                             os.killpg(bad_proc.pid, signal.SIGKILL)))
+            for name in ['a', 'b']:
+                scheduler.submit(make_task(name, 1.0))
+            killer.start()
+            scheduler.run()
+            killer.join()
+
+            report = scheduler.report()
+            assert report['successful'] == 2
+            assert report['requeued'] == 1
+            assert Path('results', 'a').exists() and Path('results', 'b').exists()
+    finally:
+        os.chdir(cwd)
+        stop_worker(good_proc)
+        stop_worker(bad_proc)
+
+def test_all_workers_lost():
+    cwd = os.getcwd()
+    address, proc = start_worker(1)
+    try:
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            scheduler = Scheduler(1, executor=RemoteExecutor([address], AUTHKEY))
+            killer = Process(target=lambda: (sleep(0.5),
+                                             os.killpg(proc.pid, signal.SIGKILL)))
+            tasks = [ make_task(name, 1.0) for name in ['a', 'b'] ]
+            for task in tasks:
+                scheduler.submit(task)
+            finished = []
+            killer.start()
+            scheduler.run(on_finish=lambda task: finished.append(task.key))
+            killer.join()
+
+            assert sorted(finished) == ['a', 'b']
+            assert [ t.status for t in tasks ] == ['failed (no slots left)'] * 2
+            assert scheduler.report()['failed'] == 2
+    finally:
+        os.chdir(cwd)
+        stop_worker(proc)
+
+def write_unreadable_output(name):
+    # A directory where the worker expects to read back a file.
+    Path('results', name).mkdir(parents=True)
+
+def test_failed_handler_keeps_worker():
+    cwd = os.getcwd()
+    address, proc = start_worker(1)
+    try:
+        with TemporaryDirectory() as d:
+            os.chdir(d)
+            scheduler = Scheduler(1, executor=RemoteExecutor([address], AUTHKEY))
+            bad = Task('bad', write_unreadable_output, ('bad',),
+                       outputs=[('results/bad', 'w')])
+            scheduler.submit(bad)
+            scheduler.submit(make_task('a', 0.1))
+            scheduler.run()
+
+            report = scheduler.report()
+            assert bad.status == 'failed'
+            assert report['successful'] == 1 and report['requeued'] == 0
+            assert scheduler.executor.slots == 1
+    finally:
+        os.chdir(cwd)
+        stop_worker(proc)
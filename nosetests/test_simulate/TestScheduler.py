@@ -0,0 +1,121 @@
+from lapidary.simulate.Scheduler import Scheduler, Task
+
+from pathlib import Path
+from subprocess import Popen
+from tempfile import TemporaryDirectory
+from time import sleep, time
+
+def fail_once(marker):
+    if not marker.exists():
+        marker.touch()
+        raise Exception('First attempt fails')
+
+def hang(pid_file):
+    proc = Popen(['sleep', '60'])
+    pid_file.write_text(str(proc.pid))
+    sleep(60)
+
+def test_retry():
+    with TemporaryDirectory() as d:
+        scheduler = Scheduler(2, max_retries=1, backoff_seconds=0.1)
+        finished = []
+        scheduler.submit(Task('flaky', fail_once, (Path(d) / 'marker',)))
+        scheduler.run(lambda task: finished.append(task))
+
+        assert len(finished) == 1
+        assert finished[0].status == 'successful'
+        assert finished[0].attempts == 2
+        assert scheduler.report()['retries'] == 1
+
+def test_timeout_kills_process_group():
+    with TemporaryDirectory() as d:
+        pid_file = Path(d) / 'pid'
+        scheduler = Scheduler(1, timeout_seconds=1.0)
+        task = Task('hung', hang, (pid_file,))
+        scheduler.submit(task)
+        scheduler.run()
+
+        assert task.status == 'failed (timeout)'
+        report = scheduler.report()
+        assert report['timeouts'] == 1
+        assert 0.0 < report['utilization'] <= 1.0
+
+        # The grandchild should have been killed with its process group
+        # (it may linger as a zombie until something reaps it).
+        stat = Path('/proc') / pid_file.read_text() / 'stat'
+        for _ in range(100):
+            if not stat.exists() or stat.read_text().split()[2] == 'Z':
+                break
+            sleep(0.01)
+        else:
+            assert False, 'sleep process survived the timeout'
+
+def test_timeout_scale():
+    scheduler = Scheduler(1, timeout_seconds=0.5)
+    task = Task('long', sleep, (1.0,), timeout_scale=4)
+    scheduler.submit(task)
+    scheduler.run()
+
+    assert task.status == 'successful'
+    assert scheduler.report()['timeouts'] == 0
+
+def allocate(size, log):
+    start = time()
+    buf = bytearray(size)
+    sleep(0.2)
+    log.write_text('{} {}'.format(start, time()))
+
+def test_memory_budget():
+    mb = 1 << 20
+    with TemporaryDirectory() as d:
+        logs = { k: Path(d) / k for k in ['big0', 'big1', 'small0', 'small1'] }
+        scheduler = Scheduler(4, memory_budget=200 * mb)
+        for key, log in logs.items():
+            size = 100 * mb if 'big' in key else mb
+            memory = 150 * mb if 'big' in key else 10 * mb
+            scheduler.submit(Task(key, allocate, (size, log), memory=memory))
+        finished = []
+        scheduler.run(lambda task: finished.append(task))
+
+        assert scheduler.report()['successful'] == 4
+        # The small tasks were packed in next to the first big one, but the
+        # two big ones never ran at the same time.
+        times = { k: [float(t) for t in log.read_text().split()]
+                  for k, log in logs.items() }
+        assert times['small0'][0] < times['big0'][1]
+        assert times['big1'][0] >= times['big0'][1]
+        assert max(t.max_rss for t in finished) >= 100 * mb
+        assert scheduler.report()['rss_ratio'] is not None
+
+class HeldExecutor:
+    ''' Starts tasks which never finish. '''
+    slots = 8
+
+    def start(self, task):
+        return object()
+
+def test_large_task_not_starved():
+    scheduler = Scheduler(8, memory_budget=100, executor=HeldExecutor())
+    scheduler.MAX_SKIPS = 2
+    scheduler.submit(Task('big', None, (), memory=60, priority=0))
+    huge = Task('huge', None, (), memory=80, priority=1)
+    scheduler.submit(huge)
+    for i in range(6):
+        scheduler.submit(Task('small{}'.format(i), None, (), memory=10,
+                              priority=2))
+
+    scheduler._start_ready_tasks(time())
+    started = sorted(t.key for t in scheduler.running.values())
+    # Without aging, four small tasks would have been packed in.
+    assert started == ['big', 'small0', 'small1']
+    assert huge.skips == 2
+    assert huge in scheduler.pending
+
+def test_priority():
+    scheduler = Scheduler(1)
+    order = []
+    for key, priority in [('c', 2), ('a', 0), ('b', 1), ('a2', 0)]:
+        scheduler.submit(Task(key, sleep, (0,), priority=priority,
+            on_finish=lambda task: order.append(task.key)))
+    scheduler.run()
+    assert order == ['a', 'a2', 'b', 'c']
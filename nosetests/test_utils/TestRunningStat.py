@@ -0,0 +1,22 @@
+from lapidary.utils.Utils import RunningStat
+
+import numpy as np
+
+def test_matches_numpy():
+    values = np.random.RandomState(0).normal(1.5, 0.2, 100)
+    stat = RunningStat()
+    for value in values:
+        stat.add(value)
+
+    assert stat.count == len(values)
+    assert np.isclose(stat.mean, values.mean())
+    assert np.isclose(stat.std(), values.std(ddof=0))
+    assert np.isclose(stat.ci(), 1.96 * values.std(ddof=0) / np.sqrt(len(values)))
+
+def test_count_for_ci_percent():
+    stat = RunningStat()
+    for value in [0.9, 1.1] * 5:
+        stat.add(value)
+    # std is 0.1, so the CI is within 1% of the mean at ~385 samples.
+    assert stat.ci_percent() > 1.0
+    assert stat.count_for_ci_percent(1.0) == 385
@@ -30,7 +30,7 @@ def main():
         packages=setuptools.find_packages(),
         package_data={'lapidary': [
             'config/schema.yaml',
-            'checkpoint/get_brk.c',
+            'checkpoint/fork_snapshot.c',
             'checkpoint/get_fs_base.c'
         ]},
         setup_requires=['wheel'],